@@ -290,6 +290,10 @@ def _mk_execution_parser(p: ArgParser) -> ArgParser:
     group.add_argument("--use-ns", dest="use_ns",
                        action="store_true",
                        help="Use the Pyro NameServer to store object locations. Currently a Pyro nameserver must be started separately for this to work.")
+    group.add_argument("--server-mode", dest="server_mode",
+                       type=str, default="pyro", choices=["pyro", "asyncio"],
+                       help="Run the server as a Pyro daemon or serve executors from a single asyncio event loop "
+                            "using a lighter-weight protocol. [Default = %(default)s]")
     group.add_argument("--latency-tolerance", dest="latency_tolerance",
                        type=float, default=600.0,
                        help="Allowed grace period by which an executor may miss a heartbeat tick before being considered failed [Default = %(default)s.")
@@ -324,6 +328,9 @@ def _mk_execution_parser(p: ArgParser) -> ArgParser:
     group.add_argument("--ppn", dest="ppn",
                        type=int, default=8,
                        help="Number of processes per node. Used when --queue-type=pbs. [Default = %(default)s].")
+    group.add_argument("--whole-node-executors", dest="whole_node_executors", action="store_true",
+                       help="Run one executor per node, using all --ppn processors of the node (rather than --proc), "
+                            "and submit the executors launched at once as a single job array. [Default = %(default)s]")
     group.add_argument("--queue-name", dest="queue_name", type=str, default=None,
                        help="Name of the queue, e.g., all.q (MICe) or batch (SciNet)")
     group.add_argument("--queue-type", dest="queue_type", type=str, default=None,
@@ -345,6 +352,9 @@ def _mk_execution_parser(p: ArgParser) -> ArgParser:
                        help="The number of minutes after which an executor will not accept new jobs anymore. This can be useful when running executors on a batch system where other (competing) jobs run for a limited amount of time. The executors can behave in a similar way by given them a rough end time. [Default = %(default)s]")
     group.add_argument('--local', dest="local", action='store_true',
                        help="Don't submit anything to any specified queueing system but instead run as a server/executor")
+    group.add_argument("--in-process", dest="in_process", action="store_true",
+                       help="With --local, run the stages directly from the pipeline's own process (up to --proc "
+                            "at a time, within --mem) rather than via a server and executors. [Default = %(default)s]")
     group.add_argument("--config-file", type=str, metavar='config_file', is_config_file=True,
                        required=False, help='Config file location')
     group.add_argument("--prologue-file", type=str, metavar='file',
@@ -361,6 +371,37 @@ def _mk_execution_parser(p: ArgParser) -> ArgParser:
                        help="Overall factor by which to scale all memory estimates/requests (including default job memory, "
                             "but not executor totals (--mem)), say due to system differences or overcommitted nodes. "
                             "[Default=%(default)s]")
+    group.add_argument("--learn-resources", dest="learn_resources", action="store_true",
+                       help="Record the peak memory use and running time of each stage (in the output directory) "
+                            "and, once enough similar stages have run, use these to raise the static memory "
+                            "estimates (scaled by --memory-factor) where these seem too low, and instead of "
+                            "the static running time estimates. [Default=%(default)s]")
+    group.add_argument("--stage-trace", dest="stage_trace", action="store_true",
+                       help="Record when each stage becomes runnable and is claimed, started, finished, failed or "
+                            "lost (and by which executor), write these out as <pipeline_name>_trace.json "
+                            "(a Chrome trace, viewable in chrome://tracing) and <pipeline_name>_trace.csv, "
+                            "and summarize the time spent per tool at shutdown. [Default=%(default)s]")
+    group.add_argument("--fuse-stages", dest="fuse_stages", action="store_true",
+                       help="Run linear chains of cheap stages (where each stage's outputs are used only by the next) "
+                            "as single jobs (`sh -c 'a && b ...'`), saving a round trip to the server per stage. "
+                            "A chain is retried as a whole if any of its stages fails, or if it's lost.  "
+                            "Only the first stage's log file gets the executor's header and the chain's exit "
+                            "status; the others get just their command and output, and the resource usage of "
+                            "chains isn't learned (see --learn-resources). [Default = %(default)s]")
+    group.add_argument("--stage-cache-dir", dest="stage_cache_dir",
+                       type=str, default=None,
+                       help="Directory (which may be shared by several pipelines) in which to keep the outputs of "
+                            "stages, keyed by their commands, the contents of their inputs and the programs run, "
+                            "so that stages already run with the same inputs are skipped, their outputs being "
+                            "cloned or copied from there instead. [Default = %(default)s (no cache)]")
+    group.add_argument("--stage-cache-max-size", dest="stage_cache_max_size",
+                       type=float, default=None,
+                       help="Remove the least recently used entries of the stage cache at shutdown "
+                            "so that it takes up at most this many G. [Default = %(default)s (no limit)]")
+    group.add_argument("--stage-cache-max-age", dest="stage_cache_max_age",
+                       type=float, default=None,
+                       help="Remove entries of the stage cache which haven't been used for this many days "
+                            "at shutdown. [Default = %(default)s (no limit)]")
     group.add_argument("--cmd-wrapper", dest="cmd_wrapper",
                        type=str, default="",
                        help="Wrapper inside of which to run the command, e.g., '/usr/bin/time -v'. [Default='%(default)s']")
@@ -379,10 +420,27 @@ def _mk_execution_parser(p: ArgParser) -> ArgParser:
     group.set_defaults(check_outputs=False)
     group.add_argument("--fs-delay", dest="fs_delay",
                        type=float, default=5,
-                       help="Time (sec) to allow for NFS to become consistent after stage completion [Default=%(default)s]")
+                       help="Maximum time (sec) to allow for NFS to become consistent after stage completion "
+                            "(waiting only until the stage's outputs appear) [Default=%(default)s]")
     group.add_argument("--executor_wrapper", dest="executor_wrapper",
                        type=str, default="",
                        help="Command inside of which to run the executor. [Default='%(default)s']")
+    group.add_argument("--journal-flush-records", dest="journal_flush_records",
+                       type=int, default=32,
+                       help="Write out the record of finished stages (used on restart) after this many "
+                            "stages have finished ... [Default = %(default)s]")
+    group.add_argument("--journal-flush-interval", dest="journal_flush_interval",
+                       type=float, default=2.0,
+                       help="... or when the oldest unwritten record is this many seconds old. "
+                            "[Default = %(default)s]")
+    group.add_argument("--metrics-port", dest="metrics_port",
+                       type=int, default=None,
+                       help="Serve the server's status on this port of localhost, at /metrics in the Prometheus "
+                            "text format and at /status as JSON. [Default = %(default)s (don't serve)]")
+    group.add_argument("--profile-server", dest="profile_server", action="store_true",
+                       help="Time the server's methods, reporting their latency histograms via the status "
+                            "snapshot and in <pipeline_name>_server_latency.json at shutdown; SIGUSR1 starts "
+                            "and stops a detailed (cProfile/tracemalloc) profile. [Default = %(default)s]")
     group.add_argument("--defer-directory-creation", default=False,
                        action="store_true", dest="defer_directory_creation",
                        help="Create relevant directories when a stage is run instead of at startup [Default=%(default)s]")
@@ -1,10 +1,14 @@
+from sys import intern
+
 from pydpiper.execution.pipeline import CmdStage, InputFile, OutputFile
 
 def convertCmdStage(cmd_stage):
     c = CmdStage([])
-    c.inputFiles  = [x.path for x in cmd_stage.inputs]
-    c.outputFiles = [x.path for x in cmd_stage.outputs]
-    c.cmd  = cmd_stage.to_array()
+    # intern all tokens since the same paths appear in many commands
+    # (the command first, so that the interned copies are the ones the stage already holds)
+    c.cmd  = tuple(intern(x) for x in cmd_stage.to_array())
+    c.inputFiles  = tuple(intern(x.path) for x in cmd_stage.inputs)
+    c.outputFiles = tuple(intern(x.path) for x in cmd_stage.outputs)
     c.mem  = cmd_stage.memory
     c.procs = cmd_stage.procs
     c.name = c.cmd[0]
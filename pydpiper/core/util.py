@@ -82,7 +82,7 @@ def output_directories(stages: Set['pydpiper.execution.pipeline.CmdStage']) -> S
     # way of tagging this other than ending the path in a trailing "/"?
     all_files_to_consider = []
     for stage in stages:
-        all_files_to_consider = all_files_to_consider + stage.outputFiles
+        all_files_to_consider.extend(stage.outputFiles)
         if stage.logFile:
             all_files_to_consider.append(stage.logFile)
         else:
@@ -15,11 +15,13 @@ from pydpiper.core.stages import Result
 from pydpiper.core.arguments import (CompoundParser, AnnotatedParser, application_parser,
                                      registration_parser, execution_parser, parse)
 from pydpiper.execution.pipeline import Pipeline, pipelineDaemon
+from pydpiper.execution.local import run_in_process
 from pydpiper.execution.queueing import runOnQueueingSystem
 from pydpiper.execution.pipeline_executor import ensure_exec_specified
 from pydpiper.core.util import output_directories
 from pydpiper.core.conversion import convertCmdStage
 from pydpiper.minc.registration import can_read_MINC_file
+from pydpiper.minc import headers
 
 PYDPIPER_VERSION = pkg_resources.get_distribution("pydpiper").version  # pylint: disable=E1101
 
@@ -132,9 +134,14 @@ def execute(stages, options):
     # if options.application.output_directory:
     #     os.chdir(options.application.output_directory)
 
+    # share the MINC headers read (e.g., by the stages' memory-estimation hooks) with other runs:
+    headers.use_store(options.application.output_directory)
+
     # TODO: logger.info('Constructing pipeline...')
     pipeline = Pipeline(stages=[convertCmdStage(s) for s in stages],
                         options=options)
+    # measure the stages' sizes (for the learned resource usage model) by their MINC inputs
+    pipeline.stage_size = headers.input_voxels
 
     # TODO: print/log version
     reconstruct_command(options)
@@ -144,7 +151,7 @@ def execute(stages, options):
     if options.application.create_graph:
         # TODO: these could have more descriptive names ...
         logger.debug("Writing dot file...")
-        nx.drawing.nx_agraph.write_dot(pipeline.G, str(options.application.pipeline_name) + "_labeled-tree.dot")
+        nx.drawing.nx_agraph.write_dot(pipeline.networkx_graph(), str(options.application.pipeline_name) + "_labeled-tree.dot")
         nx.drawing.nx_agraph.write_dot(file_graph(stages, options.application.output_directory),
                                        str(options.application.pipeline_name) + "_labeled-tree-alternate.dot")
         logger.debug("Done.")
@@ -203,11 +210,15 @@ def mk_application(parsers: List[AnnotatedParser], pipeline: Callable[[Any], Res
                         ] + parsers)
     def f():
         options = parse(p, sys.argv[1:])
+        # (the pipeline may already look at its input files' headers while it's being constructed)
+        headers.use_store(options.application.output_directory)
         execute(pipeline(options).stages, options)
     return f
 
 
 def backend(options):
+    if options.execution.local and options.execution.in_process:
+        return in_process_execute
     return grid_only_execute if options.execution.submit_server and not options.execution.local else normal_execute
 
 # TODO: should create_directories be added as a method to Pipeline?
@@ -236,6 +247,14 @@ def normal_execute(pipeline, options):
     pipelineDaemon(pipeline, options, sys.argv[0])
     logger.info("Server has stopped.  Quitting...")
 
+def in_process_execute(pipeline, options):
+    # like normal_execute, but run the stages from this process instead of launching a server
+    logger.info("Running pipeline in process...")
+    if not options.execution.defer_directory_creation:
+        create_directories(pipeline.stages)
+    pipelineDaemon(pipeline, options, sys.argv[0], launch=run_in_process)
+    logger.info("Pipeline has stopped.  Quitting...")
+
 def grid_only_execute(pipeline, options):
     if options.execution.queue_type != 'pbs':
         raise ValueError("currently we only support submitting the server to PBS/Torque systems")
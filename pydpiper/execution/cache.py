@@ -0,0 +1,303 @@
+"""
+An opt-in cache of stage outputs shared between pipelines (--stage-cache-dir), so that stages which
+have already been run elsewhere with the same inputs (e.g., the registrations of the same atlases
+and templates in many MAGeT/MBM pipelines) needn't be run again.
+
+Unlike the finished stages journal (pydpiper.execution.journal), which is keyed by a stage's command
+and so only works within a single output directory, entries are keyed by digests of the contents
+of the stage's input files (in order) and its command with each argument which is an input or
+output file replaced by that file's position among the stage's inputs or outputs, together with
+the identity (path, size and modification time) of the program run, which stands in for its version.
+(Files named within other arguments, e.g., antsRegistration's `CC[fixed.mnc,moving.mnc,1,4]`, are
+left in place, so such stages are only reused by pipelines using the same paths.)  Only declared
+inputs and outputs are taken into account, so a stage reading or writing other files may be wrongly reused.
+
+An entry holds (read-only copies of) a stage's outputs.  Since reading a stage's inputs is slow,
+looking for and restoring an entry, like adding one, happens in a background thread: when the
+server is about to enqueue a stage it looks for an entry, and if there is one, puts copies of
+the outputs into place (copy-on-write clones where the filesystem supports these) and marks the
+stage finished rather than running it; once a stage has finished, its outputs are added to the
+cache.  Entries unused for longer than a maximum age, and then the least recently used entries
+beyond a maximum total size, are removed at shutdown.
+"""
+
+import concurrent.futures
+import errno
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+import uuid
+
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+logger = logging  # type: Any
+
+# ioctl to make a file share another's data (copy-on-write) on filesystems supporting it (btrfs, xfs)
+FICLONE = 0x40049409
+# the file recording an entry's command; its modification time is when the entry was last used
+META_FILENAME = "meta.json"
+# directory (within the cache) of entries being written, and the age (s) after which these are abandoned
+TMP_DIRNAME = "tmp"
+STALE_TMP_AGE = 24 * 3600
+
+
+def file_digest(path: str) -> str:
+    """A digest of the contents of a file.
+
+    >>> import tempfile
+    >>> with tempfile.NamedTemporaryFile() as f:
+    ...     _ = f.write(b"data"); f.flush()
+    ...     file_digest(f.name)
+    '82f64e6be809763df98195dfa5de656c'
+    """
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def program_identity(program: str) -> str:
+    """The path, size and modification time of the executable `program` would run (or just `program`
+    if it can't be found), so that entries made with a different version aren't reused."""
+    path = shutil.which(program)
+    if path is None:
+        return program
+    path = os.path.realpath(path)
+    st = os.stat(path)
+    return "%s:%d:%d" % (path, st.st_size, st.st_mtime_ns)
+
+
+def _clone(src: str, dst: str) -> bool:
+    """Make `dst` a copy of `src` sharing its data (copy-on-write), if the filesystem supports this."""
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            return True
+        except OSError:
+            pass
+    os.unlink(dst)
+    return False
+
+
+class StageCache(object):
+    """A directory of stage outputs, keyed by `key`, which several pipelines may use at once.
+
+    >>> import tempfile
+    >>> d = tempfile.mkdtemp()
+    >>> inp, a, b = (os.path.join(d, f) for f in ["in.mnc", "a_blur.mnc", "b_blur.mnc"])
+    >>> with open(inp, 'w') as fh: _ = fh.write("image")
+    >>> c = StageCache(os.path.join(d, "cache"))
+    >>> k = c.key(["mincblur", inp, a], inputs=[inp], outputs=[a])
+    >>> k == c.key(["mincblur", inp, b], inputs=[inp], outputs=[b])
+    True
+    >>> c.lookup(["mincblur", inp, b], inputs=[inp], outputs=[b]).result() == (k, False)
+    True
+    >>> with open(a, 'w') as fh: _ = fh.write("blurred")
+    >>> c.store(["mincblur", inp, a], inputs=[inp], outputs=[a])
+    >>> c.wait()
+    >>> c.lookup(["mincblur", inp, b], inputs=[inp], outputs=[b]).result() == (k, True), open(b).read()
+    (True, 'blurred')
+    >>> os.access(b, os.W_OK)  # (the entry's copy is read-only, but the restored output isn't)
+    True
+    >>> c.evict(max_size=0)
+    (1, 7)
+    >>> c.restore(k, [b])
+    False
+    """
+    def __init__(self, directory: str, max_size: Optional[float] = None, max_age: Optional[float] = None) -> None:
+        self.directory = directory
+        # (in bytes and seconds, respectively)
+        self.max_size = max_size
+        self.max_age = max_age
+        self.hits = 0
+        # digests of files already read, by (path, size, modification time)
+        self._digests = {}  # type: Dict[Tuple[str, int, int], str]
+        self._programs = {}  # type: Dict[str, str]
+        # looking for and storing entries (reading inputs and copying outputs) is slow, so done by a
+        # background thread, in the order requested (started on first use, e.g., in a forked server process)
+        self._pool = None  # type: Optional[concurrent.futures.ThreadPoolExecutor]
+        self._pending = []  # type: List[concurrent.futures.Future]
+        os.makedirs(os.path.join(directory, TMP_DIRNAME), exist_ok=True)
+
+    def _file_digest(self, path: str) -> str:
+        st = os.stat(path)
+        k = (path, st.st_size, st.st_mtime_ns)
+        digest = self._digests.get(k)
+        if digest is None:
+            digest = self._digests[k] = file_digest(path)
+        return digest
+
+    def key(self, cmd: Sequence[str], inputs: Sequence[str], outputs: Sequence[str]) -> Optional[str]:
+        """The key of the stage running `cmd`, or None if some of its inputs can't be read.
+        (All the inputs are digested, whether or not they appear as arguments of their own.)
+
+        >>> import tempfile
+        >>> d = tempfile.mkdtemp()
+        >>> fixed = os.path.join(d, "fixed.mnc")
+        >>> c = StageCache(os.path.join(d, "cache"))
+        >>> def k():
+        ...     return c.key(["antsRegistration", "CC[%s,moving.mnc,1,4]" % fixed], inputs=[fixed], outputs=[])
+        >>> with open(fixed, 'w') as fh: _ = fh.write("image")
+        >>> k1 = k()
+        >>> with open(fixed, 'w') as fh: _ = fh.write("other image")
+        >>> k1 == k()
+        False
+        """
+        if not cmd:
+            return None
+        program = self._programs.get(cmd[0])
+        if program is None:
+            program = self._programs[cmd[0]] = program_identity(cmd[0])
+        try:
+            digests = [self._file_digest(f) for f in inputs]
+        except OSError:
+            return None
+        input_ixs = {f: k for k, f in enumerate(inputs)}
+        output_ixs = {o: k for k, o in enumerate(outputs)}
+        normalized = [("<in:%d>" % input_ixs[a]) if a in input_ixs
+                      else ("<out:%d>" % output_ixs[a]) if a in output_ixs
+                      else a
+                      for a in cmd[1:]]
+        return hashlib.sha256(json.dumps([program, digests, len(outputs)] + normalized).encode()).hexdigest()
+
+    def _entry(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key)
+
+    def _submit(self, f, *args) -> concurrent.futures.Future:
+        if self._pool is None:
+            self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._pending = [p for p in self._pending if not p.done()]
+        future = self._pool.submit(f, *args)
+        self._pending.append(future)
+        return future
+
+    def lookup(self, cmd: Sequence[str], inputs: Sequence[str], outputs: Sequence[str]) -> concurrent.futures.Future:
+        """Look for the entry of the stage running `cmd` (in the background), putting its outputs into
+        place if there is one.  The result is the stage's key (None if some of its inputs can't be read)
+        and whether the outputs were restored."""
+        return self._submit(self._lookup, list(cmd), list(inputs), list(outputs))
+
+    def _lookup(self, cmd: Sequence[str], inputs: Sequence[str], outputs: Sequence[str]) -> Tuple[Optional[str], bool]:
+        key = self.key(cmd, inputs, outputs)
+        return key, key is not None and self.restore(key, outputs)
+
+    def restore(self, key: str, outputs: Sequence[str]) -> bool:
+        """Put (writable) copies of the outputs of the entry for `key` (if any) into place as `outputs`;
+        return whether this succeeded."""
+        entry = self._entry(key)
+        restored = []
+        try:
+            os.utime(os.path.join(entry, META_FILENAME))  # (mark as recently used)
+            for k, output in enumerate(outputs):
+                os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+                try:
+                    os.unlink(output)
+                except FileNotFoundError:
+                    pass
+                src = os.path.join(entry, str(k))
+                # (not hard links, which would share the entry's permissions and contents with the output)
+                if not _clone(src, output):
+                    shutil.copyfile(src, output)
+                restored.append(output)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                logger.warning("Couldn't restore %s from the stage cache: %s", outputs, e)
+            # (so that the stage can write its outputs)
+            for output in restored:
+                os.unlink(output)
+            return False
+        self.hits += 1
+        return True
+
+    def store(self, cmd: Sequence[str], inputs: Sequence[str], outputs: Sequence[str],
+              key: Optional[str] = None) -> None:
+        """Add (copies of) the `outputs` of a stage running `cmd` which has just finished to the cache
+        (in the background; see `wait`), as the entry for `key` if it's already known."""
+        self._submit(self._store, list(cmd), list(inputs), list(outputs), key)
+
+    def _store(self, cmd: Sequence[str], inputs: Sequence[str], outputs: Sequence[str], key: Optional[str]) -> None:
+        if key is None:
+            key = self.key(cmd, inputs, outputs)
+            if key is None:
+                return
+        entry = self._entry(key)
+        if os.path.exists(entry):
+            return
+        tmp = os.path.join(self.directory, TMP_DIRNAME, uuid.uuid4().hex)
+        try:
+            os.mkdir(tmp)
+            for k, output in enumerate(outputs):
+                if not _clone(output, os.path.join(tmp, str(k))):
+                    shutil.copyfile(output, os.path.join(tmp, str(k)))
+                # (so that the entry can't be modified by mistake; restored outputs are writable copies)
+                os.chmod(os.path.join(tmp, str(k)), 0o444)
+            with open(os.path.join(tmp, META_FILENAME), 'w') as fh:
+                json.dump(dict(cmd=" ".join(cmd), created=time.time()), fh)
+            os.makedirs(os.path.dirname(entry), exist_ok=True)
+            os.rename(tmp, entry)
+        except OSError as e:
+            if not os.path.exists(entry):  # (otherwise another pipeline just added it)
+                logger.warning("Couldn't add %s to the stage cache: %s", outputs, e)
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    def wait(self) -> None:
+        """Wait for lookups to finish and entries being added to be written out."""
+        concurrent.futures.wait(self._pending)
+        self._pending = []
+
+    def evict(self, max_size: Optional[float] = None, max_age: Optional[float] = None,
+              now: Optional[float] = None) -> Tuple[int, int]:
+        """Remove entries unused for more than `max_age` seconds, and then the least recently used ones
+        until the remaining ones take up at most `max_size` bytes (by default, the cache's limits);
+        return the number of entries removed and their size."""
+        max_size = self.max_size if max_size is None else max_size
+        max_age = self.max_age if max_age is None else max_age
+        now = time.time() if now is None else now
+        tmp_dir = os.path.join(self.directory, TMP_DIRNAME)
+        for name in os.listdir(tmp_dir):
+            path = os.path.join(tmp_dir, name)
+            try:
+                if now - os.stat(path).st_mtime > STALE_TMP_AGE:
+                    shutil.rmtree(path, ignore_errors=True)
+            except OSError:
+                pass
+        entries = []
+        for prefix in os.listdir(self.directory):
+            if prefix == TMP_DIRNAME:
+                continue
+            for key in os.listdir(os.path.join(self.directory, prefix)):
+                entry = os.path.join(self.directory, prefix, key)
+                try:
+                    last_used = os.stat(os.path.join(entry, META_FILENAME)).st_mtime
+                    size = sum(e.stat().st_size for e in os.scandir(entry) if e.name != META_FILENAME)
+                except OSError:
+                    continue
+                entries.append((last_used, size, entry))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        removed, removed_size = 0, 0
+        for last_used, size, entry in entries:
+            if not ((max_age is not None and now - last_used > max_age)
+                    or (max_size is not None and total > max_size)):
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+            removed += 1
+            removed_size += size
+        if removed:
+            logger.info("Removed %d entries (%.2fG) from the stage cache", removed, removed_size / 2 ** 30)
+        return removed, removed_size
+
+    def close(self) -> None:
+        self.wait()
+        if self._pool is not None:
+            self._pool.shutdown()
+        try:
+            self.evict()
+        except OSError:
+            logger.exception("Couldn't clean up the stage cache")
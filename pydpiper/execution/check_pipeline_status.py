@@ -9,7 +9,7 @@ Path.ls = lambda x: list(x.iterdir())
 
 signal.signal(signal.SIGPIPE, signal.SIG_DFL)
 
-import Pyro4
+from pydpiper.execution import rpc
 
 """ check the status of a pydpiper pipeline by querying the server using its uri"""
 
@@ -17,6 +17,8 @@ if __name__ == '__main__':
 
     parser = argparse.ArgumentParser()
     parser.add_argument("uri_file", type=str, help="file containing server's URI. If not given, defaults to *_uri", nargs="?")
+    parser.add_argument("--minutes", type=int, default=10,
+                        help="report the number of stages finished over this many minutes [default = %(default)s]")
 
     options = parser.parse_args()
 
@@ -36,48 +38,52 @@ if __name__ == '__main__':
     # find the server
     try:
         uf = open(uri_file)
-        serverURI = Pyro4.URI(uf.readline())
+        serverURI = uf.readline()
         uf.close()
     except:
         print("There is a problem opening the specified uri file: %s" % uri_file)
         raise
 
-    proxyServer = Pyro4.Proxy(serverURI)
+    # works for both Pyro and asyncio (--server-mode) servers
+    proxyServer = rpc.connect(serverURI)
+
+    # everything in a single call, so as not to hold up a busy server:
+    status = proxyServer.getStatusSnapshot(options.minutes)
+    stages, executors = status["stages"], status["executors"]
 
     # total number of stages in the pipeline:
-    numStages = proxyServer.getTotalNumberOfStages()
-    processedStages = proxyServer.getNumberProcessedStages()
-    print("Total number of stages in the pipeline: ", numStages)
-    print("Number of stages already processed:     ", processedStages, "\n")
+    print("Total number of stages in the pipeline: ", stages["total"])
+    print("Number of stages already processed:     ", stages["finished"], "\n")
+    if status.get("stage_cache_hits") is not None:
+        print("Number of stages restored from cache:   ", status["stage_cache_hits"], "\n")
 
     # some info about executors
-    runningClients = proxyServer.getNumberOfRunningClients()
-    waitingClients = proxyServer.getNumberOfQueuedClients()
-    print("Number of active clients:               ", runningClients)
-    print("Number of clients waiting in the queue: ", waitingClients, "\n")
+    print("Number of active clients:               ", executors["registered"])
+    print("Number of clients waiting in the queue: ", executors["queued"], "\n")
 
     # stages currently running:
-    runningStages = proxyServer.getCurrentlyRunningStages()
+    runningStages = status["running_stages"]
     print("Currently running stages (%d): " % len(runningStages))
     for stage in runningStages:
-        print("%s\t%s\n" % (stage, proxyServer.getStageCommand(stage)))
+        print("%s\t%s\n" % (stage["ix"], stage["cmd"]))
 
     # currently runnable jobs:
-    numberRunnableStages = proxyServer.getNumberRunnableStages()
-    print("\nNumber of runnable stages:               ", numberRunnableStages, "\n")
+    print("\nNumber of runnable stages:               ", stages["runnable"], "\n")
 
     # number of failed stages:
-    numberFailedStages = proxyServer.getNumberFailedStages()
-    print("\nNumber of failed stages:                 ", numberFailedStages)
+    print("\nNumber of failed stages:                 ", stages["failed_or_blocked"])
     # number of lost/died executors:
-    numberFailedExecutors = proxyServer.getNumberFailedExecutors()
-    print("Number of failed/lost/dead executors:    ", numberFailedExecutors, "\n")
-
+    print("Number of failed/lost/dead executors:    ", executors["failed"], "\n")
 
     # memory requirements for runnable stages:
-    memArray = proxyServer.getMemoryRequirementsRunnable()
-    print("\nMemory requirement of runnable stages: %s" % memArray)
+    print("\nMemory requirement of runnable stages (memory: number of stages): %s" %
+          ", ".join("%.2fG: %d" % (mem, count) for mem, count in status["runnable_memory"]))
     # memory available in registered executors:
-    memAvailable = proxyServer.getMemoryAvailableInClients()
     print("Memory available in registered clients: %s \n" %
-          [round(x, 4) for x in memAvailable])
+          [round(c["mem"], 4) for c in executors["clients"]])
+    print("Free memory in registered clients:       %s \n" %
+          [round(c["mem_free"], 4) for c in executors["clients"]])
+
+    throughput = status["throughput"]
+    print("Stages finished in the last %d minutes:   %d (%.2f per minute)" %
+          (throughput["minutes"], throughput["finished"], throughput["per_minute"]))
@@ -0,0 +1,122 @@
+"""
+A compact representation of the stage graph used by the server.
+
+Nodes are the integers 0..n-1 (i.e., stage indices) and the edges are stored once as predecessor
+and once as successor lists in compressed sparse row form, using flat integer arrays rather than
+the per-node dictionaries of networkx, which dominate the server's memory usage and startup time
+for large pipelines.  Since the graph is immutable once built, this is all we need.
+"""
+
+from array import array
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+
+class StageGraph(object):
+    """
+    >>> G = StageGraph.from_predecessors(4, [[], [0], [0], [1, 2]])
+    >>> list(G.successors(0)), list(G.predecessors(3)), G.in_degree(3), G.order()
+    ([1, 2], [1, 2], 2, 4)
+    >>> G.topological_sort()
+    [0, 1, 2, 3]
+    >>> sorted(G.descendants(1))
+    [3]
+    """
+    def __init__(self, pred_offsets: array, preds: array, succ_offsets: array, succs: array) -> None:
+        # the predecessors of node i are preds[pred_offsets[i]:pred_offsets[i+1]], and similarly for successors
+        self._pred_offsets = pred_offsets
+        self._preds = preds
+        self._succ_offsets = succ_offsets
+        self._succs = succs
+
+    @classmethod
+    def from_predecessors(cls, n: int, predecessors: Iterable[Iterable[int]]) -> 'StageGraph':
+        """Build a graph on n nodes from the (duplicate-free) predecessors of each node in turn."""
+        pred_offsets = array('q', [0])
+        preds = array('i')
+        for ps in predecessors:
+            preds.extend(ps)
+            pred_offsets.append(len(preds))
+        if len(pred_offsets) != n + 1:
+            raise ValueError("expected predecessors for %d nodes but got %d" % (n, len(pred_offsets) - 1))
+
+        # a counting sort of the edges by source node gives the successor lists:
+        out_degrees = array('q', bytes(8 * (n + 1)))
+        for p in preds:
+            out_degrees[p + 1] += 1
+        succ_offsets = array('q', bytes(8 * (n + 1)))
+        for i in range(n):
+            succ_offsets[i + 1] = succ_offsets[i] + out_degrees[i + 1]
+        fill = array('q', succ_offsets)
+        succs = array('i', bytes(4 * len(preds)))
+        for v in range(n):
+            for k in range(pred_offsets[v], pred_offsets[v + 1]):
+                u = preds[k]
+                succs[fill[u]] = v
+                fill[u] += 1
+        return cls(pred_offsets, preds, succ_offsets, succs)
+
+    def order(self) -> int:
+        return len(self._pred_offsets) - 1
+
+    number_of_nodes = order
+    __len__ = order
+
+    def number_of_edges(self) -> int:
+        return len(self._preds)
+
+    def nodes(self) -> range:
+        return range(self.order())
+
+    def __iter__(self):
+        return iter(self.nodes())
+
+    def predecessors(self, i: int) -> array:
+        return self._preds[self._pred_offsets[i]:self._pred_offsets[i + 1]]
+
+    def successors(self, i: int) -> array:
+        return self._succs[self._succ_offsets[i]:self._succ_offsets[i + 1]]
+
+    def in_degree(self, i: int) -> int:
+        return self._pred_offsets[i + 1] - self._pred_offsets[i]
+
+    def out_degree(self, i: int) -> int:
+        return self._succ_offsets[i + 1] - self._succ_offsets[i]
+
+    def in_degrees(self) -> array:
+        """The in-degree of every node, e.g., as initial counts of unfinished predecessors."""
+        offsets = self._pred_offsets
+        return array('i', (offsets[i + 1] - offsets[i] for i in range(self.order())))
+
+    def topological_sort(self) -> List[int]:
+        remaining = self.in_degrees()
+        order = [i for i in range(self.order()) if remaining[i] == 0]
+        # `order` doubles as the queue of Kahn's algorithm:
+        for i in order:
+            for j in self.successors(i):
+                remaining[j] -= 1
+                if remaining[j] == 0:
+                    order.append(j)
+        if len(order) != self.order():
+            raise ValueError("stage graph contains a cycle")
+        return order
+
+    def descendants(self, i: int) -> set:
+        seen = set()  # type: set
+        stack = list(self.successors(i))
+        while stack:
+            j = stack.pop()
+            if j not in seen:
+                seen.add(j)
+                stack.extend(self.successors(j))
+        return seen
+
+    def to_networkx(self, node_attrs: Optional[Callable[[int], Dict[str, Any]]] = None):
+        """Build an equivalent networkx DiGraph, e.g., for writing a dot file."""
+        import networkx as nx  # type: ignore
+        G = nx.DiGraph()
+        for i in self.nodes():
+            G.add_node(i, **(node_attrs(i) if node_attrs else {}))
+        for j in self.nodes():
+            for i in self.predecessors(j):
+                G.add_edge(i, j)
+        return G
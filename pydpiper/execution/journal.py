@@ -0,0 +1,157 @@
+"""
+The server's record of finished stages (the `<pipeline>_finished_stages` file), used to skip
+previously completed stages when a pipeline is restarted.
+
+The file consists of a short header followed by fixed-size binary records, each holding the
+(md5) digest of a stage's command, the time the stage finished, and how long it ran.  Since
+records have a fixed size, a record partially written when the server died is simply ignored
+on loading, and the whole file can be loaded with a single read.  Records are buffered and
+written out in groups, since flushing after every stage stalls the (single-threaded) server
+on slow shared filesystems; losing the last few records to a crash only means that those
+stages will be re-run.  Files written by older versions (lines of the form "index,hash")
+are still read, and are converted whenever the file is rewritten.
+"""
+
+import os
+import struct
+import tempfile
+import time
+
+from typing import BinaryIO, Iterable, Iterator, Optional, Set, Tuple
+
+MAGIC = b"PYDPJNL1"
+# stage digest, completion time (seconds since the epoch), running time (seconds):
+RECORD = struct.Struct("<16sdf")
+
+Record = Tuple[bytes, float, float]
+
+
+def stage_digest(h: str) -> bytes:
+    """The binary form of a stage hash (see CmdStage.getHash).
+
+    >>> stage_digest("d41d8cd98f00b204e9800998ecf8427e").hex()
+    'd41d8cd98f00b204e9800998ecf8427e'
+    """
+    return bytes.fromhex(h)
+
+
+def _parse(data: bytes) -> Iterator[Record]:
+    if data.startswith(MAGIC):
+        # ignore any partial record at the end
+        end = len(MAGIC) + (len(data) - len(MAGIC)) // RECORD.size * RECORD.size
+        yield from RECORD.iter_unpack(memoryview(data)[len(MAGIC):end])
+    else:
+        for line in data.split():
+            try:
+                yield (stage_digest(line.split(b',')[1].decode()), 0.0, 0.0)
+            except (IndexError, ValueError, UnicodeDecodeError):
+                continue
+
+
+def read_records(path: str) -> Iterator[Record]:
+    with open(path, 'rb') as fh:
+        data = fh.read()
+    return _parse(data)
+
+
+def load_finished_digests(path: str) -> Set[bytes]:
+    """The digests of all stages recorded in the journal at `path`.
+
+    >>> import tempfile, os
+    >>> d = tempfile.mkdtemp()
+    >>> path = os.path.join(d, "p_finished_stages")
+    >>> with open(path, 'w') as fh: _ = fh.write("0,d41d8cd98f00b204e9800998ecf8427e\\n")
+    >>> [x.hex() for x in load_finished_digests(path)]
+    ['d41d8cd98f00b204e9800998ecf8427e']
+    >>> rewrite(path, read_records(path))
+    >>> j = FinishedStagesJournal(path, flush_records=10, flush_interval=60)
+    >>> j.open()
+    >>> j.record(stage_digest("0" * 32), runtime=1.5)
+    >>> len(load_finished_digests(path))  # not flushed yet
+    1
+    >>> j.close()
+    >>> sorted(x.hex() for x in load_finished_digests(path))
+    ['00000000000000000000000000000000', 'd41d8cd98f00b204e9800998ecf8427e']
+    """
+    with open(path, 'rb') as fh:
+        data = fh.read()
+    if data.startswith(MAGIC):
+        size = RECORD.size
+        return {data[k:k + 16] for k in range(len(MAGIC), len(data) - size + 1, size)}
+    return {r[0] for r in _parse(data)}
+
+
+def rewrite(path: str, records: Iterable[Record]) -> None:
+    """Atomically replace the journal at `path` by one containing `records`
+    (so that an interruption can't lose the records of previously finished stages)."""
+    # materialize first since `records` may be read lazily from `path` itself:
+    data = b"".join(RECORD.pack(*r) for r in records)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)),
+                               prefix=os.path.basename(path) + ".")
+    try:
+        with os.fdopen(fd, 'wb') as fh:
+            fh.write(MAGIC)
+            fh.write(data)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(tmp, path)
+    except:
+        os.unlink(tmp)
+        raise
+
+
+def _is_clean(path: str) -> bool:
+    """Whether records can be appended to the file at `path` as is."""
+    size = os.path.getsize(path)
+    with open(path, 'rb') as fh:
+        return fh.read(len(MAGIC)) == MAGIC and (size - len(MAGIC)) % RECORD.size == 0
+
+
+class FinishedStagesJournal(object):
+    """An append-only journal of finished stages with group commit: records are written out
+    once `flush_records` have accumulated or the oldest unwritten record is `flush_interval`
+    seconds old (checked whenever a record is added and by `flush_if_due`)."""
+    def __init__(self, path: str, flush_records: int = 1, flush_interval: float = 0) -> None:
+        self.path = path
+        self.flush_records = flush_records
+        self.flush_interval = flush_interval
+        self._fh = None  # type: Optional[BinaryIO]
+        self._pending = []  # type: list
+        self._oldest_pending = None  # type: Optional[float]
+
+    def open(self) -> None:
+        exists = os.path.exists(self.path) and os.path.getsize(self.path) > 0
+        if exists and not _is_clean(self.path):
+            # an old-style journal, or one with a partially written final record:
+            rewrite(self.path, read_records(self.path))
+        self._fh = open(self.path, 'ab')
+        if not exists:
+            self._fh.write(MAGIC)
+            self._fh.flush()
+
+    def record(self, digest: bytes, runtime: float = 0.0, timestamp: Optional[float] = None) -> None:
+        now = time.time()
+        self._pending.append(RECORD.pack(digest, now if timestamp is None else timestamp, runtime))
+        if self._oldest_pending is None:
+            self._oldest_pending = now
+        self.flush_if_due(now)
+
+    def flush_if_due(self, now: Optional[float] = None) -> None:
+        if self._oldest_pending is None:
+            return
+        if (len(self._pending) >= self.flush_records
+              or (now or time.time()) - self._oldest_pending >= self.flush_interval):
+            self.flush()
+
+    def flush(self) -> None:
+        if self._pending and self._fh is not None:
+            self._fh.write(b"".join(self._pending))
+            self._fh.flush()
+            self._pending = []
+            self._oldest_pending = None
+
+    def close(self) -> None:
+        if self._fh is not None:
+            self.flush()
+            self._fh.close()
+            self._fh = None
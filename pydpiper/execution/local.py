@@ -0,0 +1,140 @@
+"""
+Run a pipeline's stages directly from the current process (--local --in-process) instead of
+serving them to executors over Pyro: a single asyncio event loop claims runnable stages which
+fit into the --mem/--proc limits, runs each of them via `runStage` (just as an executor would)
+in a worker thread, and reports the results back to the pipeline.  Since the stages are claimed
+and reported through the same `Pipeline` methods the executors use, the finished stages journal
+and restarts (--restart, --smart-restart) work exactly as with the server.
+"""
+
+import asyncio
+import concurrent.futures
+import logging
+import os
+import resource
+import signal
+import sys
+import threading
+
+from typing import Any, Dict
+
+from pydpiper.execution.pipeline import LOOP_INTERVAL
+from pydpiper.execution.pipeline_executor import runStage
+
+logger = logging  # type: Any
+
+# the name under which stages are claimed from the pipeline
+CLIENT = "local"
+
+
+class LocalRunner(object):
+    """Run the stages of `pipeline`, using at most `mem` G of memory and `procs` processors at once."""
+    def __init__(self, pipeline, mem: float, procs: int) -> None:
+        self.pipeline = pipeline
+        self.mem = mem
+        self.procs = procs
+        self.running = {}  # type: Dict[asyncio.Future, Any]  # StageInfos by the future running them
+        # the process IDs of the running stages' commands, each leading a process group (see runStage)
+        self.pids = {}  # type: Dict[int, int]
+        self.running_mem = 0.0
+        self.running_procs = 0
+
+    def launch(self, pool, stage) -> None:
+        options = self.pipeline.exec_options
+        future = asyncio.get_event_loop().run_in_executor(
+            pool, lambda: runStage(clientURI=CLIENT, stage=stage, cmd_wrapper=options.cmd_wrapper,
+                                   fs_delay=options.fs_delay, check_outputs=options.check_outputs,
+                                   mkdirs=options.defer_directory_creation,
+                                   on_start=lambda pid: self.pids.__setitem__(stage.ix, pid)))
+        self.running[future] = stage
+        self.running_mem += stage.mem
+        self.running_procs += stage.procs
+
+    def collect(self, futures):
+        """The results of the given finished stages, in the form expected by `Pipeline.report`."""
+        results = []
+        for future in futures:
+            stage = self.running.pop(future)
+            self.pids.pop(stage.ix, None)
+            self.running_mem -= stage.mem
+            self.running_procs -= stage.procs
+            ix, res, runtime, maxrss, cputime = future.result()
+            # (runStage returns an exception in place of the return code if the stage couldn't be run)
+            results.append((ix, res if isinstance(res, int) else None, runtime, maxrss, cputime))
+        return results
+
+    def kill(self) -> None:
+        """Stop the running stages' commands (as an executor's generalShutdownCall does)."""
+        for pid in list(self.pids.values()):
+            try:
+                os.killpg(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass  # already finished
+
+    async def run(self) -> None:
+        p = self.pipeline
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.procs) as pool:
+            while True:
+                # (after a shutdown request, only wait for the running stages)
+                flag, stages = p.claim(CLIENT, clientMemFree=self.mem - self.running_mem,
+                                       clientProcsFree=self.procs - self.running_procs,
+                                       max_n=self.procs - self.running_procs)
+                for stage in stages:
+                    self.launch(pool, stage)
+                if not self.running:
+                    if p.cache_requests or p.cache_lookups:
+                        # (nothing else to do until the stages being looked for in the stage cache are found
+                        # or made runnable)
+                        p.collect_cache_lookups(wait=True)
+                        continue
+                    if flag == "wait" and len(p.runnable) > 0:
+                        msg = ("\nA stage (%s) requires %.2fG of memory to run, but max allowed is %.2fG"
+                               % (str(p.highest_memory_stage())[:1000], p.max_memory_required(), self.mem))
+                        logger.error(msg)
+                        print(msg)
+                    return
+                done, _ = await asyncio.wait(list(self.running), timeout=LOOP_INTERVAL,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                if done:
+                    p.report(CLIENT, self.collect(done))
+                else:
+                    # write out the records of recently finished stages even if nothing else finishes for a while
+                    p.flush_if_due()
+
+
+def run_in_process(pipeline) -> None:
+    """Run the pipeline's runnable stages to completion (or until no more can run);
+    an alternative to `launchServer` for pipelineDaemon."""
+    options = pipeline.options
+    pipeline.printStages(options.application.pipeline_name)
+    pipeline.printNumberProcessedStages()
+    pipeline.setVerbosity(options.application.verbose)
+    # as for a server running local executors, leave room for the server itself:
+    pipeline.memAvail = options.execution.mem - (float(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss) / 10**6)
+    pipeline.shutdown_ev = threading.Event()
+    pipeline.registerClient(CLIENT, pipeline.memAvail)
+
+    runner = LocalRunner(pipeline, mem=pipeline.memAvail, procs=options.execution.proc)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    # on SIGTERM, write out the journal and stop starting new stages
+    loop.add_signal_handler(signal.SIGTERM, pipeline.set_shutdown_ev)
+    if pipeline.profile is not None:
+        loop.add_signal_handler(signal.SIGUSR1, pipeline.toggle_profile_snapshot)
+    try:
+        loop.run_until_complete(runner.run())
+    except KeyboardInterrupt:
+        logger.exception("Caught keyboard interrupt, shutting down.")
+        print("\nKeyboardInterrupt caught: shutting down.\n")
+        sys.stdout.flush()
+        runner.kill()
+        # (the stages killed aren't reported, so they'll be run again on restart)
+        pipeline.flush_journal()
+    else:
+        pipeline.unregisterClient(CLIENT)
+        pipeline.printShutdownMessage()
+        pipeline.write_trace()
+        pipeline.write_profile()
+        pipeline.flush_stage_cache()
+    finally:
+        loop.close()
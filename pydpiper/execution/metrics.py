@@ -0,0 +1,136 @@
+"""
+An optional HTTP endpoint (--metrics-port) serving the pipeline server's status, for dashboards:
+`/metrics` in the Prometheus text exposition format and `/status` as JSON (see
+`Pipeline.getStatusSnapshot`).  It listens on localhost only, and runs in a thread of its own
+which fetches the status from the server like any other client, so that it doesn't touch the
+server's state outside of the server's own request handling.
+"""
+
+import json
+import logging
+import threading
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from typing import Any, Callable, Dict, List
+
+logger = logging  # type: Any
+
+Snapshot = Dict[str, Any]
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def prometheus_text(snapshot: Snapshot) -> str:
+    """The status `snapshot` in the Prometheus text format.
+
+    >>> print(prometheus_text(dict(stages=dict(total=3, finished=1), runnable_memory=[[2.0, 1]],
+    ...                            executors=dict(registered=1, queued=0, failed=0,
+    ...                                           clients=[dict(uri="local", mem=4.0, mem_free=2.0, running_stages=[1])]),
+    ...                            throughput=dict(minutes=10, per_minute=0.1))), end="")
+    # HELP pydpiper_stages Number of stages in each state.
+    # TYPE pydpiper_stages gauge
+    pydpiper_stages{state="total"} 3
+    pydpiper_stages{state="finished"} 1
+    # HELP pydpiper_runnable_stages_by_memory Number of runnable stages requiring each amount of memory (G).
+    # TYPE pydpiper_runnable_stages_by_memory gauge
+    pydpiper_runnable_stages_by_memory{mem="2.0"} 1
+    # HELP pydpiper_executors Number of executors registered, queued (launched but not yet registered) and failed.
+    # TYPE pydpiper_executors gauge
+    pydpiper_executors{state="registered"} 1
+    pydpiper_executors{state="queued"} 0
+    pydpiper_executors{state="failed"} 0
+    # HELP pydpiper_executor_memory_gigabytes Memory of each registered executor.
+    # TYPE pydpiper_executor_memory_gigabytes gauge
+    pydpiper_executor_memory_gigabytes{executor="local"} 4.0
+    # HELP pydpiper_executor_memory_free_gigabytes Memory not used by the stages running on each executor.
+    # TYPE pydpiper_executor_memory_free_gigabytes gauge
+    pydpiper_executor_memory_free_gigabytes{executor="local"} 2.0
+    # HELP pydpiper_executor_running_stages Number of stages running on each executor.
+    # TYPE pydpiper_executor_running_stages gauge
+    pydpiper_executor_running_stages{executor="local"} 1
+    # HELP pydpiper_finished_stages_per_minute Stages finished per minute over the last 10 minutes.
+    # TYPE pydpiper_finished_stages_per_minute gauge
+    pydpiper_finished_stages_per_minute 0.1
+    """
+    lines = []  # type: List[str]
+
+    def metric(name: str, help: str, samples, kind: str = "gauge") -> None:
+        lines.append("# HELP %s %s" % (name, help))
+        lines.append("# TYPE %s %s" % (name, kind))
+        for labels, value in samples:
+            label_str = ",".join('%s="%s"' % (k, _escape(v)) for k, v in labels)
+            lines.append("%s%s %s" % (name, "{%s}" % label_str if label_str else "", value))
+
+    executors = snapshot["executors"]
+    clients = executors["clients"]
+    metric("pydpiper_stages", "Number of stages in each state.",
+           [((("state", state),), n) for state, n in snapshot["stages"].items()])
+    metric("pydpiper_runnable_stages_by_memory", "Number of runnable stages requiring each amount of memory (G).",
+           [((("mem", mem),), n) for mem, n in snapshot["runnable_memory"]])
+    metric("pydpiper_executors", "Number of executors registered, queued (launched but not yet registered) and failed.",
+           [((("state", state),), executors[state]) for state in ("registered", "queued", "failed")])
+    metric("pydpiper_executor_memory_gigabytes", "Memory of each registered executor.",
+           [((("executor", c["uri"]),), c["mem"]) for c in clients])
+    metric("pydpiper_executor_memory_free_gigabytes", "Memory not used by the stages running on each executor.",
+           [((("executor", c["uri"]),), c["mem_free"]) for c in clients])
+    metric("pydpiper_executor_running_stages", "Number of stages running on each executor.",
+           [((("executor", c["uri"]),), len(c["running_stages"])) for c in clients])
+    throughput = snapshot["throughput"]
+    metric("pydpiper_finished_stages_per_minute",
+           "Stages finished per minute over the last %d minutes." % throughput["minutes"],
+           [((), throughput["per_minute"])])
+    if snapshot.get("stage_cache_hits") is not None:
+        # (with --stage-cache-dir)
+        metric("pydpiper_stage_cache_hits_total", "Number of stages whose outputs were restored from the stage cache.",
+               [((), snapshot["stage_cache_hits"])], kind="counter")
+    profile = snapshot.get("profile")
+    if profile:
+        # (with --profile-server)
+        metric("pydpiper_server_calls_total", "Number of calls of each of the server's methods.",
+               [((("method", m),), p["calls"]) for m, p in profile.items()], kind="counter")
+        metric("pydpiper_server_call_seconds_total", "Total time spent in each of the server's methods.",
+               [((("method", m),), p["total"]) for m, p in profile.items()], kind="counter")
+        metric("pydpiper_server_call_p99_seconds", "99th percentile (upper bound) of each method's call duration.",
+               [((("method", m),), p["p99"]) for m, p in profile.items()])
+    return "\n".join(lines) + "\n"
+
+
+def _handler(snapshot: Callable[[], Snapshot]):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            path = self.path.split('?', 1)[0]
+            if path not in ("/metrics", "/status"):
+                self.send_error(404)
+                return
+            try:
+                status = snapshot()
+            except Exception:
+                logger.exception("Couldn't get the pipeline's status for %s", path)
+                self.send_error(503)
+                return
+            if path == "/metrics":
+                body, content_type = prometheus_text(status), "text/plain; version=0.0.4"
+            else:
+                body, content_type = json.dumps(status), "application/json"
+            data = body.encode()
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            logger.debug("metrics endpoint: " + format, *args)
+
+    return Handler
+
+
+def start_metrics_server(port: int, snapshot: Callable[[], Snapshot], host: str = "127.0.0.1") -> HTTPServer:
+    """Serve the status given by `snapshot` from a daemon thread; call `shutdown()` on the result to stop.
+    (Requests are served one at a time, so `snapshot` is only ever called from that thread.)"""
+    httpd = HTTPServer((host, port), _handler(snapshot))
+    threading.Thread(target=httpd.serve_forever, name="metrics", daemon=True).start()
+    logger.info("Serving the pipeline's status at http://%s:%d/metrics", host, httpd.server_address[1])
+    return httpd
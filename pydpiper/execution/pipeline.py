@@ -1,9 +1,10 @@
 #!/usr/bin/env python3
 
+import asyncio
+import concurrent.futures
 import hashlib
 import threading
 
-import networkx as nx  # type: ignore
 import os
 import sys
 import signal
@@ -11,16 +12,17 @@ import socket
 import time
 import re
 import resource
-from collections import defaultdict
+from array import array
+from collections import defaultdict, deque
 from datetime import datetime
 import subprocess
-from shlex import split
+from shlex import quote, split
 from multiprocessing import Process, Event  # type: ignore
 from configargparse import Namespace
 import logging
 import functools
 import math
-from typing import Any
+from typing import Any, Dict, Iterable, List, Optional, Tuple
 
 try:
     from sys import intern
@@ -41,12 +43,37 @@ logger.basicConfig(filename="pipeline.log", level=os.getenv("PYDPIPER_LOGLEVEL",
                 
 import Pyro4  # type: ignore
 from . import pipeline_executor as pe
-from pydpiper.execution.queueing import create_uri_filename_from_options
+from pydpiper.execution import rpc
+from pydpiper.execution.cache import StageCache
+from pydpiper.execution.metrics import start_metrics_server
+from pydpiper.execution.profiling import ServerProfile, profile_paths
+from pydpiper.execution.queueing import create_uri_filename_from_options, timestr_to_secs
+from pydpiper.execution.graph import StageGraph
+from pydpiper.execution.journal import FinishedStagesJournal, load_finished_digests, read_records, rewrite, \
+    stage_digest
+from pydpiper.execution.scheduling import DEFAULT_COST_SECONDS, RunnableQueue, critical_path_priorities, \
+    executor_size_classes, stage_cost
+from pydpiper.execution.trace import CLAIMED, FAILED, FINISHED, LOST, RUNNABLE, STARTED, StageTrace, trace_paths
+from pydpiper.execution.usage import OOM_FRACTION, input_bytes, load_model, usage_key
 
 Pyro4.config.SERVERTYPE = pe.Pyro4.config.SERVERTYPE
 
 LOOP_INTERVAL = 5
 STAGE_RETRY_INTERVAL = 1
+# the longest window (in minutes) over which the status snapshot can report throughput
+MAX_THROUGHPUT_WINDOW = 60
+# time (s) after which the executors of a launch which still haven't registered are assumed never
+# to start (e.g., since their jobs were rejected by the queueing system), so others can be launched instead
+EXECUTOR_LAUNCH_TIMEOUT = 12 * 3600
+# factor by which to inflate the expected running time of a stage when deciding whether it can finish
+# within an executor's remaining walltime (the estimates are averages, and the executor needs time to report)
+RUNTIME_MARGIN = 1.5
+# limits on the length and total (static) cost of chains of stages fused into single jobs
+MAX_FUSED_STAGES = 8
+MAX_FUSED_COST = 20.0
+
+# stage statuses, kept by the pipeline in a bytearray indexed by stage
+STAGE_NOT_RUN, STAGE_RUNNING, STAGE_FINISHED, STAGE_FAILED = range(4)
 
 sys.excepthook = Pyro4.util.excepthook # type: ignore
 
@@ -85,6 +112,17 @@ class ExecClient(object):
         self.maxmemory = maxmemory
         self.running_stages = set([])
         self.timestamp = time.time()
+        # the request id and reply of the client's most recent claim (see `Pipeline.claim`)
+        self.last_claim = None
+
+class ExecutorLaunch(object):
+    """A number of executors launched (submitted) together, e.g., as one job array,
+    which register with the server one by one as they start running"""
+    def __init__(self, number, mem):
+        self.number = number
+        self.mem = mem
+        self.registered = 0
+        self.timestamp = time.time()
 
 def memoize_hook(hook):  # TODO replace with functools.lru_cache (?!) in python3
     data = Namespace(called=False, result=None)  # because of Python's bizarre assignment rules
@@ -98,38 +136,32 @@ def memoize_hook(hook):  # TODO replace with functools.lru_cache (?!) in python3
     return g
 
 class PipelineStage(object):
+    # there can be hundreds of thousands of stages, so avoid a per-instance __dict__.
+    # Dynamic information (status, number of retries) is kept by the `Pipeline` instead.
+    __slots__ = ("mem", "procs", "inputFiles", "outputFiles", "logFile", "name",
+                 "_runnable_hooks", "finished_hooks", "env_vars")
+    colour = "black" # used when a graph is created of all stages to colour the nodes
+
     def __init__(self):
         self.mem = None # if not set, use pipeline default
         self.procs = 1 # default number of processors per stage
         # the input files for this stage
-        self.inputFiles  = [] # type: List[str]
+        self.inputFiles  = () # type: Tuple[str, ...]
         # the output files for this stage
-        self.outputFiles = [] # type: List[str]
+        self.outputFiles = () # type: Tuple[str, ...]
         self.logFile = None
-        self.status = None
         self.name = ""
-        self.colour = "black" # used when a graph is created of all stages to colour the nodes
-        self.number_retries = 0
         # functions to be called when the stage becomes runnable
         # (these might be called multiple times, so should be benign
         # in some sense)
         self._runnable_hooks = []
         # functions to be called when a stage finishes
         self.finished_hooks = []
+        self.env_vars = {}
 
     def add_runnable_hook(self, h, memoize=True):
         self._runnable_hooks.append((memoize_hook if memoize else lambda x: x)(h))
 
-    def isFinished(self):
-        return self.status == "finished"
-    def setRunning(self):
-        self.status = "running"
-    def setFinished(self):
-        self.status = "finished"
-    def setFailed(self):
-        self.status = "failed"
-    def setNone(self):
-        self.status = None
     def setMem(self, mem):
         self.mem = mem
     def getMem(self):
@@ -144,29 +176,28 @@ class PipelineStage(object):
         return self.inputFiles == other.inputFiles and self.outputFiles == other.outputFiles
     def __ne__(self, other):
         return not(self.__eq__(other))
-    def getNumberOfRetries(self):
-        return self.number_retries
-    def incrementNumberOfRetries(self):
-        self.number_retries += 1
 
 class CmdStage(PipelineStage):
+    __slots__ = ("cmd",)
     pipeline_start_time = datetime.isoformat(datetime.now())
     logfile_id = 0
     def __init__(self, argArray):
         PipelineStage.__init__(self)
-        self.cmd = [] # the input array converted to strings
+        self.cmd = () # the input array converted to (interned) strings
         self.parseArgs(argArray)
         #self.checkLogFile()
     def parseArgs(self, argArray):
         if argArray:
+            cmd, inputFiles, outputFiles = [], [], []
             for a in argArray:
                 ft = getattr(a, "fileType", None)
                 s = intern(str(a))
                 if ft == "input":
-                    self.inputFiles.append(s)
+                    inputFiles.append(s)
                 elif ft == "output":
-                    self.outputFiles.append(s)
-                self.cmd.append(s)
+                    outputFiles.append(s)
+                cmd.append(s)
+            self.cmd, self.inputFiles, self.outputFiles = tuple(cmd), tuple(inputFiles), tuple(outputFiles)
             self.name = self.cmd[0]
     def checkLogFile(self):  # TODO silly, this is always called since called by __init__
         if not self.logFile:
@@ -198,13 +229,25 @@ class CmdStage(PipelineStage):
     def __hash__(self):
         return tuple(self.cmd).__hash__()
 
-"""A graph with no edge information; see networkx/classes/digraph.py"""
-class ThinGraph(nx.DiGraph):
-    all_edge_dict = {'weight': 1}
-    def single_edge_dict(self):
-        return self.all_edge_dict
-    edge_attr_dict_factory = single_edge_dict
+def fused_command(stages):
+    """A shell command running the commands of `stages` one after another, stopping at the first
+    failure.  The output of the first goes wherever the executor sends it (the first stage's log file),
+    and that of each of the others to its own log file.
 
+    >>> a, b = CmdStage(["mincblur", "in.mnc", "blur"]), CmdStage(["mincpik", "blur_blur.mnc", "qc.png"])
+    >>> b.logFile = "log/qc.log"
+    >>> print(" ".join(fused_command([a, b])))
+    sh -c 'mincblur in.mnc blur && mkdir -p log && { echo '"'"'mincpik blur_blur.mnc qc.png'"'"'; mincpik blur_blur.mnc qc.png; } >> log/qc.log 2>&1'
+    """
+    cmds = [" ".join(stages[0].cmd)]
+    for s in stages[1:]:
+        cmd = " ".join(s.cmd)
+        if s.logFile:
+            cmds.append("mkdir -p %s && { echo %s; %s; } >> %s 2>&1"
+                        % (quote(os.path.dirname(s.logFile) or "."), quote(cmd), cmd, quote(s.logFile)))
+        else:
+            cmds.append(cmd)
+    return ["sh", "-c", quote(" && ".join(cmds))]
 
 class Pipeline(object):
     # TODO the way we initialize a pipeline is currently a bit gross, e.g.,
@@ -212,25 +255,39 @@ class Pipeline(object):
     # called `initialize` should be a hint that all is perhaps not well, but perhaps
     # there is indeed some information legitimately unavailable when we first construct
     def __init__(self, stages, options):
-        # the core pipeline is stored in a directed graph. The graph is made
-        # up of integer indices
+        # the core pipeline is stored in a directed graph (a `StageGraph`, created
+        # in createEdges). The graph is made up of integer indices
         # main set of options, needed since (a) we don't bother unpacking
         # every single option into `self`, (b) since (most of) the option set
         # is needed to launch new executors at run time
         self.pipeline_name = options.application.pipeline_name
         self.options = options
         self.exec_options = options.execution
-        self.G = ThinGraph()
+        self.G = None
         # a map from indices to the number of unfulfilled prerequisites
         # of the corresponding graph node (will be populated later -- __init__ is a misnomer)
-        self.unfinished_pred_counts = []
+        self.unfinished_pred_counts = array('i')
         # an array of the actual stages (PipelineStage objects)
         self.stages = []
-        self.nameArray = []
-        # indices of the stages ready to be run
-        self.runnable = set()
-        # an array to keep track of stage memory requirements
-        self.mem_req_for_runnable = []
+        # the dynamic state of each stage (populated once all stages are added):
+        self.stage_status  = bytearray()
+        self.stage_retries = bytearray()
+        # whether prepare_to_run has been called for each stage
+        self.stage_prepared = bytearray()
+        # the peak memory use (G) and CPU time (s) of each stage's most recent run, as reported by the executor
+        self.stage_maxrss = array('f')
+        self.stage_cputime = array('f')
+        # the model of the stages' resource usage learned from previous runs (see pydpiper.execution.usage),
+        # if enabled, and the size of each stage (given by `stage_size`; NaN until needed -- see `_stage_size`)
+        self.usage_model = None
+        self.stage_size = input_bytes
+        self.stage_sizes = array('d')
+        # seconds per unit of the static stage costs (see `estimated_stage_cost`)
+        self.cost_scale = DEFAULT_COST_SECONDS
+        # indices of the stages ready to be run, ordered by remaining downstream work
+        # (needs the graph, so is created below once the edges are known)
+        # (it also keeps track of the memory requirements of the runnable stages)
+        self.runnable = None
         # a hideous hack; the idea is that after constructing the underlying graph,
         # a pipeline running executors locally will measure its own maxRSS (once)
         # and subtract this from the amount of memory claimed available for use on the node.
@@ -239,9 +296,13 @@ class Pipeline(object):
         # the current stage counter
         self.counter = 0
         # hash to keep the output to stage association
+        # (only needed while constructing the graph, so emptied afterwards)
         self.outputhash = {}
         # a hash per stage - computed from inputs and outputs or whole command
+        # (only needed to remove duplicate stages, so emptied after construction)
         self.stage_dict = {}
+        # the digests of the stages' hashes, 16 bytes per stage (see `getStageDigest`)
+        self.stage_digests = bytearray()
         self.num_finished_stages = 0
         self.failedStages = []
         # location of backup files for restart if needed
@@ -253,6 +314,8 @@ class Pipeline(object):
         # are actually registered, a whole bunch of them could be waiting in the
         # queue
         self.number_launched_and_waiting_clients = 0
+        # the launches (ExecutorLaunch instances) some of whose executors haven't registered yet, oldest first
+        self.launches = []
         # clients we've lost contact with due to crash, etc.
         self.failed_executors = 0
         # time to shut down, due to walltime or having completed all stages?
@@ -265,11 +328,41 @@ class Pipeline(object):
         # report back to the user which percentage of the pipeline stages has finished
         # keep track of the last percentage that was printed
         self.percent_finished_reported = 0
-        # Handle to write out processed stages to
-        self.finished_stages_fh = None
+        # journal to record processed stages in (see pydpiper.execution.journal)
+        self.finished_stages_journal = None
+        # when each currently running stage was started (as seen by the server)
+        self.stage_start_times = {}
+        # when stages finished during the last MAX_THROUGHPUT_WINDOW minutes, oldest first
+        self.finish_times = deque()
+        # the lifecycle events of the stages, if recorded (see pydpiper.execution.trace)
+        self.trace = None  # type: Optional[StageTrace]
+        # timings of the server's methods, if profiling (see pydpiper.execution.profiling)
+        self.profile = None  # type: Optional[ServerProfile]
+        # executors waiting (in waitForWork) for a runnable stage to fit into their free resources,
+        # as a map from an asyncio future to those resources (and remaining walltime); None unless the server
+        # is running an event loop (--server-mode=asyncio), since otherwise we can't wait without blocking
+        self.work_waiters = None  # type: Optional[Dict[Any, Tuple[float, int, Optional[float]]]]
+        # the cache of stage outputs shared with other pipelines, if any (see pydpiper.execution.cache),
+        # the cache keys of stages which weren't found in it (to add their outputs once they've run),
+        # the stages to look for in it once the server is running, and those being looked for
+        # (with the lookups, in the order these finish; see `collect_cache_lookups`)
+        self.stage_cache = None  # type: Optional[StageCache]
+        self.stage_cache_keys = {}  # type: Dict[int, str]
+        self.cache_requests = []  # type: List[int]
+        self.cache_lookups = deque()
         
         self.outputDir = self.options.application.output_directory or os.getcwd()
 
+        if self.exec_options.learn_resources:
+            self.usage_model = load_model(self.outputDir)
+        if self.exec_options.stage_trace:
+            self.trace = StageTrace()
+        if self.exec_options.stage_cache_dir:
+            max_size, max_age = self.exec_options.stage_cache_max_size, self.exec_options.stage_cache_max_age
+            self.stage_cache = StageCache(self.exec_options.stage_cache_dir,
+                                          max_size=max_size * 2 ** 30 if max_size is not None else None,
+                                          max_age=max_age * 24 * 3600 if max_age is not None else None)
+
         # TODO this doesn't work with the qbatch-based server submission on Graham:
         if self.options.execution.submit_server and self.options.execution.local:
             # redirect the standard output to a text file
@@ -281,13 +374,34 @@ class Pipeline(object):
             self._add_stage(s)
 
         self.createEdges()
+        self.outputhash = {}
+        self.stage_dict = {}
+        self.stage_status  = bytearray(len(self.stages))  # all STAGE_NOT_RUN
+        self.stage_retries = bytearray(len(self.stages))
+        self.stage_prepared = bytearray(len(self.stages))
+        self.stage_maxrss = array('f', bytes(4 * len(self.stages)))
+        self.stage_cputime = array('f', bytes(4 * len(self.stages)))
+        self.stage_sizes = array('d', [math.nan]) * len(self.stages)
+        # (stages expected to run for longer than an executor's whole walltime are still handed out
+        # to executors with most of their walltime left, rather than never)
+        self.runnable = RunnableQueue(priorities=self.compute_stage_priorities(),
+                                      resources=self.stage_resources,
+                                      runtimes=self.expected_runtime,
+                                      max_walltime=(timestr_to_secs(self.exec_options.time)
+                                                    if self.exec_options.queue_type is not None
+                                                       and self.exec_options.time else None))
         # could also set this on G itself ...
-        # TODO the name "unfinished" here is probably misleading since nothing is marked "finished";
-        # even though the "graph heads" are enqueued here, this will be changed later when completed stages
-        # are skipped :D
-        self.unfinished_pred_counts = [ len([i for i in self.G.predecessors(n)
-                                             if not self.stages[i].isFinished()])
-                                        for n in range(self.G.order()) ]
+        # (initially just the in-degrees; these are decremented as stages finish, including
+        # when previously completed stages are skipped on restart)
+        self.unfinished_pred_counts = self.G.in_degrees()
+        # the stage each stage is fused with into a single job, or -1 (see `fuse_chains`)
+        self.chain_next = array('i', [-1]) * len(self.stages)
+        if self.exec_options.fuse_stages:
+            self.fuse_chains()
+        # nothing is enqueued yet since we don't know which stages have finished previously;
+        # see `skip_completed_stages` and `enqueue_graph_heads`
+
+    def enqueue_graph_heads(self):
         graph_heads = [n for n in self.G.nodes()
                        if self.unfinished_pred_counts[n] == 0]
         logger.info("Graph heads: " + str(graph_heads))
@@ -296,7 +410,22 @@ class Pipeline(object):
        
     # expose methods to get/set shutdown_ev via Pyro (setter not needed):
     def set_shutdown_ev(self):
+        self.flush_journal()
         self.shutdown_ev.set()
+        self.wake_work_waiters()
+
+    def flush_journal(self):
+        if self.finished_stages_journal is not None:
+            self.finished_stages_journal.flush()
+        if self.usage_model is not None:
+            self.usage_model.flush()
+
+    def flush_if_due(self):
+        """Write out recently finished stages (and resource usage samples) if they've been buffered for long enough."""
+        if self.finished_stages_journal is not None:
+            self.finished_stages_journal.flush_if_due()
+        if self.usage_model is not None:
+            self.usage_model.flush_if_due()
 
     def get_shutdown_ev(self):
         return self.shutdown_ev
@@ -329,11 +458,60 @@ class Pipeline(object):
         return len(self.runnable)
 
     def getMemoryRequirementsRunnable(self):
-        return self.mem_req_for_runnable
+        """(memory, number of runnable stages requiring it) pairs, largest first"""
+        return self.runnable.memory_counts()
 
     def getMemoryAvailableInClients(self):
         return [c.maxmemory for _, c in self.clients.items()]
 
+    def getStatusSnapshot(self, minutes=10):
+        """The pipeline's status (as reported by check_pipeline_status.py) as a single structure
+        of plain dictionaries and lists, so that it can be fetched in one call:
+        the number of stages in each state, the running stages with their commands,
+        the executors with their free memory, and the number of stages finished
+        per minute over the last `minutes` (at most MAX_THROUGHPUT_WINDOW) minutes."""
+        now = time.time()
+        minutes = min(max(minutes, 1), MAX_THROUGHPUT_WINDOW)
+        self._forget_finish_times(now)
+        recently_finished = sum(1 for t in self.finish_times if t >= now - 60 * minutes)
+        not_run = self.stage_status.count(STAGE_NOT_RUN)
+        clients = []
+        for uri, c in self.clients.items():
+            # (a chain of fused stages runs as a single job, needing only the most memory any of them needs)
+            fused = {self.chain_next[i] for i in c.running_stages if self.chain_next[i] in c.running_stages}
+            mem_used = sum(self.stage_resources(i, status=STAGE_RUNNING)[0]
+                           for i in c.running_stages if i not in fused)
+            clients.append(dict(uri=uri, mem=c.maxmemory, mem_free=c.maxmemory - mem_used,
+                                running_stages=sorted(c.running_stages), last_contact=c.timestamp))
+        running = [dict(ix=i, cmd=str(self.stages[i]), mem=self.stages[i].mem,
+                        started=self.stage_start_times.get(i))
+                   for i in sorted(self.currently_running_stages)]
+        return dict(time=now,
+                    pipeline_name=self.pipeline_name,
+                    stages=dict(total=len(self.stages),
+                                finished=self.stage_status.count(STAGE_FINISHED),
+                                running=self.stage_status.count(STAGE_RUNNING),
+                                runnable=len(self.runnable),
+                                waiting=not_run - len(self.runnable),
+                                failed=self.stage_status.count(STAGE_FAILED),
+                                failed_or_blocked=len(self.failedStages)),
+                    stage_cache_hits=self.stage_cache.hits if self.stage_cache is not None else None,
+                    running_stages=running,
+                    runnable_memory=self.runnable.memory_counts(),
+                    executors=dict(registered=len(self.clients),
+                                   queued=self.number_launched_and_waiting_clients,
+                                   failed=self.failed_executors,
+                                   clients=clients,
+                                   launches=[dict(number=l.number, mem=l.mem, registered=l.registered,
+                                                  launched=l.timestamp) for l in self.launches]),
+                    throughput=dict(minutes=minutes, finished=recently_finished,
+                                    per_minute=recently_finished / minutes),
+                    profile=self.profile.summary() if self.profile is not None else None)
+
+    def _forget_finish_times(self, now):
+        while self.finish_times and self.finish_times[0] < now - 60 * MAX_THROUGHPUT_WINDOW:
+            self.finish_times.popleft()
+
     def _add_stage(self, stage):
         """adds a stage to the pipeline"""
         # check if stage already exists in pipeline - if so, don't bother
@@ -343,10 +521,8 @@ class Pipeline(object):
         # FIXME this logic is rather redundant and can be simplified
         # (assuming that the set of stages the pipeline is given has
         # the same equality relation as is used here)
-        # FIXME as getHash is called several times per stage, cache the hash in the stage.
-        # To save memory, we could make use of the fact that strings
-        # are actually interned, so it might be faster/cheaper
-        # just to store/compare the pointers.
+        # FIXME getHash is recomputed here (an md5 of the whole command); only its binary form is kept
+        # (in stage_digests), so anything else needing the hash must recompute it too.
         h = stage.getHash()
         if h in self.stage_dict:
             self.skipped_stages += 1
@@ -355,12 +531,11 @@ class Pipeline(object):
             self.stage_dict[h] = self.counter
             #self.statusArray[self.counter] = 'notstarted'
             self.stages.append(stage)
-            self.nameArray.append(stage.name)
+            # cache the (binary) hash, which is needed again when the stage finishes and on restart
+            self.stage_digests += stage_digest(h) if isinstance(stage, CmdStage) else bytes(16)
             # add all outputs to the output dictionary
             for o in stage.outputFiles:
                 self.outputhash[o] = self.counter
-            # add the stage's index to the graph
-            self.G.add_node(self.counter, label=stage.name, color=stage.colour)
             self.counter += 1
         # huge hack since default isn't available in CmdStage() constructor
         # (may get overridden later by a hook, hence may really be wrong ... ugh):
@@ -381,20 +556,120 @@ class Pipeline(object):
     def createEdges(self):
         """computes stage dependencies by examining their inputs/outputs"""
         starttime = time.time()
-        # iterate over all nodes
-        for i in self.G.nodes():
-            for ip in self.stages[i].inputFiles:
-                # if the input to the current stage was the output of another
-                # stage, add a directional dependence to the DiGraph
-                if ip in self.outputhash:
-                    self.G.add_edge(self.outputhash[ip], i)
+        # if an input to a stage was the output of another stage, add a directional
+        # dependence to the graph (dict.fromkeys removes duplicates but keeps the order)
+        self.G = StageGraph.from_predecessors(len(self.stages),
+                                              (dict.fromkeys(self.outputhash[ip] for ip in s.inputFiles
+                                                             if ip in self.outputhash)
+                                               for s in self.stages))
         endtime = time.time()
         logger.info("Create Edges time: " + str(endtime-starttime))
 
+    def networkx_graph(self):
+        """an equivalent (but much larger) networkx graph, with stage names as labels"""
+        return self.G.to_networkx(lambda i: { "label" : self.stages[i].name, "color" : self.stages[i].colour })
+
+    def estimated_stage_cost(self, i):
+        name = self.stages[i].name
+        if self.usage_model is not None:
+            # measured running times where available, otherwise the static costs scaled to match
+            runtime = self.usage_model.mean_runtime(os.path.basename(name))
+            return runtime if runtime is not None else stage_cost(name) * self.cost_scale
+        return stage_cost(name)
+
+    def estimated_runtime(self, i):
+        """The expected running time (s) of stage `i` according to the resource usage model, or None if unknown."""
+        s = self.stages[i]
+        if self.usage_model is None or not isinstance(s, CmdStage):
+            return None
+        if self.stage_prepared[i] and self.usage_model.has_samples(usage_key(s.cmd)):
+            runtime = self.usage_model.predict_runtime(usage_key(s.cmd), self._stage_size(i))
+            if runtime is not None:
+                return runtime
+        return self.usage_model.mean_runtime(os.path.basename(s.name))
+
+    def expected_runtime(self, i):
+        """The running time (s) to allow for stage `i` when deciding whether it can finish within an
+        executor's remaining walltime: as measured in previous runs where possible, otherwise
+        according to the (scaled) static per-tool costs, plus a margin."""
+        total = 0.0
+        for j in self.fused_chain(i):
+            runtime = self.estimated_runtime(j)
+            if runtime is None:
+                runtime = stage_cost(os.path.basename(self.stages[j].name)) * self.cost_scale
+            total += runtime
+        return RUNTIME_MARGIN * total
+
+    def compute_stage_priorities(self):
+        """rank stages by the (estimated) cost of the longest path from each stage to the end of
+        the pipeline, so that long chains of dependent stages (e.g., registrations) are started
+        before cheap stages which nothing is waiting for"""
+        starttime = time.time()
+        if self.usage_model is not None:
+            self.cost_scale = self.usage_model.cost_scale(stage_cost, default=DEFAULT_COST_SECONDS)
+        priorities = critical_path_priorities(topological_order=self.G.topological_sort(),
+                                              successors=self.G.successors,
+                                              cost=self.estimated_stage_cost,
+                                              n=self.G.order())
+        logger.info("Stage priority computation time: " + str(time.time() - starttime))
+        return priorities
+
+    def fuse_chains(self):
+        """Fuse linear chains of cheap stages (e.g., a mincblur and the minctracc using the blurred image),
+        where each stage's only successor has no other predecessors, into single jobs, which saves a round trip
+        to the server (and the wait for the outputs to appear) per stage.  The stages remain separate
+        stages of the pipeline (so, e.g., are recorded as finished separately), but whichever stage of a chain
+        becomes runnable is handed out together with the rest of the chain (see `fused_chain`).
+        Stages whose requirements are only known once their inputs exist (i.e., with runnable hooks)
+        can't be fused with their predecessors."""
+        n = len(self.stages)
+        chain_lengths = [1] * n
+        chain_costs = [stage_cost(os.path.basename(s.name)) for s in self.stages]
+        fused = 0
+        for i in self.G.topological_sort():
+            s = self.stages[i]
+            if not isinstance(s, CmdStage) or self.G.out_degree(i) != 1:
+                continue
+            j = self.G.successors(i)[0]
+            t = self.stages[j]
+            if (self.G.in_degree(j) != 1 or not isinstance(t, CmdStage) or t._runnable_hooks
+                    or t.env_vars != s.env_vars or chain_lengths[i] >= MAX_FUSED_STAGES
+                    or chain_costs[i] + chain_costs[j] > MAX_FUSED_COST):
+                continue
+            self.chain_next[i] = j
+            chain_lengths[j] = chain_lengths[i] + 1
+            chain_costs[j] += chain_costs[i]
+            fused += 1
+        logger.info("Fused %d stages with their predecessors (%d jobs for %d stages)", fused, n - fused, n)
+
+    def fused_chain(self, i, status=STAGE_NOT_RUN):
+        """Stage `i` followed by the stages fused with it into a single job (see `fuse_chains`),
+        as far as these have the given status (i.e., are still to be run, or are running as part of the job)."""
+        chain = [i]
+        j = self.chain_next[i]
+        while j >= 0 and self.stage_status[j] == status:
+            chain.append(j)
+            j = self.chain_next[j]
+        return chain
+
+    def stage_resources(self, i, status=STAGE_NOT_RUN):
+        """The memory and processors required by stage `i` (together with the stages fused with it,
+        as far as these have the given status; see `fused_chain`)."""
+        if self.chain_next[i] < 0:
+            return (self.stages[i].mem, self.stages[i].procs)
+        chain = self.fused_chain(i, status=status)
+        return (max(self.stages[j].mem for j in chain), max(self.stages[j].procs for j in chain))
+
     def get_stage_info(self, i):
         s = self.stages[i]
-        return pe.StageInfo(mem=s.mem, procs=s.procs, ix=i, cmd=s.cmd, log_file=s.logFile,
-                            output_files=s.outputFiles, env_vars=s.env_vars)
+        chain = self.fused_chain(i)
+        if len(chain) == 1:
+            return pe.StageInfo(mem=s.mem, procs=s.procs, ix=i, cmd=s.cmd, log_file=s.logFile,
+                                output_files=s.outputFiles, env_vars=s.env_vars)
+        mem, procs = self.stage_resources(i)
+        return pe.StageInfo(mem=mem, procs=procs, ix=i, cmd=fused_command([self.stages[j] for j in chain]),
+                            log_file=s.logFile, output_files=[f for j in chain for f in self.stages[j].outputFiles],
+                            env_vars=s.env_vars)
 
     def getStage(self, i):
         """given an index, return the actual pipelineStage object"""
@@ -408,6 +683,10 @@ class Pipeline(object):
         return(repr(self.stages[i]))
     def getStageLogfile(self,i):
         return(self.stages[i].logFile)
+    def getStageDigest(self, i):
+        return bytes(self.stage_digests[16 * i:16 * (i + 1)])
+    def isStageFinished(self, i):
+        return self.stage_status[i] == STAGE_FINISHED
 
     def is_time_to_drain(self):
         return self.shutdown_ev.is_set()
@@ -417,16 +696,16 @@ class Pipeline(object):
 
     """Given client information, issue commands to the client (along similar
     lines to getRunnableStageIndex) and update server's internal view of client.
-    This is highly stateful, being a resource-tracking wrapper around
-    getRunnableStageIndex and hence a glorified Set.pop."""
-    def getCommand(self, clientURIstr, clientMemFree, clientProcsFree):
+    Of the runnable stages which fit into its free resources, the client is given the one with
+    the most work remaining downstream of it (of equal ones, the largest in terms of memory,
+    then processors).  If the client reports how long it has left to run (`walltime_left`,
+    in seconds), only stages expected to finish within that time are considered."""
+    def getCommand(self, clientURIstr, clientMemFree, clientProcsFree, walltime_left=None):
         if self.is_time_to_drain():
             return ("shutdown_abnormally", None)
 
-        # TODO now that getRunnableStageIndex pops from a set,
-        # intelligently look for something this client can run
-        # (e.g., by passing available resources
-        # into getRunnableStageIndex)?
+        if self.allStagesCompleted():
+            return ("shutdown_normally", None)
         if clientMemFree == 0:
             logger.debug("Executor has no free memory")
             return ("wait", None)
@@ -434,27 +713,102 @@ class Pipeline(object):
             logger.debug("Executor has no free processors")
             return ("wait", None)
 
-        flag, i = self.getRunnableStageIndex()
-        if flag == "run_stage":
-            eps = 0.000001
-            memOK   = self.getStageMem(i) <= clientMemFree + eps
-            procsOK = self.getStageProcs(i) <= clientProcsFree
-            if memOK and procsOK:
-                return (flag, i)
+        eps = 0.000001
+        i = self.runnable.pop_fitting(mem=clientMemFree + eps, procs=clientProcsFree, max_runtime=walltime_left)
+        if i is None:
+            if len(self.runnable) > 0:
+                logger.debug("None of the %d runnable stages fit into the executor's free resources "
+                             "(free memory: %.2fG, free processors: %d, walltime left: %s s). (Executor: %s)",
+                             len(self.runnable), clientMemFree, clientProcsFree, walltime_left, clientURIstr)
+            return ("wait", None)
+        self.trace_event(i, CLAIMED, clientURIstr)
+        return ("run_stage", i)
+
+    def getCommands(self, clientURIstr, clientMemFree, clientProcsFree, max_n, walltime_left=None):
+        """Like getCommand, but hand out up to `max_n` stages which together fit into the
+        client's free resources, returning a flag and a (possibly empty) list of their `StageInfo`s
+        so that a newly started executor can fill up in a single round trip."""
+        flag, stages = "wait", []
+        while len(stages) < max_n:
+            flag, i = self.getCommand(clientURIstr, clientMemFree, clientProcsFree, walltime_left)
+            if flag != "run_stage":
+                break
+            stages.append(self.get_stage_info(i))
+            clientMemFree   -= stages[-1].mem
+            clientProcsFree -= stages[-1].procs
+        return ("run_stage", stages) if stages else (flag, stages)
+
+    def claim(self, clientURI, clientMemFree, clientProcsFree, max_n, walltime_left=None, request_id=None):
+        """As getCommands, but also mark the stages handed out as started (on the client)
+        and refresh the client's heartbeat, so that starting stages takes a single round trip.
+        Since this happens atomically, a stage can't be handed out again before it's started.
+        Unlike getCommands, this is safe to retry (e.g., if the reply was lost) given a `request_id`
+        unique among the client's claims: a repeated request gets the same stages (those of them
+        still running on the client) rather than more of them, which the client would never run."""
+        self.touchClient(clientURI)
+        client = self.clients.get(clientURI)
+        if request_id is not None and client is not None and client.last_claim is not None \
+                and client.last_claim[0] == request_id:
+            flag, stages = client.last_claim[1]
+            stages = [s for s in stages if s.ix in client.running_stages]
+            return ("wait", stages) if flag == "run_stage" and not stages else (flag, stages)
+        self.collect_cache_lookups()
+        flag, stages = self.getCommands(clientURI, clientMemFree, clientProcsFree, max_n, walltime_left)
+        for s in stages:
+            # (including any stages fused with it)
+            for i in self.fused_chain(s.ix):
+                self.setStageStarted(i, clientURI)
+        if request_id is not None and client is not None:
+            client.last_claim = (request_id, (flag, stages))
+        return flag, stages
+
+    def report(self, clientURI, results):
+        """Record the results of stages which have terminated on the client, given as
+        (index, returncode, runtime, maxrss, cputime) tuples (a returncode of None means the stage couldn't
+        be run; maxrss is the peak memory use in G and cputime the user + system CPU time in seconds),
+        and refresh the client's heartbeat.  Results of stages
+        which aren't running on the client (e.g., reported a second time since the reply to an
+        earlier report was lost) are ignored."""
+        self.touchClient(clientURI)
+        client = self.clients.get(clientURI)
+        for ix, returncode, runtime, maxrss, cputime in results:
+            if client is None or ix not in client.running_stages:
+                logger.warning("Ignoring result of stage %d from %s, which isn't running it", ix, clientURI)
+                continue
+            self.stage_maxrss[ix] = maxrss
+            self.stage_cputime[ix] = cputime
+            s = self.stages[ix]
+            # the stages fused with this one (see `fuse_chains`), which ran as part of the same job
+            fused = self.fused_chain(ix, status=STAGE_RUNNING)[1:]
+            if fused:
+                if returncode == 0:
+                    self.setStageFinished(ix, clientURI, runtime=runtime)
+                    for i in fused:
+                        self.setStageFinished(i, clientURI, runtime=0.0)
+                else:
+                    # (we don't know which of the stages failed, so retry them all)
+                    for i in fused:
+                        self.removeFromRunning(i, clientURI, new_status=STAGE_NOT_RUN)
+                    self.setStageFailed(ix, clientURI)
+                continue
+            if self.usage_model is not None and isinstance(s, CmdStage):
+                if returncode == 0:
+                    self.usage_model.record(usage_key(s.cmd), self._stage_size(ix), maxrss, runtime)
+                elif returncode is not None and (returncode == -signal.SIGKILL or maxrss >= OOM_FRACTION * s.mem):
+                    # probably ran out of memory (or was killed for using too much), so retry with more
+                    mem = self.usage_model.record_oom(usage_key(s.cmd), self._stage_size(ix), s.mem)
+                    logger.info("Stage %d used %.2fG of %.2fG before failing; requesting %.2fG",
+                                ix, maxrss, s.mem, mem)
+                    s.setMem(mem)
+            if returncode == 0:
+                self.setStageFinished(ix, clientURI, runtime=runtime)
             else:
-                if not memOK:
-                    logger.debug("The executor does not have enough free memory (free: %.2fG, required: %.2fG) to run stage %d. (Executor: %s)", clientMemFree, self.getStageMem(i), i, clientURIstr)
-                if not procsOK:
-                    logger.debug("The executor does not have enough free processors (free: %.1f, required: %.1f) to run stage %d. (Executor: %s)", clientProcsFree, self.getStageProcs(i), i, clientURIstr)
-                self.enqueue(i)
-                return ("wait", None)
-        else:
-            return (flag, i)
+                self.setStageFailed(ix, clientURI)
 
     """Return a tuple of a command ("shutdown_normally" if all stages are finished,
     "wait" if no stages are currently runnable, or "run_stage" if a stage is
-    available) and the next runnable stage if the flag is "run_stage", otherwise
-    None"""
+    available) and the next runnable stage (the one with the most work remaining
+    downstream of it) if the flag is "run_stage", otherwise None"""
     def getRunnableStageIndex(self):
         if self.allStagesCompleted():
             return ("shutdown_normally", None)
@@ -462,12 +816,6 @@ class Pipeline(object):
             return ("wait", None)
         else:
             index = self.runnable.pop()
-            # remove an instance of currently required memory
-            try:
-                self.mem_req_for_runnable.remove(self.stages[index].mem)
-            except:
-                logger.debug("mem_req_for_runnable: %s; mem: %s", self.mem_req_for_runnable, self.stages[index].mem)
-                logger.exception("It wasn't here!")
             return ("run_stage", index)
 
     def allStagesCompleted(self): 
@@ -502,21 +850,26 @@ class Pipeline(object):
         # It would be better to catch that earlier (by using a different/additional data structure)
         # but for now look for the case when a stage is run twice at the same time, which may
         # produce bizarre results as both processes write files
-        if self.stages[index].status == 'running':
+        if self.stage_status[index] == STAGE_RUNNING:
             raise Exception('stage %d is already running' % index)
         self.addRunningStageToClient(clientURI, index)
         self.currently_running_stages.add(index)
-        self.stages[index].setRunning()
+        self.stage_start_times[index] = time.time()
+        self.stage_status[index] = STAGE_RUNNING
+        self.trace_event(index, STARTED, clientURI)
 
     def checkIfRunnable(self, index):
         """stage added to runnable set if all predecessors finished"""
-        canRun = ((not self.stages[index].isFinished()) and (self.unfinished_pred_counts[index] == 0))
+        # (a stage fused with its predecessor is already running when the latter finishes)
+        canRun = self.stage_status[index] == STAGE_NOT_RUN and self.unfinished_pred_counts[index] == 0
         #logger.debug("Stage %s Runnable: %s", str(index), str(canRun))
         return canRun
 
     def setStageFinished(self, index, clientURI, save_state = True,
-                         checking_pipeline_status = False):
-        """given an index, sets corresponding stage to finished and adds successors to the runnable set"""
+                         checking_pipeline_status = False, runtime = None):
+        """given an index, sets corresponding stage to finished and adds successors to the runnable set
+        (`runtime`, if given, is the stage's running time as measured by the executor; a `clientURI`
+        of None means the stage wasn't run, since its outputs were restored from the stage cache)"""
 
         s = self.stages[index]
         
@@ -527,7 +880,7 @@ class Pipeline(object):
         # to finish more than once (alternately, we could merely avoid
         # decrementing counts of previously finished stages, but
         # this choice should expose bugs sooner)
-        if s.isFinished():
+        if self.isStageFinished(index):
             raise ValueError("Already finished stage %d" % index)
         
         # this function can be called when a pipeline is restarted, and 
@@ -536,10 +889,18 @@ class Pipeline(object):
         # jobs, because there is none.
 
         if checking_pipeline_status:
-            s.status = "finished"
+            self.stage_status[index] = STAGE_FINISHED
         else:
             logger.info("Finished Stage %s: %s (on %s)", str(index), str(self.stages[index]), clientURI)
-            self.removeFromRunning(index, clientURI, new_status = "finished")
+            if runtime is None:
+                runtime = time.time() - self.stage_start_times.get(index, time.time())
+            self.trace_event(index, FINISHED, clientURI)
+            if clientURI is None:
+                self.stage_status[index] = STAGE_FINISHED
+            else:
+                self.removeFromRunning(index, clientURI, new_status = STAGE_FINISHED)
+            self.finish_times.append(time.time())
+            self._forget_finish_times(self.finish_times[-1])
             # run any potential hooks now that the stage has finished:
             for f in s.finished_hooks:
                 f(s)
@@ -556,18 +917,23 @@ class Pipeline(object):
                       + str(self.exec_options.urifile) + "\n")
             self.percent_finished_reported = roughly_processed
 
-        # write out the (index, hash) pairs to disk.  We don't actually need the indices
-        # for anything (in fact, the restart code in skip_completed_stages is resilient 
-        # against an arbitrary renumbering of stages), but a human-readable log is somewhat useful.
-        if not checking_pipeline_status:
-            self.finished_stages_fh.write("%d,%s\n" % (index, self.stages[index].getHash()))
-            self.finished_stages_fh.flush()
-        # FIXME flush could turned off as an optimization (more sensibly, a small buffer size could be set)
-        # ... though we might not record a stage's completion, this doesn't affect correctness.
+        # record the stage's hash (but not its index, which is just an artifact of the graph
+        # construction) in the journal.  This is buffered, so a crash may lose the last few
+        # records, but this only means those stages will be re-run.
+        # (including stages restored from the stage cache, whose entries may be gone by a restart)
+        if not checking_pipeline_status and isinstance(s, CmdStage):
+            self.finished_stages_journal.record(self.getStageDigest(index), runtime=runtime)
+            if self.stage_cache is not None and clientURI is not None and s.outputFiles:
+                # (the key isn't known yet, e.g., for a stage run along with the one it's fused with,
+                # whose inputs didn't exist when that was enqueued, so is computed in the background)
+                self.stage_cache.store(s.cmd, s.inputFiles, s.outputFiles, key=self.stage_cache_keys.pop(index, None))
         for i in self.G.successors(index):
             self.unfinished_pred_counts[i] -= 1
             if self.checkIfRunnable(i):
                 self.enqueue(i)
+        if self.allStagesCompleted():
+            # so that waiting executors are told to shut down
+            self.wake_work_waiters()
 
     def removeFromRunning(self, index, clientURI, new_status):
         try:
@@ -575,13 +941,22 @@ class Pipeline(object):
         except:
             logger.exception("Unable to remove stage %d from client %s's stages: %s", index, clientURI, self.clients[clientURI].running_stages)
         self.removeRunningStageFromClient(clientURI, index)
-        self.stages[index].status = new_status
+        self.stage_start_times.pop(index, None)
+        self.stage_status[index] = new_status
 
     def setStageLost(self, index, clientURI):
         """Clean up a stage lost due to unresponsive client"""
+        if self.stage_status[index] != STAGE_RUNNING:
+            return  # (already lost along with the stage it's fused with)
         logger.warning("Lost Stage %d: %s: ", index, self.stages[index])
-        self.removeFromRunning(index, clientURI, new_status = None)
-        self.enqueue(index)
+        self.trace_event(index, LOST, clientURI)
+        # the stages fused with this one are lost too, and will be run along with it again
+        for i in self.fused_chain(index, status=STAGE_RUNNING)[1:]:
+            self.trace_event(i, LOST, clientURI)
+            self.removeFromRunning(i, clientURI, new_status = STAGE_NOT_RUN)
+        self.removeFromRunning(index, clientURI, new_status = STAGE_NOT_RUN)
+        if self.checkIfRunnable(index):
+            self.enqueue(index)
 
     def setStageFailed(self, index, clientURI):
         # given an index, sets stage to failed, adds to failed stages array
@@ -589,34 +964,84 @@ class Pipeline(object):
         # Once in while retrying a stage makes sense, because of some odd I/O
         # read write issue (NFS race condition?). At least that's what I think is 
         # happening, so trying this to see whether it solves the issue.
-        num_retries = self.stages[index].getNumberOfRetries()
+        self.trace_event(index, FAILED, clientURI)
+        num_retries = self.stage_retries[index]
         if num_retries < 2:
             # without a sleep statement, the stage will be retried within
             # a handful of milliseconds, that won't solve anything...
             # this sleep command will block the server for a small amount
             # of time, but should happen only sporadically
             #time.sleep(STAGE_RETRY_INTERVAL)
-            self.removeFromRunning(index, clientURI, new_status = None)
-            self.stages[index].incrementNumberOfRetries()
+            self.removeFromRunning(index, clientURI, new_status = STAGE_NOT_RUN)
+            self.stage_retries[index] += 1
             logger.info("RETRYING: ERROR in Stage " + str(index) + ": " + str(self.stages[index]) + "\n"
                         + "RETRYING: adding this stage back to the runnable set.\n"
                         + "RETRYING: Logfile for Stage " + str(self.stages[index].logFile) + "\n")
             self.enqueue(index)
         else:
-            self.removeFromRunning(index, clientURI, new_status = "failed")
+            self.removeFromRunning(index, clientURI, new_status = STAGE_FAILED)
             logger.info("ERROR in Stage " + str(index) + ": " + str(self.stages[index]))
             # This is something we should also directly report back to the user:
             print("\nERROR in Stage %s: %s" % (str(index), str(self.stages[index])))
             print("Logfile for (potentially) more information:\n%s\n" % self.stages[index].logFile)
             sys.stdout.flush()
             self.failedStages.append(index)
-            for i in nx.dfs_successors(self.G, index).keys():
+            for i in self.G.descendants(index):
                 self.failedStages.append(i)
 
-    @functools.lru_cache(maxsize=None)  # must cache *all* results!
+    def trace_event(self, i, event, clientURI=None):
+        """Record a lifecycle event of stage `i` in the trace (if any)."""
+        if self.trace is not None:
+            ended = event in (FINISHED, FAILED)
+            self.trace.record(time.time(), i, event, executor=clientURI, mem=self.stages[i].mem,
+                              maxrss=self.stage_maxrss[i] if ended else 0.0,
+                              cputime=self.stage_cputime[i] if ended else 0.0)
+
+    def stage_tool(self, i):
+        """The name of the program stage `i` runs (used to group stages in the trace)."""
+        return os.path.basename(self.stages[i].name) or type(self.stages[i]).__name__
+
+    def write_trace(self):
+        """Write out the trace of the stages' lifecycle events (as a Chrome trace and as a CSV file)
+        and print a summary of the time spent per tool."""
+        if self.trace is None or len(self.trace) == 0:
+            return
+        json_file, csv_file = trace_paths(self.outputDir, self.pipeline_name)
+        try:
+            self.trace.write_chrome_trace(json_file, self.stage_tool)
+            self.trace.write_csv(csv_file, self.stage_tool)
+        except OSError:
+            logger.exception("Couldn't write the stage trace")
+        else:
+            logger.info("Wrote the stage trace to %s and %s", json_file, csv_file)
+        summary = self.trace.format_summary(self.stage_tool)
+        logger.info("Time spent per tool:\n%s", summary)
+        print("\nTime spent per tool (see %s for a timeline):\n%s\n" % (json_file, summary))
+        sys.stdout.flush()
+
+    def write_profile(self):
+        """Write out the latency histograms of the server's methods (with --profile-server)."""
+        if self.profile is None:
+            return
+        latency_file, _ = profile_paths(self.outputDir, self.pipeline_name)
+        try:
+            self.profile.write(latency_file)
+        except OSError:
+            logger.exception("Couldn't write the server's latency histograms")
+        logger.info("Server method latencies (also in %s):\n%s", latency_file, self.profile.format_summary())
+
+    def toggle_profile_snapshot(self):
+        """Start or stop (and write out) a cProfile/tracemalloc profile of the server (on SIGUSR1)."""
+        if self.profile is not None:
+            _, prefix = profile_paths(self.outputDir, self.pipeline_name)
+            self.profile.toggle_snapshot(prefix)
+
     def prepare_to_run(self, i):
         """Some pre-run tasks that must only run once
         (in the current model, `enqueue` may run arbitrarily many times!)"""
+        if self.stage_prepared[i]:
+            return
+        self.stage_prepared[i] = 1
         for f in self.stages[i]._runnable_hooks:
             f(self.stages[i])
         # the easiest place to ensure that all stages request at least
@@ -626,16 +1051,125 @@ class Pipeline(object):
         if self.stages[i].mem < self.exec_options.default_job_mem:
             self.stages[i].setMem(self.exec_options.default_job_mem)
         # scale everything by the memory_factor
-        # FIXME this may run several times ... weird !!
         self.stages[i].setMem(self.stages[i].mem * self.exec_options.memory_factor)
+        s = self.stages[i]
+        if self.usage_model is not None and isinstance(s, CmdStage) and self.usage_model.has_samples(usage_key(s.cmd)):
+            # raise the estimate to the memory use measured for similar stages, if known and larger
+            # (these measurements are from the same system, so aren't scaled by the memory_factor)
+            mem = self.usage_model.predict_mem(usage_key(s.cmd), self._stage_size(i))
+            if mem is not None and mem > s.mem:
+                logger.debug("Stage %d: using learned memory estimate %.3fG instead of %.3fG", i, mem, s.mem)
+                s.setMem(mem)
+
+    def _stage_size(self, i):
+        """The size of stage `i` (see `stage_size`), measured the first time it's needed rather than
+        for every stage, since this may involve reading the headers of the stage's inputs."""
+        if math.isnan(self.stage_sizes[i]):
+            self.stage_sizes[i] = self.stage_size(self.stages[i])
+        return self.stage_sizes[i]
 
     def enqueue(self, i):
         """Update pipeline data structures and run relevant hooks when a stage becomes runnable."""
         #logger.debug("Queueing stage %d", i)
-        self.runnable.add(i)
+        # run the hooks first since they may change the stage's resource requirements,
+        # which the runnable queue is indexed by
         self.prepare_to_run(i)
-        # keep track of the memory requirements of the runnable jobs
-        self.mem_req_for_runnable.append(self.stages[i].mem)
+        for j in self.fused_chain(i)[1:]:
+            self.prepare_to_run(j)
+        s = self.stages[i]
+        if (self.stage_cache is not None and isinstance(s, CmdStage) and s.outputFiles
+                and i not in self.stage_cache_keys):  # (i.e., not already missed, e.g., when retrying)
+            # look for the stage in the cache first, which involves reading its inputs, so happens
+            # in the background (see `collect_cache_lookups`)
+            self.cache_requests.append(i)
+            return
+        self._add_runnable(i)
+
+    def _add_runnable(self, i):
+        self.runnable.add(i)
+        self.trace_event(i, RUNNABLE)
+        if self.work_waiters:
+            self.wake_work_waiters(i)
+
+    def collect_cache_lookups(self, wait=False):
+        """Start looking for the stages waiting to be looked for in the stage cache, then mark those whose
+        lookups have finished as finished if their outputs were restored, or make them runnable otherwise.
+        With `wait`, wait for lookups (including those of stages made runnable in turn) until none are left."""
+        if self.stage_cache is None:
+            return
+        while self.cache_requests or self.cache_lookups:
+            for i in self.cache_requests:
+                s = self.stages[i]
+                self.cache_lookups.append((i, self.stage_cache.lookup(s.cmd, s.inputFiles, s.outputFiles)))
+            self.cache_requests = []
+            # (the lookups finish in order, so only check the oldest)
+            i, lookup = self.cache_lookups[0]
+            if not (wait or lookup.done()):
+                break
+            self.cache_lookups.popleft()
+            try:
+                key, restored = lookup.result()
+            except Exception:
+                logger.exception("Couldn't look for stage %d in the stage cache", i)
+                key, restored = None, False
+            if restored:
+                logger.info("Stage %d: restored outputs from the stage cache: %s", i, self.stages[i])
+                self.setStageFinished(i, None)
+            else:
+                if key is not None:
+                    self.stage_cache_keys[i] = key
+                self._add_runnable(i)
+
+    def flush_stage_cache(self):
+        """Wait for the outputs of finished stages to be added to the stage cache, if any."""
+        if self.stage_cache is not None:
+            self.stage_cache.wait()
+            logger.info("Stages whose outputs were restored from the stage cache: %d", self.stage_cache.hits)
+
+    def has_work_for(self, clientMemFree, clientProcsFree, walltime_left=None):
+        """Whether getCommand would return something other than "wait" for these free resources."""
+        eps = 0.000001
+        return (self.is_time_to_drain() or self.allStagesCompleted()
+                or self.runnable.has_fitting(mem=clientMemFree + eps, procs=clientProcsFree,
+                                             max_runtime=walltime_left))
+
+    def waitForWork(self, clientURI, clientMemFree, clientProcsFree, timeout, walltime_left=None):
+        """Return True as soon as getCommand would give the client something other than "wait"
+        (a stage fitting into the given free resources, or a shutdown command), or False after
+        `timeout` seconds, so that idle executors needn't poll.  When not running an event loop
+        (i.e., for the Pyro server) this can't wait and just returns the current state."""
+        self.touchClient(clientURI)
+        if self.work_waiters is None or self.has_work_for(clientMemFree, clientProcsFree, walltime_left):
+            return self.has_work_for(clientMemFree, clientProcsFree, walltime_left)
+        return self._wait_for_work(clientMemFree, clientProcsFree, timeout, walltime_left)
+
+    async def _wait_for_work(self, clientMemFree, clientProcsFree, timeout, walltime_left):
+        waiter = asyncio.get_event_loop().create_future()
+        # (the walltime left when the wait times out, since the stage is started only after that)
+        self.work_waiters[waiter] = (clientMemFree, clientProcsFree,
+                                     walltime_left - timeout if walltime_left is not None else None)
+        try:
+            return await asyncio.wait_for(waiter, timeout)
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self.work_waiters.pop(waiter, None)
+
+    def wake_work_waiters(self, i=None):
+        """Wake up one executor waiting for work which stage `i` fits into
+        (only one, since the others would just find that it's gone), or all of them."""
+        if not self.work_waiters:
+            return
+        eps = 0.000001
+        mem, procs = self.stage_resources(i) if i is not None else (0, 0)
+        runtime = self.runnable.runtime_bound(i) if i is not None else 0
+        for waiter, (clientMemFree, clientProcsFree, walltime_left) in list(self.work_waiters.items()):
+            if (mem <= clientMemFree + eps and procs <= clientProcsFree
+                    and (walltime_left is None or runtime <= walltime_left) and not waiter.done()):
+                waiter.set_result(True)
+                del self.work_waiters[waiter]
+                if i is not None:
+                    break
 
     """
         Returns True unless all stages are finished, then False
@@ -649,6 +1183,9 @@ class Pipeline(object):
     def continueLoop(self):
         if self.verbose:
             print('.', end="", flush=True)
+        # write out recently finished stages if they've been buffered for long enough
+        self.flush_if_due()
+        self.collect_cache_lookups()
         # We may be have been called one last time just as the parent thread is exiting
         # (if it wakes us with a signal).  In this case, don't do anything:
         if self.shutdown_ev.is_set():
@@ -664,7 +1201,8 @@ class Pipeline(object):
         # (e.g., if some stages have repeatedly failed)
         # TODO this might indicate a bug, so better reporting would be useful
         elif (len(self.runnable) == 0
-            and len(self.currently_running_stages) == 0):
+            and len(self.currently_running_stages) == 0
+            and not (self.cache_requests or self.cache_lookups)):
             logger.info("ERROR: no more runnable stages, however not all stages have finished. Going to shut down.")
             print("\nERROR: no more runnable stages, however not all stages have finished. Going to shut down.\n")
             sys.stdout.flush()
@@ -687,7 +1225,7 @@ class Pipeline(object):
         # TODO combine with above clause?
         else:
           if len(self.runnable) > 0:
-            highest_mem_stage = self.highest_memory_stage(self.runnable)
+            highest_mem_stage = self.highest_memory_stage()
             max_memory_required = highest_mem_stage.mem
           if ((len(self.runnable) > 0) and
           # require no running jobs rather than no clients
@@ -696,7 +1234,8 @@ class Pipeline(object):
           # the latter choice might lead to the system
           # running indefinitely with no jobs
             (self.number_launched_and_waiting_clients + len(self.clients) == 0 and
-            max_memory_required > self.memAvail)):
+            # (only if none of the runnable stages could run, since executors would be launched for any which can)
+            not self.runnable.has_fitting(mem=self.memAvail, procs=math.inf))):
               msg = ("\nShutting down due to jobs (e.g. `%s`) which require more memory (%.2fG) than the amount requestable. "
                      "Please use the --mem argument to increase the amount of memory that executors can request."
                      % (str(highest_mem_stage)[:1000], max_memory_required))
@@ -706,6 +1245,12 @@ class Pipeline(object):
           else:
             return True
 
+    def touchClient(self, clientURI):
+        """Refresh the heartbeat of a client, as any call from it shows that it's alive."""
+        client = self.clients.get(clientURI)
+        if client is not None:
+            client.timestamp = time.time()
+
     #@Pyro4.oneway
     def updateClientTimestamp(self, clientURI, tick):
         t = time.time()  # use server clock for consistency
@@ -718,46 +1263,39 @@ class Pipeline(object):
             logger.exception("clientURI not found in server client list:")
             raise
 
-    # requires: stages != []
-    # a better interface might be (self, [stage]) -> { MemAmount : (NumStages, [Stage]) }
-    # or maybe the same using a heap (to facilitate getting N stages with most memory)
-    def highest_memory_stage(self, stages):
-        s = max(stages, key=lambda i: self.stages[i].mem)
-        return self.stages[s]
+    # requires: len(self.runnable) > 0
+    def highest_memory_stage(self):
+        return self.stages[self.runnable.largest()]
 
-    def max_memory_required(self, stages):
-        return self.highest_memory_stage(stages).mem  # TODO don't use below, propagate stage # ....
+    def max_memory_required(self):
+        return self.runnable.max_memory()
 
     # this can't be a loop since we call it via sockets and don't want to block the socket forever
     def manageExecutors(self):
         logger.debug("Checking if executors need to be launched ...")
+        self.expire_launches()
         executors_to_launch = self.numberOfExecutorsToLaunch()
         if executors_to_launch > 0:
-            # RAM needed to run a single job:
-            max_memory_stage = self.highest_memory_stage(self.runnable)
-            memNeeded = max_memory_stage.mem  # self.max_memory_required(self.runnable)
-            # RAM needed to run `proc` most expensive jobs (not the ideal choice):
-            memWanted = sum(sorted([self.stages[i].mem for i in self.runnable],
-                                   key = lambda x: -x)[0:self.exec_options.proc])
-            logger.debug("wanted: %s", memWanted)
-            logger.debug("needed: %s", memNeeded)
-
-            if memNeeded > self.memAvail:
+            if self.max_memory_required() > self.memAvail:
+                max_memory_stage = self.highest_memory_stage()
                 msg = "\nA stage (%s) requires %.2fG of memory to run, but max allowed is %.2fG" \
-                        % (str(max_memory_stage)[:1000], memNeeded, self.memAvail)
+                        % (str(max_memory_stage)[:1000], max_memory_stage.mem, self.memAvail)
                 logger.error(msg)
                 print(msg)
-            else:
-                if self.exec_options.greedy:
-                    mem = self.memAvail
-                elif memWanted <= self.memAvail:
-                    mem = memWanted
-                else:
-                    mem = self.memAvail  #memNeeded?
+            # rather than sizing all executors for the largest stage, pack the runnable stages
+            # into executors and launch a few different sizes of executor to fit them
+            # (with --whole-node-executors, executors get a whole node, so fill its memory):
+            size_classes = executor_size_classes(self.runnable.resource_counts(),
+                                                 max_mem=self.memAvail, procs=self.executor_procs(),
+                                                 max_executors=executors_to_launch,
+                                                 greedy=self.exec_options.greedy
+                                                        or self.exec_options.whole_node_executors)
+            logger.debug("executor sizes (memory, number): %s", size_classes)
+            for mem, number in size_classes:
                 try:
-                    self.launchExecutorsFromServer(executors_to_launch, mem)
-                    print("\nSubmitted " + str(executors_to_launch) + " executors (clients) to the queue."
-                          "\nWaiting for them to register with the server...")
+                    self.launchExecutorsFromServer(number, mem)
+                    print("\nSubmitted %d executors (clients) with %.2fG of memory to the queue."
+                          "\nWaiting for them to register with the server..." % (number, mem))
                 except pe.SubmitError:
                     logger.exception("Failed to submit executors; will retry")
 
@@ -798,36 +1336,48 @@ class Pipeline(object):
         if self.failed_executors > self.exec_options.max_failed_executors:
             return 0
 
-        if (len(self.runnable) > 0 and
-            self.max_memory_required(self.runnable) > self.memAvail):
-            # we might still want to launch executors for the stages with smaller
-            # requirements
-            return 0
-        
         if self.exec_options.num_exec != 0:
             # Server should launch executors itself
             # This should happen regardless of whether or not executors
             # can kill themselves, because the server is now responsible 
             # for the initial launches as well.
             active_executors = self.number_launched_and_waiting_clients + len(self.clients)
-            desired_num_executors = min(len(self.runnable), self.exec_options.num_exec)
+            # (stages requiring more than an executor can have don't need executors, but the others still do)
+            runnable_stages = sum(n for (mem, procs), n in self.runnable.resource_counts()
+                                  if mem <= self.memAvail and procs <= self.executor_procs())
+            desired_num_executors = min(runnable_stages, self.exec_options.num_exec)
             executor_launch_room = desired_num_executors - active_executors
             # there are runnable stages, and there is room to launch 
             # additional executors
             return max(executor_launch_room, 0)
         else:
             return 0
-        
+
+    def executor_procs(self):
+        """The number of processors of each executor the server launches"""
+        return self.exec_options.ppn if self.exec_options.whole_node_executors else self.exec_options.proc
+
     def launchExecutorsFromServer(self, number_to_launch, memNeeded):
         logger.info("Launching %i executors", number_to_launch)
         try:
             launchPipelineExecutors(options=self.options, number=number_to_launch,
                                     mem_needed=memNeeded, uri_file=self.exec_options.urifile)
             self.number_launched_and_waiting_clients += number_to_launch
+            self.launches.append(ExecutorLaunch(number_to_launch, memNeeded))
         except:
             logger.exception("Failed launching executors from the server.")
             raise
         
+    def expire_launches(self, now=None):
+        """Stop waiting for the executors of launches which haven't registered within EXECUTOR_LAUNCH_TIMEOUT."""
+        now = time.time() if now is None else now
+        for launch in [l for l in self.launches if now - l.timestamp > EXECUTOR_LAUNCH_TIMEOUT]:
+            waiting = launch.number - launch.registered
+            logger.warning("%d of %d executors (%.2fG) of the launch at %s never registered; no longer waiting for them",
+                           waiting, launch.number, launch.mem, time.strftime("%X", time.localtime(launch.timestamp)))
+            self.number_launched_and_waiting_clients = max(self.number_launched_and_waiting_clients - waiting, 0)
+            self.launches.remove(launch)
+
     def getProcessedStageCount(self):
         return self.num_finished_stages
 
@@ -841,6 +1391,15 @@ class Pipeline(object):
         self.clients[clientURI] = ExecClient(clientURI, maxmemory)
         if self.number_launched_and_waiting_clients > 0:
             self.number_launched_and_waiting_clients -= 1
+        # attribute the executor to the oldest launch of executors of its size still waiting for some of these
+        # (there's none if, e.g., the user launched the executor)
+        launch = next((l for l in self.launches if abs(l.mem - maxmemory) < 0.001), None)
+        if launch is not None:
+            launch.registered += 1
+            logger.info("%d of %d executors (%.2fG) of the launch at %s registered", launch.registered,
+                        launch.number, launch.mem, time.strftime("%X", time.localtime(launch.timestamp)))
+            if launch.registered >= launch.number:
+                self.launches.remove(launch)
         logger.debug("Client registered (Eh!): %s", clientURI)
         if self.verbose:
             print("\nClient registered (Eh!): %s" % clientURI, end="")
@@ -868,69 +1427,62 @@ class Pipeline(object):
         self.number_launched_and_waiting_clients += 1
 
     def skip_completed_stages(self):
+        """Mark the stages recorded in the finished stages log as finished (unless they must re-run
+        since an ancestor must, or with --smart-restart, since their inputs have changed) and
+        enqueue the stages which can run next.  This walks the graph once, in topological order,
+        and doesn't run any hooks for the stages it marks finished."""
         logger.debug("Consulting logs to determine skippable stages...")
         try:
-            with open(self.backupFileLocation, 'r') as fh:
-                # a stage's index is just an artifact of the graph construction,
-                # so load only the hashes of finished stages
-                previous_hashes = frozenset((e.split(',')[1] for e in fh.read().split()))
+            previous_digests = load_finished_digests(self.backupFileLocation)
         except:
             logger.info("Finished stages log doesn't exist or is corrupt.")
+            self.enqueue_graph_heads()
             return
 
-        runnable  = []
-        finished  = []
-        completed = 0
-        while True:
-            # self.runnable should be populated initially by the graph heads.
-            # Traverse the graph by removing stages from the runnable set and,
-            # if they don't need to be re-run, adding their dependencies to that set
-            # (via setStageFinished); if they do, accumulate them.  Once this set is emptied,
-            # we have computed a set of stages which must and can be run
-            # (either because the input/output filenames or command has changed
-            # or because an ancestor has re-run, i.e., the files themselves have changed)
-            # but whose ancestors have already been run
-            flag,i = self.getRunnableStageIndex()
-            if i == None:
-                break
-
-            s = self.getStage(i)
-
-            if not isinstance(s, CmdStage):
-                runnable.append(i)
-                continue
-
-            h = s.getHash()
-
-            # we've never run this command before
-            if not h in previous_hashes:
-                runnable.append(i)
-                continue
-
-            if self.options.application.smart_restart:
-                latest_input_mtime = max([os.stat(inputFile).st_mtime for inputFile in s.inputFiles])
-                latest_output_mtime = max([os.stat(outputFile).st_mtime for outputFile in s.outputFiles])
-                #this command's inputFiles were modified after its outputFiles, so rerun it.
-                if (latest_input_mtime > latest_output_mtime):
-                    runnable.append(i)
-                    continue
-
-            self.setStageFinished(i, clientURI = "fake_client_URI", checking_pipeline_status = True)
-
-            finished.append((i, h))  # stupid ... duplicates logic in setStageFinished ...
-            completed += 1
-
+        # stages which have run before (a stage's index is just an artifact of the graph
+        # construction, so only the hashes of finished stages are recorded):
+        candidates = [i for i in self.G.nodes()
+                      if isinstance(self.stages[i], CmdStage) and self.getStageDigest(i) in previous_digests]
+
+        if self.options.application.smart_restart:
+            # stat each file only once (rather than once per stage using it), and in parallel
+            mtimes = file_mtimes({f for i in candidates
+                                    for f in self.stages[i].inputFiles + self.stages[i].outputFiles})
+            def inputs_unchanged(i):
+                s = self.stages[i]
+                output_mtimes = [mtimes[f] for f in s.outputFiles]
+                input_mtimes  = [mtimes[f] for f in s.inputFiles]
+                if None in output_mtimes or None in input_mtimes:
+                    return False
+                # re-run a stage if its inputs were modified after its outputs:
+                return max(input_mtimes, default=-math.inf) <= max(output_mtimes, default=math.inf)
+            candidates = [i for i in candidates if inputs_unchanged(i)]
+
+        skippable = bytearray(len(self.stages))
+        for i in candidates:
+            skippable[i] = 1
+
+        finished = []
+        # since predecessors are visited first, a stage's predecessors have all been
+        # marked finished exactly when its count of unfinished predecessors is zero:
+        for i in self.G.topological_sort():
+            if skippable[i] and self.unfinished_pred_counts[i] == 0:
+                self.stage_status[i] = STAGE_FINISHED
+                self.num_finished_stages += 1
+                for j in self.G.successors(i):
+                    self.unfinished_pred_counts[j] -= 1
+                finished.append(self.getStageDigest(i))
+        self.percent_finished_reported = math.floor(self.num_finished_stages / len(self.stages) * 100)
+
+        runnable = [i for i in self.G.nodes() if self.checkIfRunnable(i)]
         logger.debug("Runnable: %s", runnable)
         for i in runnable:
             self.enqueue(i)
-        with open(self.backupFileLocation, 'w') as fh:
-            # TODO For further optimization, it might (?) be even faster to write to memory and then
-            # make a single file write when finished.
-            # FIXME should write to tmp file in same dir, then overwrite (?) since a otherwise an interruption
-            # in writing this file will cause progress to be lost
-            for l in finished:
-                fh.write("%d,%s\n" % l)
-        logger.info('Previously completed stages (of %d total): %d', len(self.stages), completed)
+        # keep only the records of stages which won't be re-run (atomically, so that an
+        # interruption here can't lose the record of previously finished stages)
+        keep = frozenset(finished)
+        rewrite(self.backupFileLocation, (r for r in read_records(self.backupFileLocation) if r[0] in keep))
+        logger.info('Previously completed stages (of %d total): %d', len(self.stages), len(finished))
 
     def printShutdownMessage(self):
         # it is possible that pipeline.continueLoop returns false, even though the
@@ -974,9 +1526,6 @@ def launchServer(pipeline):
     pipeline.printStages(options.application.pipeline_name)
     pipeline.printNumberProcessedStages()
 
-    # expensive, so only create for pipelines that will actually run
-    pipeline.shutdown_ev = Event()
-
     # for ideological reasons this should live in a method, but pipeline init is
     # rather baroque anyway, and arguably launchServer/pipelineDaemon ought to be
     # a single method with cleaned-up initialization
@@ -999,6 +1548,18 @@ def launchServer(pipeline):
     # but uses a hack to attempt to avoid returning localhost (127....)
     network_address = Pyro4.socketutil.getIpAddress(socket.gethostname(),
                                                     workaround127 = True, ipVersion = 4)
+
+    pipeline.setVerbosity(options.application.verbose)
+
+    shutdown_time = pe.EXECUTOR_MAIN_LOOP_INTERVAL + options.execution.latency_tolerance
+
+    if options.execution.server_mode == "asyncio":
+        launchAsyncioServer(pipeline, network_address, shutdown_time, verboseprint)
+        return
+
+    # expensive, so only create for pipelines that will actually run
+    pipeline.shutdown_ev = Event()
+
     daemon = Pyro4.core.Daemon(host=network_address)
     pipelineURI = daemon.register(pipeline)
     
@@ -1009,19 +1570,30 @@ def launchServer(pipeline):
         ns.register("pipeline", pipelineURI)
     else:
         # If not using Pyro NameServer, must write uri to file for reading by client.
-        uf = open(options.execution.urifile, 'w')
-        uf.write(pipelineURI.asString())
-        uf.close()
+        write_uri_file(options.execution.urifile, pipelineURI.asString())
     
-    pipeline.setVerbosity(options.application.verbose)
+    def serve():
+        # the server process is terminated (below) when we shut down, so make sure that
+        # any buffered records of finished stages are written out first:
+        def handler(sig, _stack):
+            pipeline.flush_journal()
+            os._exit(0)
+        signal.signal(signal.SIGTERM, handler)
+        if pipeline.profile is not None:
+            signal.signal(signal.SIGUSR1, lambda _sig, _stack: pipeline.toggle_profile_snapshot())
+        daemon.requestLoop()
 
-    shutdown_time = pe.EXECUTOR_MAIN_LOOP_INTERVAL + options.execution.latency_tolerance
-    
+    metrics = None
     try:
-        t = Process(target=daemon.requestLoop)
+        t = Process(target=serve)
         # t.daemon = True
         t.start()
 
+        if options.execution.metrics_port is not None:
+            # (fetching the status through the daemon like any other client)
+            metrics = start_metrics_server(options.execution.metrics_port,
+                                           rpc.PersistentProxy(pipelineURI.asString()).getStatusSnapshot)
+
         # at this point requests made to the Pyro daemon will touch process `t`'s copy
         # of the pipeline, so modifiying `pipeline` won't have any effect.  The exception is
         # communication through its multiprocessing.Event, which we use below to wait
@@ -1043,6 +1615,11 @@ def launchServer(pipeline):
         def handler(sig, _stack):
             e.set()
         signal.signal(signal.SIGTERM, handler)
+        if pipeline.profile is not None:
+            # the pipeline's state lives in the daemon's process, so profile that
+            signal.signal(signal.SIGUSR1, lambda _sig, _stack: os.kill(t.pid, signal.SIGUSR1))
+            logger.info("Profiling the server: send SIGUSR1 to process %d to start/stop a detailed profile",
+                        os.getpid())
 
         # spawn a loop to manage executors in a separate process
         # (here we use a proxy to make calls to manageExecutors because (a)
@@ -1070,16 +1647,7 @@ def launchServer(pipeline):
         h.start()
         #del pipeline   # `top` shows this has no effect on vmem
 
-        try:
-            jid    = os.environ["PBS_JOBID"]
-            output = subprocess.check_output(['qstat', '-f', jid], stderr=subprocess.STDOUT)
-
-            time_left = int(re.search('Walltime.Remaining = (\d*)', output).group(1))
-            logger.debug("Time remaining: %d s" % time_left)
-            time_to_live = time_left - shutdown_time
-        except:
-            logger.info("I couldn't determine your remaining walltime from qstat.")
-            time_to_live = None
+        time_to_live = remaining_walltime(shutdown_time)
         flag = e.wait(time_to_live)
         if not flag:
             logger.info("Time's up!")
@@ -1107,11 +1675,130 @@ def launchServer(pipeline):
         # trying to access variables from `p` in the `finally` clause (in order
         # to print a shutdown message) hangs for some reason, so do it here instead
         p.printShutdownMessage()
+        p.write_trace()
+        p.write_profile()
+        p.flush_stage_cache()
     finally:
+        if metrics is not None:
+            metrics.shutdown()
         # brutal, but awkward to do with our system of `Event`s
         # could send a signal to `t` instead:
         t.terminate()
 
+def write_uri_file(urifile, uri):
+    with open(urifile, 'w') as uf:
+        uf.write(uri)
+
+def remaining_walltime(shutdown_time):
+    """Time (in seconds) until the server should shut down to stay within its walltime,
+    or None if this can't be determined."""
+    try:
+        jid    = os.environ["PBS_JOBID"]
+        output = subprocess.check_output(['qstat', '-f', jid], stderr=subprocess.STDOUT)
+
+        time_left = int(re.search(r'Walltime.Remaining = (\d*)', output).group(1))
+        logger.debug("Time remaining: %d s" % time_left)
+        return time_left - shutdown_time
+    except:
+        logger.info("I couldn't determine your remaining walltime from qstat.")
+        return None
+
+def launchAsyncioServer(pipeline, network_address, shutdown_time, verboseprint):
+    """Serve executors' requests, manage executors, and check their heartbeats from a single asyncio
+    event loop in this process, rather than forking a Pyro daemon plus a second process which
+    manages executors by calling back into the daemon."""
+    options = pipeline.options
+    if options.execution.use_ns:
+        raise ValueError("the Pyro NameServer (--use-ns) can't be used with --server-mode=asyncio")
+
+    # no other processes to share this with:
+    pipeline.shutdown_ev = threading.Event()
+    e = pipeline.shutdown_ev
+    # allow executors to wait for work (see Pipeline.waitForWork):
+    pipeline.work_waiters = {}
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    server = rpc.Server(pipeline, host=network_address)
+    stopping = asyncio.Event()
+
+    def shutdown():
+        pipeline.set_shutdown_ev()
+        stopping.set()
+
+    async def manage_executors():
+        try:
+            logger.debug("Executor management loop started")
+            logger.debug("memory limit: %.3G; available after server overhead: %.3fG" % (options.execution.mem, pipeline.memAvail))
+            while pipeline.continueLoop():
+                pipeline.manageExecutors()
+                try:
+                    await asyncio.wait_for(stopping.wait(), LOOP_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+        except:
+            logger.exception("Server loop encountered a problem.  Shutting down.")
+        finally:
+            logger.info("Server loop going to shut down ...")
+            shutdown()
+
+    metrics = None
+    try:
+        loop.run_until_complete(server.start())
+        write_uri_file(options.execution.urifile, server.uri)
+        if options.execution.metrics_port is not None:
+            # (the endpoint's thread fetches the status from the event loop like any other client)
+            metrics = start_metrics_server(options.execution.metrics_port,
+                                           rpc.PersistentProxy(server.uri).getStatusSnapshot)
+        verboseprint("The pipeline's uri is: %s" % server.uri)
+        logger.info("The pipeline's uri is: %s", server.uri)
+
+        # handle SIGTERM and the walltime limit as for the Pyro server
+        loop.add_signal_handler(signal.SIGTERM, shutdown)
+        if pipeline.profile is not None:
+            loop.add_signal_handler(signal.SIGUSR1, pipeline.toggle_profile_snapshot)
+            logger.info("Profiling the server: send SIGUSR1 to process %d to start/stop a detailed profile",
+                        os.getpid())
+        time_to_live = remaining_walltime(shutdown_time)
+        if time_to_live is not None:
+            def times_up():
+                logger.info("Time's up!")
+                shutdown()
+            loop.call_later(time_to_live, times_up)
+
+        manager = loop.create_task(manage_executors())
+        loop.run_until_complete(stopping.wait())
+        loop.run_until_complete(manager)
+    except KeyboardInterrupt:
+        logger.exception("Caught keyboard interrupt, killing executors and shutting down server.")
+        print("\nKeyboardInterrupt caught: cleaning up, shutting down executors.\n")
+        sys.stdout.flush()
+    except:
+        logger.exception("Exception running the server's event loop. Server shutting down.")
+        raise
+    else:
+        pipeline.printShutdownMessage()
+        pipeline.write_trace()
+        pipeline.write_profile()
+        pipeline.flush_stage_cache()
+    finally:
+        if metrics is not None:
+            metrics.shutdown()
+        loop.run_until_complete(server.close())
+        loop.close()
+
+def file_mtimes(paths: Iterable[str], max_workers: int = 8) -> Dict[str, Optional[float]]:
+    """Modification times of the given files (None for files which can't be stat'ed),
+    looked up in parallel since each stat can take a while on a network filesystem."""
+    def mtime(path):
+        try:
+            return os.stat(path).st_mtime
+        except OSError:
+            return None
+    paths = list(paths)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return dict(zip(paths, executor.map(mtime, paths)))
+
 def flatten_pipeline(p):
     """return a list of tuples for each stage.
        Each item in the list is (id, command, [dependencies]) 
@@ -1125,18 +1812,22 @@ def flatten_pipeline(p):
         else:
             return 0 
                 
-    return sorted([(i, str(p.stages[i]), p.G.predecessors(i)) for i in p.G.nodes()], key=functools.cmp_to_key(post))
+    return sorted([(i, str(p.stages[i]), list(p.G.predecessors(i))) for i in p.G.nodes()], key=functools.cmp_to_key(post))
 
-def pipelineDaemon(pipeline, options, programName=None):
-    """Launches Pyro server and (if specified by options) pipeline executors"""
+def pipelineDaemon(pipeline, options, programName=None, launch=None):
+    """Launches Pyro server and (if specified by options) pipeline executors
+    (or runs the pipeline some other way, given `launch`; see pydpiper.execution.local)"""
 
     if options.execution.urifile is None:
         options.execution.urifile = create_uri_filename_from_options(options.application.pipeline_name)
 
     if options.application.restart:
         pipeline.skip_completed_stages()
+    else:
+        pipeline.enqueue_graph_heads()
 
-    if len(pipeline.runnable) == 0:
+    # (stages to be looked for in the stage cache may well be runnable)
+    if len(pipeline.runnable) == 0 and not pipeline.cache_requests:
         print("\nPipeline has no runnable stages. Exiting...")
         sys.exit()
    
@@ -1146,13 +1837,25 @@ def pipelineDaemon(pipeline, options, programName=None):
                  len(pipeline.runnable))
     
     pipeline.programName = programName
+    if options.execution.profile_server:
+        pipeline.profile = ServerProfile()
+        pipeline.profile.instrument(pipeline)
     try:
         # we are now appending to the stages file since we've already written
         # previously completed stages to it in skip_completed_stages
-        with open(pipeline.backupFileLocation, 'a') as fh:
-            pipeline.finished_stages_fh = fh
+        pipeline.finished_stages_journal = FinishedStagesJournal(pipeline.backupFileLocation,
+                                                                 flush_records=options.execution.journal_flush_records,
+                                                                 flush_interval=options.execution.journal_flush_interval)
+        pipeline.finished_stages_journal.open()
+        try:
             logger.debug("Starting server...")
-            launchServer(pipeline)
+            (launch or launchServer)(pipeline)
+        finally:
+            pipeline.finished_stages_journal.close()
+            if pipeline.usage_model is not None:
+                pipeline.usage_model.flush()
+            if pipeline.stage_cache is not None:
+                pipeline.stage_cache.close()
     except:
         logger.exception("Exception (=> quitting): ")
         raise
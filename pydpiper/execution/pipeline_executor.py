@@ -7,10 +7,11 @@ import warnings
 
 from configargparse import ArgParser, Namespace  # type: ignore
 from datetime import datetime
-from multiprocessing import Process, Pool, Lock # type: ignore
+from multiprocessing import Process, Lock # type: ignore
 import subprocess
 import shlex
 import pydpiper.execution.queueing as q
+from pydpiper.execution import rpc
 import math as m
 import logging
 import socket
@@ -18,7 +19,7 @@ import signal
 import threading
 os.environ["PYRO_LOGLEVEL"] = os.getenv("PYRO_LOGLEVEL", "INFO")
 import Pyro4       # type: ignore
-from typing import Any
+from typing import Any, Dict
 
 if os.getenv("OMP_NUM_THREADS") is None:  # for #378 (very large vmem usage)
   os.environ["OMP_NUM_THREADS"] = "4"
@@ -68,27 +69,26 @@ def launchExecutor(executor):
     if executor.ns:
         ns = Pyro4.locateNS()
         #ns.register("executor", executor, safe=True)
-        serverURI = ns.lookup("pipeline")
+        serverURI = ns.lookup("pipeline").asString()
     else:
         try:
             uf = open(executor.uri_file)
-            serverURI = Pyro4.URI(uf.readline())
+            # either a Pyro URI or (with --server-mode=asyncio) one of ours (see rpc.connect)
+            serverURI = uf.readline().strip()
             uf.close()
         except:
             logger.exception("Problem opening the specified uri file:")
             raise
 
-    p = Pyro4.Proxy(serverURI)
+    executor.setServerURI(serverURI)
     # Register the executor with the pipeline
-    # the following command only works if the server is alive. Currently if that's
-    # not the case, the executor will die which is okay, but this should be
-    # more properly handled: a more elegant check to verify the server is running
-    p.registerClient(clientURI.asString(), executor.mem)
+    # the following command only works if the server is alive (or comes up while
+    # we're retrying). Currently if that's not the case, the executor will die which
+    # is okay, but this should be more properly handled
+    executor.server.registerClient(clientURI.asString(), executor.mem)
 
     executor.registeredWithServer()
     executor.setClientURI(clientURI.asString())
-    executor.setServerURI(serverURI.asString())
-    executor.setProxyForServer(p)
     
     logger.info("Connected to %s",  serverURI)
     logger.info("Client URI is %s", clientURI)
@@ -96,10 +96,6 @@ def launchExecutor(executor):
     executor.connection_time_with_server = time.time()
     logger.info("Connected to the server at: %s", datetime.isoformat(datetime.now(), " "))
 
-    # you'd think this could be done in __init__, but sometimes that's in the wrong process,
-    # which causes an error when calling `join` ...
-    executor.initializePool()
-
     logger.debug("Executor daemon running at: %s", daemon.locationStr)
     try:
         # run the daemon, not the executor mainLoop, in a new thread
@@ -154,12 +150,99 @@ def stageinfo_dict_to_class(classname, d):
 
 Pyro4.util.SerializerBase.register_dict_to_class("pydpiper.execution.pipeline_executor.StageInfo",
                                                  stageinfo_dict_to_class)
+rpc.register_class(StageInfo)
 
 
 class MissingOutputs(ValueError): pass
 
+
+def maxrss_gb(rusage) -> float:
+    """The peak resident set size from a `resource.struct_rusage`, in G."""
+    # ru_maxrss is in kilobytes, except on macOS (bytes)
+    return rusage.ru_maxrss / (2**30 if sys.platform == "darwin" else 2**20)
+
+
+def wait_for_process(process):
+    """Wait for a subprocess.Popen to finish, returning its returncode and resource usage
+    (that of the process and, with shell=True, of the commands it ran).
+
+    >>> wait_for_process(subprocess.Popen("exit 3", shell=True))[0]
+    3
+    >>> ret, rusage = wait_for_process(subprocess.Popen("kill -TERM $$", shell=True))
+    >>> ret == -signal.SIGTERM, rusage.ru_maxrss > 0
+    (True, True)
+    """
+    _, status, rusage = os.wait4(process.pid, 0)
+    # we've reaped the process, so the Popen must not try to:
+    process.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+    return process.returncode, rusage
+
+
+# how long (s) the outputs of recent stages took to appear after the stages' commands finished,
+# by filesystem (device number), as an exponentially weighted moving average
+_fs_latency = {}  # type: Dict[int, float]
+FS_LATENCY_WEIGHT = 0.25  # of the latest observation
+MIN_OUTPUT_POLL_INTERVAL = 0.01
+
+
+def _updated_since(path, t):
+    try:
+        # (whole seconds since some filesystems only store those, and a coarse clock
+        # may give a file written just after `t` a slightly earlier mtime)
+        return os.stat(path).st_mtime >= m.floor(t)
+    except OSError:
+        return False
+
+
+def _fs_id(path):
+    try:
+        return os.stat(os.path.dirname(os.path.abspath(path))).st_dev
+    except OSError:
+        return None
+
+
+def wait_for_outputs(paths, start_time, max_delay):
+    """Wait until all of `paths` exist and have been modified since `start_time` (e.g., until the outputs
+    of a stage are visible over NFS), but at most `max_delay` seconds, returning those which haven't.
+    The outputs are polled with exponential backoff, starting from the time outputs on the same
+    filesystem have recently taken to appear, so on a local filesystem there's no delay at all.
+
+    >>> import tempfile
+    >>> f = os.path.join(tempfile.mkdtemp(), "out.txt")
+    >>> wait_for_outputs([f], start_time=time.time(), max_delay=0.05) == [f]
+    True
+    >>> open(f, 'w').close()
+    >>> wait_for_outputs([f], start_time=time.time(), max_delay=5)
+    []
+    """
+    waiting = [p for p in paths if not _updated_since(p, start_time)]
+    fs = _fs_id((waiting or paths)[0]) if paths and (waiting or _fs_latency) else None
+    if not waiting:
+        if fs in _fs_latency:
+            _fs_latency[fs] *= 1 - FS_LATENCY_WEIGHT
+        return []
+    t0 = time.time()
+    deadline = t0 + max_delay
+    delay = max(MIN_OUTPUT_POLL_INTERVAL, _fs_latency.get(fs, 0))
+    while waiting:
+        now = time.time()
+        if now >= deadline:
+            return waiting
+        time.sleep(min(delay, deadline - now))
+        delay *= 2
+        waiting = [p for p in waiting if not _updated_since(p, start_time)]
+    latency = time.time() - t0
+    _fs_latency[fs] = (latency if fs not in _fs_latency
+                       else FS_LATENCY_WEIGHT * latency + (1 - FS_LATENCY_WEIGHT) * _fs_latency[fs])
+    return []
+
+
 def runStage(*, clientURI    : str, stage,
-                cmd_wrapper  : str, fs_delay : float, check_outputs : bool, mkdirs : bool):
+                cmd_wrapper  : str, fs_delay : float, check_outputs : bool, mkdirs : bool,
+                on_start = None):
+        """Run a stage's command, returning its index, return code (or the exception which prevented
+        it from being run), running time, peak memory use (G) and CPU (user + system) time.
+        `on_start`, if given, is called with the PID of the command's process once it has started."""
         ix = stage.ix
 
         logger.info("Running stage %i (on %s). Memory requested: %.2f", ix, clientURI, stage.mem)
@@ -190,16 +273,17 @@ def runStage(*, clientURI    : str, stage,
                 for key in stage.env_vars.keys():
                     environment[key]=stage.env_vars[key]
 
-                process = subprocess.Popen(args, stdout=of, stderr=of, shell=True, env=environment)
-                #client.addPIDtoRunningList(process.pid)
-                process.communicate()
-                #client.removePIDfromRunningList(process.pid)
-                ret = process.returncode
+                # (in a process group of its own, so that the executor can kill everything the command
+                # runs, e.g., the tools run by a shell which doesn't `exec` them; see generalShutdownCall)
+                process = subprocess.Popen(args, stdout=of, stderr=of, shell=True, env=environment,
+                                           start_new_session=True)
+                if on_start is not None:
+                    on_start(process.pid)
+                ret, rusage = wait_for_process(process)
+                runtime = time.time() - start_time
                 if ret == 0:
-                    time.sleep(fs_delay)  # TODO: better: async wait with timeout=fs_delay on all output files?
-                    # TODO: better logic here, e.g., allow some tolerance for NFS slowness, etc.
-                    missing_outputs = [o for o in stage.output_files
-                                       if (not os.path.exists(o)) or os.path.getmtime(o) < start_time]
+                    # allow up to fs_delay seconds for the outputs to appear (e.g., on NFS)
+                    missing_outputs = wait_for_outputs(stage.output_files, start_time, max_delay=fs_delay)
                     if len(missing_outputs) > 0:
                         logger.warning("some outputs not produced by Stage %i: %s", ix, missing_outputs)
                         if check_outputs:
@@ -207,21 +291,22 @@ def runStage(*, clientURI    : str, stage,
                           raise MissingOutputs(missing_outputs)
         except Exception as e:
             logger.exception("Exception whilst running stage: %i (on %s)", ix, clientURI)
-            return ix, e
+            return ix, e, 0.0, 0.0, 0.0
         else:
             # TODO: the big try-catch block above is quite ugly ...
             logger.info("Stage %i finished, return was: %i (on %s)", ix, ret, clientURI)
 
-            return ix, ret
+            return ix, ret, runtime, maxrss_gb(rusage), rusage.ru_utime + rusage.ru_stime
 
 
 class ChildProcess(object):
     """Used by the executor to store runtime information about the child processes it initiates to run commands."""
     def __init__(self, stage, result, mem, procs):
         self.stage = stage
-        self.result = result
+        self.result = result  # the thread supervising the process
         self.mem = mem
         self.procs = procs
+        self.pid = None  # once the process has started
 
 class InsufficientResources(Exception):
     pass
@@ -245,6 +330,10 @@ class pipelineExecutor(object):
         self.pipeline_name = pipeline_name
         self.procs = options.proc
         self.ppn = options.ppn
+        # run a single executor on each (whole) node, using all its processors:
+        self.whole_node = options.whole_node_executors
+        if self.whole_node:
+            self.procs = self.ppn
         self.pe  = options.pe
         self.mem_request_attribute = options.mem_request_attribute
         self.time = options.time
@@ -272,13 +361,21 @@ class pipelineExecutor(object):
         self.time_to_accept_jobs = options.time_to_accept_jobs
         # stores the time of connection with the server
         self.connection_time_with_server = None
+        # the walltime (s) of the job the executor runs in, if submitted to a queueing system,
+        # so that the server only gives us stages we can expect to finish in time
+        self.walltime = (q.timestr_to_secs(options.time)
+                         if options.queue_type is not None and options.time else None)
+        self.start_time = time.time()
         #initialize runningMem and Procs
         self.runningMem = 0.0
         self.runningProcs = 0   
         self.runningChildren = {}  # was: # no scissors (i.e. children should not run around with sharp objects...)
+        # (index, returncode, runtime, maxrss) of stages which have terminated but
+        # haven't yet been reported to the server (see reportResults)
+        self.finished_results = []
         self.lock = Lock()
-        self.pool = None  # type: Pool
-        self.pyro_proxy_for_server = None
+        # connection(s) to the server, shared by all of the executor's threads
+        self.server = None  # type: rpc.PersistentProxy
         self.clientURI = None
         self.serverURI = None
         #self.current_running_job_pids = []
@@ -287,24 +384,22 @@ class pipelineExecutor(object):
         # in the future it might also be set by the server, and we might have more
         # than one event (for reclaiming, server messages, ...)
         self.e = threading.Event()
+        # set after each iteration of the main loop (see watchForWork)
+        self.main_loop_done = threading.Event()
         self.heartbeat_tick = 0
 
     def wrapPyroCall(self, func, *args, **kwargs):
         try:
-            # a bit expensive perhaps, but it is safer to create
-            # a new proxy for the server whenever it is contacted.
-            # We found that connecting to the server via the same proxy using several
-            # Process-es, can bring down either or both the server and the client
-            # (the documentation also states that proxies can only be shared between
-            # threads).
+            # `self.server` keeps one connection per thread (connecting via the same proxy
+            # from several threads or Process-es can bring down either or both the server
+            # and the client) and reconnects, with backoff, if the connection is lost.
             # also, note Ben and his bag of tricks! When a function on the server
             # side needs to be called, and wrapPyroCall is invoked, we do this
             # using the lambda functionality. Below the lambda p: p.call_at_the_server
-            # will pass the new proxy to p. At the same time, pycharm is still able
+            # will pass the proxy to p. At the same time, pycharm is still able
             # to type check things.
             logger.debug("wrapPyroCall: %s", func)
-            with Pyro4.Proxy(self.serverURI) as one_time_proxy:
-                return func(one_time_proxy)(*args, **kwargs)
+            return func(self.server)(*args, **kwargs)
         except:
             logger.exception("Exception while placing a Pyro call at the server: %s", func)
             raise Exception("Pyro call with the server failed. Shutting down...")
@@ -312,57 +407,50 @@ class pipelineExecutor(object):
     def registeredWithServer(self):
         self.registered_with_server = True
 
-    #@Pyro4.oneway
-    #def addPIDtoRunningList(self, pid):
-    #    self.current_running_job_pids.append(pid)
-
-    #@Pyro4.oneway
-    #def removePIDfromRunningList(self, pid):
-    #    self.current_running_job_pids.remove(pid)
-
-    def initializePool(self):
-        self.pool = Pool(processes = self.procs)
-        
     def setClientURI(self, cURI):
         self.clientURI = cURI 
             
     def setServerURI(self, sURI):
         self.serverURI = sURI
-            
-    def setProxyForServer(self, proxy):
-        self.pyro_proxy_for_server = proxy
+        self.server = rpc.PersistentProxy(sURI)
     
     # TODO rename completeAndExitChildren,generalShutdownCall to something like
     # normalShutdown, dirtyShutdown
     def generalShutdownCall(self):
-        # FIXME this comment is outdated (but is the problem described still a problem?)
-        # stop the worker processes (children) immediately without completing outstanding work
-        # Initially I wanted to stop the running processes using pool.terminate() and pool.join()
-        # but the keyboard interrupt handling proved tricky. Instead, the executor now keeps
-        # track of the process IDs (pid) of the current running jobs. Those are targeted by
-        # os.kill in order to stop the processes in the Pool
+        # stop the running jobs (children) immediately without completing outstanding work:
+        # the executor keeps track of the process IDs (pid) of the running jobs, each of which
+        # leads a process group (see runStage), which is targeted by os.killpg
         logger.info("Executor shutting down.  Killing running jobs...")
-        #for subprocID in self.current_running_job_pids:
-        #    os.kill(subprocID, signal.SIGTERM)
-        self.pool.terminate()
-        self.pool.join()
-        logger.debug("Finished joining process pool.")
-        # FIXME the death of the child process causes runStage
-        # to notify the server of the job's destruction
-        # so the job is no longer in the client's set of stages
-        # when unregisterClient is called
+        killed = set()
+        for ix, child in list(self.runningChildren.items()):
+            if child.pid is not None:
+                try:
+                    os.killpg(child.pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass  # already finished
+                else:
+                    killed.add(ix)
+        self.joinChildren()
+        logger.debug("Finished waiting for running jobs.")
+        # don't report the jobs we killed as failed, which would use up their retries: on unregistering,
+        # the server considers the stages still running on the executor lost, and runs them again
+        with self.lock:
+            self.finished_results = [r for r in self.finished_results if r[0] not in killed]
         self.unregister_with_server()
 
     def completeAndExitChildren(self):
         # This function is called under normal circumstances (i.e., not because
-        # of a keyboard interrupt). So we can close the pool of processes 
-        # in the normal way, prevent more jobs from starting, and exit
+        # of a keyboard interrupt). So we can wait for the running jobs
+        # in the normal way and exit (no more jobs will be started)
         self.unregister_with_server()
         if len(self.runningChildren) > 0:
             logger.warning("Exiting with some processes still running: %s" % self.runningChildren)
-        # wait for the worker processes (children) to exit (must be called after terminate() or close())
-        self.pool.close()
-        self.pool.join()
+        self.joinChildren()
+
+    def joinChildren(self):
+        """Wait for all running jobs (children) to exit."""
+        for child in list(self.runningChildren.values()):
+            child.result.join()
 
     def unregister_with_server(self):
         if self.registered_with_server:
@@ -376,11 +464,15 @@ class pipelineExecutor(object):
             # since the server runs single-threaded)
             logger.info("Unsetting the registered-with-the-server flag for executor: %s", self.clientURI)
             self.registered_with_server = False
+            self.reportResults()
             self.wrapPyroCall(lambda p: p.unregisterClient, self.clientURI)
             logger.info("Done calling unregisterClient")
+        if self.server is not None:
+            self.server.close()
 
     def submitToQueue(self, number):
-        """Submits to queueing system using qbatch"""
+        """Submits `number` executors to the queueing system using qbatch, as a single job array
+        with one executor per task"""
         # TODO it would be best if we could get this information from qbatch:
         supported = ['sge', 'pbs', 'slurm', None]
         if self.queue_type not in supported:
@@ -398,9 +490,11 @@ class pipelineExecutor(object):
         cmd = ((self.executor_wrapper.split() if self.executor_wrapper else [])
                + (["pipeline_executor.py", "--local",
                    '--uri-file', self.uri_file,
-                   # Only one exec is launched at a time in this manner, so:
+                   # Only one exec is launched per task in this manner, so:
                    "--num-executors", str(1), '--mem', str(self.mem)]
-                   + q.remove_flags(['--num-exec', '--mem'], sys.argv[1:])))
+                   + (["--proc", str(self.procs)] if self.whole_node else [])
+                   + q.remove_flags(['--num-exec', '--mem'] + (['--proc'] if self.whole_node else []),
+                                    sys.argv[1:])))
 
             #     header = '\n'.join(["#!/usr/bin/env bash",
             #                         "setenv PYRO_LOGFILE logs/%s-${JOB_ID}-${SGE_TASK_ID}.log" % ident])
@@ -414,16 +508,16 @@ class pipelineExecutor(object):
             #     # NOTE there's a problem with argparse's prefix matching which
             #     # also affects removal of --num-executors
             # TODO: procs! ppn! umask for log files? log file names? (see version 2.0.8)
-        if self.ppn > 1:
-            logger.warning("ppn of %d currently ignored in this configuration" % self.ppn)
+        if self.ppn > 1 and not self.whole_node:
+            logger.warning("ppn of %d currently ignored in this configuration (see --whole-node-executors)" % self.ppn)
         cmd_str = ' '.join(cmd)
         script = '\n'.join([cmd_str for _ in range(number)])
         submit_cmd = (["qbatch",
                        "--chunksize=1",
-                       "--cores=1",      # qbatch should run each executor as a separate job
+                       "--cores=1",      # qbatch should run each executor as a separate task of the array
                        "--jobname=%s" % ident,  # TODO -- add more identification?
-                       #"--ppj=%s", self.ppn,
                        "--mem=%sGB" % m.ceil(self.mem)]  # some schedulers don't like floats
+                       + (["--ppj=%d" % self.ppn] if self.whole_node else [])
                        # TODO expose the rest of qbatch's options here (e.g. --footer, etc.?)
                        # the following options aren't really needed if qbatch is configured separately:
                        + (["-b", self.queue_type] if self.queue_type else [])
@@ -467,6 +561,12 @@ class pipelineExecutor(object):
                 return True
         return False
 
+    def walltime_left(self):
+        """The number of seconds until the queueing system kills us, or None if unlimited."""
+        if self.walltime is None:
+            return None
+        return max(self.walltime - (time.time() - self.start_time), 0)
+
     # TODO do this cleanup in the callback!
     #def free_resources(self):
     #    # Free up resources from any completed (successful or otherwise) stages
@@ -477,24 +577,15 @@ class pipelineExecutor(object):
     #            self.runningProcs -= child.procs
     #            self.runningChildren.remove(child)
 
-    #@Pyro4.oneway
-    def notifyStageTerminated(self, i, returncode=None):
-        #try:
-            if returncode == 0:
-                logger.debug("Setting stage %d finished on the server side", i)
-                self.wrapPyroCall(lambda p: p.setStageFinished, i, self.clientURI)
-                logger.debug("Done setting stage finished")
-            else:
-                # a None returncode is also considered a failure
-                logger.debug("Setting stage %d failed on the server side. Return code: %s", i, returncode)
-                self.wrapPyroCall(lambda p: p.setStageFailed, i, self.clientURI)
-                logger.debug("Done setting stage failed")
-            # the server may have shutdown or otherwise become unavailable
-            # (currently this is expected when a long-running job completes;
-            # we should add a more elegant check for this state of affairs),
-            # but the executor may have running jobs that shouldn't be killed
-            # TODO add similar error handling around certain other Pyro calls)
-            self.e.set()  # some work finished and server notified, so wake up
+    def reportResults(self):
+        """Send the results of all stages which have terminated since the last call
+        to the server in a single batch."""
+        with self.lock:
+            results, self.finished_results = self.finished_results, []
+        if results:
+            logger.debug("Reporting results of stages %s to the server", [r[0] for r in results])
+            self.wrapPyroCall(lambda p: p.report, self.clientURI, results)
+            logger.debug("Done reporting results")
 
     def idle(self):
         return self.runningMem == 0 and self.runningProcs == 0 and self.prev_time
@@ -502,11 +593,48 @@ class pipelineExecutor(object):
     # use an event set/timeout system to run the executor mainLoop -
     # we might want to pass some extra information in addition to waking the system
     def mainLoop(self):
+        if self.serverURI.startswith(rpc.URI_PREFIX):
+            # the server can tell us as soon as there's work (see watchForWork)
+            w = threading.Thread(target=self.watchForWork)
+            w.daemon = True
+            w.start()
         while self.mainFn():
+            self.main_loop_done.set()
             self.e.wait(EXECUTOR_MAIN_LOOP_INTERVAL)
             self.e.clear()
+        self.main_loop_done.set()
         logger.info("Main loop finished")
 
+    def watchForWork(self):
+        """Wait at the server for a runnable stage fitting into our free resources and wake the
+        main loop as soon as there is one, rather than it only asking every EXECUTOR_MAIN_LOOP_INTERVAL
+        seconds (or when one of our own stages finishes)."""
+        while self.registered_with_server:
+            mem_free, procs_free = self.mem - self.runningMem, self.procs - self.runningProcs
+            work = False
+            if mem_free > 0 and procs_free > 0:
+                try:
+                    work = self.server.waitForWork(self.clientURI, mem_free, procs_free,
+                                                   timeout=EXECUTOR_MAIN_LOOP_INTERVAL,
+                                                   walltime_left=self.walltime_left())
+                except Exception:
+                    if self.registered_with_server:
+                        logger.exception("Error while waiting for work from the server")
+                    return
+            if work or mem_free <= 0 or procs_free <= 0:
+                # wait for the main loop to get the work (or, if we're full, for a stage to
+                # finish) so we don't ask again for the same stage(s)
+                self.main_loop_done.clear()
+                if work:
+                    self.e.set()
+                self.main_loop_done.wait(EXECUTOR_MAIN_LOOP_INTERVAL)
+
+    def sendHeartbeat(self):
+        logger.debug("Updating timestamp with heartbeat tick: %d", self.heartbeat_tick)
+        self.wrapPyroCall(lambda p: p.updateClientTimestamp, self.clientURI, tick=self.heartbeat_tick)
+        self.heartbeat_tick += 1
+        logger.debug("Done updating timestamp")
+
     def mainFn(self):
         """Try to get a job from the server (if appropriate) and update
         internal state accordingly.  Return True if it should be called
@@ -517,7 +645,7 @@ class pipelineExecutor(object):
         self.current_time = time.time()
 
         # a bit coarse but we can't call `free_resources` directly in a function
-        # such as notifyStageTerminated which is called from _within_ `runStage`
+        # such as process_result which is called from _within_ `runStage`
         # since resources won't be freed soon enough, causing a false resource starvation.
         # note we don't do resource accounting after leaving mainLoop, though that
         # doesn't matter too much as there will never be new jobs
@@ -525,10 +653,9 @@ class pipelineExecutor(object):
         # to other servers)
         #self.free_resources()
 
-        logger.debug("Updating timestamp with heartbeat tick: %d", self.heartbeat_tick)
-        self.wrapPyroCall(lambda p: p.updateClientTimestamp, self.clientURI, tick=self.heartbeat_tick)
-        self.heartbeat_tick += 1
-        logger.debug("Done updating timestamp")
+        # tell the server about any finished stages before asking for more
+        # (as their successors may have become runnable)
+        self.reportResults()
 
         if self.idle():
             self.idle_time += self.current_time - self.prev_time
@@ -546,18 +673,23 @@ class pipelineExecutor(object):
             logger.debug("Time expired for accepting new jobs")  #...leaving main loop.")
             # was logger.info; made this a debug since we currently don't bail out of the loop ...
             #return False
+            self.sendHeartbeat()
             return True
 
-        # TODO we get only one stage per loop iteration, so we have to wait for
-        # another event/timeout to get another.  In general we might want 
-        # getCommand to order multiple stages to be run on the same server
-        # (just setting the event immediately would be somewhat hackish)
-        # FIXME send/get the whole stageinfo here (it contains an `ix` field, right?)?!
-        logger.debug("Going to get command from server")
-        cmd, i = self.wrapPyroCall(lambda p: p.getCommand, clientURIstr=self.clientURI,
+        # ask for as many stages as could possibly fit (each needs at least one processor),
+        # so that a fresh executor fills up in a single round trip; the server marks them as
+        # started on our behalf (and takes the call as a heartbeat), giving us only stages
+        # which can be expected to finish before our walltime runs out
+        # (the tick identifies the request, so that the call can safely be retried if the reply is lost)
+        logger.debug("Going to claim stages from server")
+        cmd, stages = self.wrapPyroCall(lambda p: p.claim, clientURI=self.clientURI,
                                                            clientMemFree=self.mem - self.runningMem,
-                                                           clientProcsFree=self.procs - self.runningProcs)
-        logger.debug("Done getting command from server")
+                                                           clientProcsFree=self.procs - self.runningProcs,
+                                                           max_n=self.procs - self.runningProcs,
+                                                           walltime_left=self.walltime_left(),
+                                                           request_id=self.heartbeat_tick)
+        self.heartbeat_tick += 1
+        logger.debug("Done claiming stages from server")
 
         if cmd == "shutdown_normally":
             logger.info('Saw shutdown command from server')
@@ -568,60 +700,55 @@ class pipelineExecutor(object):
         elif cmd == "wait":
             return True
         elif cmd == "run_stage":
-            logger.debug("Going to get stage info for stage: %d", i)
-            stage = self.wrapPyroCall(lambda p: p.get_stage_info,i)
-            logger.debug("Done getting stage information for stage: %d", i)
-            # we trust that the server has given us a stage
+            # we trust that the server has given us stages
             # that we have enough memory and processors to run ...
             # reset the idle time, we are running a stage!
             self.idle_time = 0
-            with self.lock:
-                self.runningMem += stage.mem
-                self.runningProcs += stage.procs
-            # The multiprocessing library must pickle things in order to execute them.
-            # I wanted the following function (runStage) to be a function of the pipelineExecutor
-            # class. That way we can access self.serverURI and self.clientURI from
-            # within the function. However, bound methods are not picklable (a bound method
-            # is a method that has "self" as its first argument, because if I understand 
-            # this correctly, that binds the function to a class instance). There is
-            # a way to make a bound function picklable, but this seems cumbersome. So instead
-            # runStage is now a standalone function.
-
-            # callback for result of runStage, run by executor
-            def process_result(result):
-                ix, res = result
-                if isinstance(res, int):
-                    # it's a return code
-                    # don't do this logging in the callback for politeness
-                    self.notifyStageTerminated(ix, res)
-                elif isinstance(res, Exception):
-                    # runStage raised an exception.  We could use apply_async's error_callback to handle this case
-                    # instead, but we need to know the index of the stage we were attempting to run, so we'd have
-                    # to catch the exception anyway to stuff the index into it ... this seems cleaner (no re-raising).
-                    self.notifyStageTerminated(ix)
-                logger.debug("Freeing up resources for stage %i.", ix)
-                stage = self.runningChildren[ix]
-                with self.lock:
-                    self.runningMem -= stage.mem
-                    self.runningProcs -= stage.procs
-                del self.runningChildren[ix]
-
-            # why does this need a separate call? should be able to infer that this stage will start from getCommand...
-            logger.debug("Telling the server that stage %d has started", i)
-            self.wrapPyroCall(lambda p: p.setStageStarted, i, self.clientURI)
-            logger.debug("Server knows that stage started")
-            result = self.pool.apply_async(runStage, args=(),
-                                           kwds={ "clientURI" : self.clientURI, "stage" : stage,
-                                                  "cmd_wrapper" : self.cmd_wrapper,
-                                                  "fs_delay" : self.fs_delay, "check_outputs" : self.check_outputs,
-                                                  "mkdirs" : self.defer_directory_creation },
-                                           callback=process_result)
-            self.runningChildren[i] = ChildProcess(i, result, stage.mem, stage.procs)
-
-            logger.debug("Added stage %i to the running pool.", i)
+            for stage in stages:
+                self.launchStage(stage)
             return True
         else:
             raise Exception("Got invalid cmd from server: %s" % cmd)
+
+    def launchStage(self, stage):
+        """Start a stage handed out by the server and update resource accounting.
+        The stage's command is run directly from this process, supervised by a thread which
+        waits for it (so a stage costs a single process however many processors it uses;
+        the processors and memory in use are accounted for by runningProcs/runningMem)."""
+        i = stage.ix
+        with self.lock:
+            self.runningMem += stage.mem
+            self.runningProcs += stage.procs
+        child = ChildProcess(i, None, stage.mem, stage.procs)
+
+        def on_start(pid):
+            child.pid = pid
+
+        def supervise():
+            ix, res, runtime, maxrss, cputime = runStage(clientURI=self.clientURI, stage=stage,
+                                                         cmd_wrapper=self.cmd_wrapper, fs_delay=self.fs_delay,
+                                                         check_outputs=self.check_outputs,
+                                                         mkdirs=self.defer_directory_creation, on_start=on_start)
+            # runStage may have raised an exception (returned in place of the return code),
+            # in which case the stage has failed
+            returncode = res if isinstance(res, int) else None
+            logger.debug("Freeing up resources for stage %i.", ix)
+            child.pid = None
+            with self.lock:
+                self.runningMem -= stage.mem
+                self.runningProcs -= stage.procs
+                # the main loop reports this (along with any other finished stages) to the server
+                self.finished_results.append((ix, returncode, runtime, maxrss, cputime))
+                del self.runningChildren[ix]
+            self.e.set()  # some work finished, so wake up
+
+        # (the server has already marked the stage as started when handing it out)
+        child.result = threading.Thread(target=supervise, name="stage-%d" % i)
+        child.result.daemon = True
+        self.runningChildren[i] = child
+        child.result.start()
+
+        logger.debug("Started stage %i.", i)
                 
 
 def main():
@@ -670,13 +797,11 @@ def main():
         local_launch(options)
     elif options.submit_server:
         roq = q.runOnQueueingSystem(options, sysArgs=sys.argv)
-        for i in range(options.num_exec):
-            roq.createAndSubmitExecutorJobFile(i, after=None,
-                                               time=q.timestr_to_secs(options.time))
+        roq.createAndSubmitExecutorArray(options.num_exec, after=None,
+                                         time=q.timestr_to_secs(options.time))
     elif options.queue_type is not None:
-        for i in range(options.num_exec):
-            pe = pipelineExecutor(options=options, uri_file=options.urifile, pipeline_name="anon-executor")
-            pe.submitToQueue(1)  # TODO is there a reason why we have logic for submitting `i` executors again here?
+        pe = pipelineExecutor(options=options, uri_file=options.urifile, pipeline_name="anon-executor")
+        pe.submitToQueue(options.num_exec)
     else:
         local_launch(options)
 
@@ -0,0 +1,157 @@
+"""
+Opt-in instrumentation of the pipeline server (--profile-server), for finding out which of its
+methods take up its time under load.
+
+`ServerProfile.instrument` replaces each public method of the pipeline with a wrapper which
+records how long the call took in a per-method latency histogram.  Only outermost calls are
+recorded, so that, e.g., the time `report` spends in `setStageFinished` (and in the latter's hooks
+and journal writes) is attributed to `report`, which is what the executor waited for; for methods
+returning an awaitable (e.g., `waitForWork`), only the time until the awaitable is returned counts.
+
+In addition, a signal (SIGUSR1) starts a cProfile profile and tracemalloc memory tracing of the
+server, and the next one stops them and writes their results to the pipeline's output directory.
+"""
+
+import bisect
+import cProfile
+import functools
+import inspect
+import json
+import logging
+import os
+import pstats
+import time
+import tracemalloc
+
+from array import array
+from typing import Any, Dict, List, Optional
+
+logger = logging  # type: Any
+
+# upper bounds (in seconds) of the latency histograms' buckets: 10us, 20us, ..., about 84s (and beyond)
+BUCKETS = [1e-5 * 2 ** k for k in range(24)]
+# number of lines of the cProfile and tracemalloc reports
+REPORT_LINES = 50
+
+
+class LatencyHistogram(object):
+    """Counts of call durations by (exponentially growing) bucket.
+
+    >>> h = LatencyHistogram()
+    >>> for t in [0.001] * 98 + [0.5, 2.0]: h.add(t)
+    >>> h.count, round(h.total, 3), h.max, round(h.quantile(0.5), 6), round(h.quantile(0.99), 6)
+    (100, 2.598, 2.0, 0.00128, 0.65536)
+    """
+    def __init__(self) -> None:
+        self.counts = array('l', bytes(array('l').itemsize * (len(BUCKETS) + 1)))
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, t: float) -> None:
+        self.counts[bisect.bisect_left(BUCKETS, t)] += 1
+        self.count += 1
+        self.total += t
+        if t > self.max:
+            self.max = t
+
+    def quantile(self, q: float) -> float:
+        """An upper bound (the bucket boundary) for the `q` quantile of the durations."""
+        rank, seen = q * self.count, 0
+        for bound, n in zip(BUCKETS, self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return self.max
+
+    def summary(self) -> Dict[str, float]:
+        return dict(calls=self.count, total=self.total, mean=self.total / self.count if self.count else 0.0,
+                    max=self.max, p50=self.quantile(0.5), p90=self.quantile(0.9), p99=self.quantile(0.99))
+
+
+class ServerProfile(object):
+    """Latency histograms of the calls of an object's methods, plus cProfile/tracemalloc snapshots on request."""
+    def __init__(self) -> None:
+        self.histograms = {}  # type: Dict[str, LatencyHistogram]
+        self.started = time.time()
+        self._depth = 0
+        self._profiler = None  # type: Optional[cProfile.Profile]
+        self._snapshots = 0
+
+    def _wrap(self, name: str, method):
+        histogram = self.histograms.setdefault(name, LatencyHistogram())
+
+        @functools.wraps(method)
+        def timed(*args, **kwargs):
+            if self._depth:
+                return method(*args, **kwargs)
+            self._depth += 1
+            t0 = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                histogram.add(time.perf_counter() - t0)
+                self._depth -= 1
+        return timed
+
+    def instrument(self, obj) -> None:
+        """Time the calls of each of `obj`'s public methods (by replacing them with wrappers on the instance)."""
+        for name, method in inspect.getmembers(obj, inspect.ismethod):
+            if not name.startswith('_'):
+                setattr(obj, name, self._wrap(name, method))
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        """Per method called at least once: the number of calls and their total, mean, maximum and
+        (upper bounds of the) median, 90th and 99th percentile durations in seconds."""
+        return {name: h.summary() for name, h in sorted(self.histograms.items()) if h.count}
+
+    def format_summary(self) -> str:
+        rows = ["%-32s %10s %10s %10s %10s %10s %10s" % ("method", "calls", "total (s)", "mean (ms)",
+                                                         "p50 (ms)", "p99 (ms)", "max (ms)")]
+        for name, s in sorted(self.summary().items(), key=lambda kv: -kv[1]["total"]):
+            rows.append("%-32s %10d %10.2f %10.3f %10.3f %10.3f %10.3f"
+                        % (name[:32], s["calls"], s["total"], 1e3 * s["mean"], 1e3 * s["p50"],
+                           1e3 * s["p99"], 1e3 * s["max"]))
+        return "\n".join(rows)
+
+    def write(self, path: str) -> None:
+        """Write the latency histograms (with their bucket bounds) and their summaries to `path` as JSON."""
+        with open(path, 'w') as fh:
+            json.dump(dict(started=self.started, finished=time.time(), buckets=BUCKETS,
+                           methods={name: dict(h.summary(), counts=list(h.counts))
+                                    for name, h in sorted(self.histograms.items()) if h.count}),
+                      fh, indent=1)
+
+    def toggle_snapshot(self, prefix: str) -> None:
+        """Start profiling (with cProfile) and tracing memory allocations (with tracemalloc), or,
+        if already started, stop and write reports to `prefix` + ".<n>.prof" (for pstats/snakeviz),
+        ".<n>.txt" (the most expensive functions) and ".<n>.memory.txt" (the largest allocations)."""
+        if self._profiler is None:
+            logger.info("Starting to profile the server")
+            tracemalloc.start()
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+            return
+        self._profiler.disable()
+        profiler, self._profiler = self._profiler, None
+        memory = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        self._snapshots += 1
+        base = "%s.%d" % (prefix, self._snapshots)
+        try:
+            profiler.dump_stats(base + ".prof")
+            with open(base + ".txt", 'w') as fh:
+                pstats.Stats(profiler, stream=fh).sort_stats("cumulative").print_stats(REPORT_LINES)
+            with open(base + ".memory.txt", 'w') as fh:
+                for stat in memory.statistics("lineno")[:REPORT_LINES]:
+                    fh.write("%s\n" % stat)
+        except OSError:
+            logger.exception("Couldn't write the server profile")
+        else:
+            logger.info("Wrote the server profile to %s.{prof,txt,memory.txt}", base)
+
+
+def profile_paths(directory: str, pipeline_name: str) -> List[str]:
+    """The file for the latency histograms, and the prefix for the cProfile/tracemalloc reports."""
+    return [os.path.join(directory, pipeline_name + "_server_latency.json"),
+            os.path.join(directory, pipeline_name + "_server_profile")]
@@ -55,6 +55,7 @@ class runOnQueueingSystem():
         self.min_walltime = options.execution.min_walltime
         self.procs = options.execution.proc
         self.ppn = options.execution.ppn
+        self.whole_node = options.execution.whole_node_executors
         self.queue_name = options.execution.queue_name or options.execution.queue
         self.queue_type = options.execution.queue_type
         self.executor_start_delay = options.execution.executor_start_delay
@@ -85,13 +86,14 @@ class runOnQueueingSystem():
         reconstruct += " --local --num-executors=1 --max-idle-time=%d " \
                          % self.max_walltime
         return reconstruct
-    def constructAndSubmitJobFile(self, identifier, time, isMainFile, after=None, afterany=None):
-        """Construct the bulk of the pbs script to be submitted via qsub"""
+    def constructAndSubmitJobFile(self, identifier, time, isMainFile, after=None, afterany=None, array_size=None):
+        """Construct the bulk of the pbs script to be submitted via qsub
+        (as a job array of `array_size` tasks, if given)"""
         now = datetime.now()  
         jobName = self.jobName + identifier + now.strftime("%Y%m%d-%H%M%S%f") + ".job"
         self.jobFileName = os.path.join(self.jobDir, jobName)
         self.jobFile = open(self.jobFileName, "w")
-        self.addHeaderAndCommands(time, isMainFile)
+        self.addHeaderAndCommands(time, isMainFile, array_size=array_size)
         self.completeJobFile()
         jobId = self.submitJob(jobName, after, afterany)
         return jobId
@@ -110,18 +112,22 @@ class runOnQueueingSystem():
             except AttributeError:
                 pass
             if self.numexec >= 2:
-                for i in range(1, self.numexec):
-                    self.createAndSubmitExecutorJobFile(i, time=t, after=serverJobId)
+                # (a single submission rather than one per executor)
+                self.createAndSubmitExecutorArray(self.numexec - 1, time=t, after=serverJobId)
             # in principle a server could overlap the previous generation of clients,
             # but at present the clients just die within seconds
     def createAndSubmitMainJobFile(self,time, afterany=None):
         return self.constructAndSubmitJobFile("-pipeline-",time, isMainFile=True, afterany=afterany)
     def createAndSubmitExecutorJobFile(self, i, time, after):
-        # This is called directly from pipeline_executor
-        # For multiple executors, this will be called multiple times.
+        # For multiple executors, this will be called multiple times
+        # (see createAndSubmitExecutorArray).
         execId = "-executor-" + str(i) + "-"
         self.constructAndSubmitJobFile(execId, time, isMainFile=False, after=after)
-    def addHeaderAndCommands(self, time, isMainFile):
+    def createAndSubmitExecutorArray(self, number, time, after):
+        # This is called directly from pipeline_executor
+        # Submits `number` executors as a single job array (one executor per task).
+        self.constructAndSubmitJobFile("-executors-", time, isMainFile=False, after=after, array_size=number)
+    def addHeaderAndCommands(self, time, isMainFile, array_size=None):
         """Constructs header and commands for pbs script, based on options input from calling program"""
         self.jobFile.write("#!/bin/bash\n")
         requestNodes = 1
@@ -150,6 +156,8 @@ class runOnQueueingSystem():
         timestr = "%d:%02d:%02d" % (h,m,s)
         self.jobFile.write("#PBS -l nodes=%d:ppn=%d,walltime=%s\n" % (requestNodes, self.ppn, timestr))
         self.jobFile.write("#PBS -N %s\n" % name)
+        if array_size is not None:
+            self.jobFile.write("#PBS -t 1-%d\n" % array_size)
         self.jobFile.write("#PBS -q %s\n" % self.queue_name)
         if self.prologue_file is not None:
             try:
@@ -171,7 +179,12 @@ class runOnQueueingSystem():
             # provide the pipeline_executor with the uri_file that
             # the server will use
             cmd = "pipeline_executor.py --local --num-executors=1 --uri-file " + self.uri_file + " "
-            cmd += ' '.join(remove_flags(['--num-exec'], self.arguments[1:]))
+            if self.whole_node:
+                # use all of the node's processors
+                cmd += "--proc=%d " % self.ppn
+                cmd += ' '.join(remove_flags(['--num-exec', '--proc'], self.arguments[1:]))
+            else:
+                cmd += ' '.join(remove_flags(['--num-exec'], self.arguments[1:]))
             cmd += ' &\n\n'
             self.jobFile.write(cmd)
     def completeJobFile(self):
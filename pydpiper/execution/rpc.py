@@ -0,0 +1,362 @@
+"""
+A small RPC protocol used between the pipeline server and its executors (and check_pipeline_status.py)
+when the server runs in asyncio mode (--server-mode=asyncio) rather than as a Pyro daemon.
+
+Messages are JSON objects, each preceded by its length (4 bytes, big-endian), sent over TCP.
+A request {"id": n, "method": name, "args": [...], "kwargs": {...}} is answered by
+{"id": n, "result": ...} or {"id": n, "error": [exception type, message]}.  Tuples arrive as lists
+and sets as lists; instances of classes registered with `register_class` (such as StageInfo)
+are sent as dictionaries of their attributes together with a "__class__" key.
+
+The server calls methods of a single object, one request at a time per connection, from an
+asyncio event loop; a method may return an awaitable (e.g., to respond once work is available)
+without blocking the requests of other connections.
+
+Use `connect` to get a proxy for either kind of server from the contents of its URI file,
+or `PersistentProxy` for long-lived, reconnecting connections.
+"""
+
+import asyncio
+import functools
+import inspect
+import itertools
+import json
+import logging
+import socket
+import struct
+import threading
+import time
+
+from typing import Any, Callable, Dict, Optional, Tuple
+
+logger = logging  # type: Any
+
+URI_PREFIX = "PYDPIPER:"
+HEADER = struct.Struct(">I")
+MAX_MESSAGE_SIZE = 2**31
+
+
+class CommunicationError(ConnectionError):
+    """The connection to the server was lost (or could not be established)."""
+
+
+class RemoteError(Exception):
+    """An exception raised by the remote method."""
+    def __init__(self, type_name: str, message: str) -> None:
+        super().__init__("%s: %s" % (type_name, message))
+        self.type_name = type_name
+
+
+_classes = {}  # type: Dict[str, Callable[..., Any]]
+
+
+def _class_name(cls) -> str:
+    return cls.__module__ + "." + cls.__qualname__
+
+
+def register_class(cls) -> None:
+    """Send instances of `cls` as dictionaries of their attributes, re-creating them at the other
+    end as cls(**attributes), so cls must be defined (and registered) at both ends."""
+    _classes[_class_name(cls)] = cls
+
+
+def _encode_default(obj):
+    if _class_name(type(obj)) in _classes:
+        d = dict(vars(obj))
+        d["__class__"] = _class_name(type(obj))
+        return d
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    # e.g., arrays
+    try:
+        return list(obj)
+    except TypeError:
+        raise TypeError("can't send object of type %s" % type(obj).__name__)
+
+
+def _decode_object(d):
+    name = d.pop("__class__", None)
+    if name is None:
+        return d
+    return _classes[name](**d)
+
+
+def encode(msg) -> bytes:
+    """
+    >>> decode(encode({"id": 1, "result": ({1, 2}, (3.0, 'a'))})[HEADER.size:])
+    {'id': 1, 'result': [[1, 2], [3.0, 'a']]}
+    """
+    body = json.dumps(msg, default=_encode_default, separators=(',', ':')).encode()
+    return HEADER.pack(len(body)) + body
+
+
+def decode(body: bytes):
+    return json.loads(body.decode(), object_hook=_decode_object)
+
+
+def format_uri(host: str, port: int) -> str:
+    return "%s%s:%d" % (URI_PREFIX, host, port)
+
+
+def parse_uri(uri: str) -> Tuple[str, int]:
+    """
+    >>> parse_uri(format_uri("10.0.0.1", 4000))
+    ('10.0.0.1', 4000)
+    """
+    if not uri.startswith(URI_PREFIX):
+        raise ValueError("not a %s URI: %s" % (URI_PREFIX, uri))
+    host, port = uri[len(URI_PREFIX):].strip().rsplit(':', 1)
+    return host, int(port)
+
+
+def _recv_exactly(sock: socket.socket, n: int) -> bytes:
+    buf = bytearray()
+    while len(buf) < n:
+        chunk = sock.recv(n - len(buf))
+        if not chunk:
+            raise CommunicationError("connection closed by the server")
+        buf += chunk
+    return bytes(buf)
+
+
+class Proxy(object):
+    """A connection to an RPC server: `proxy.f(*args, **kwargs)` calls method `f` of the served object.
+    Calls from different threads are serialized."""
+    def __init__(self, uri: str, timeout: Optional[float] = None) -> None:
+        self._uri = uri
+        self._address = parse_uri(uri)
+        self._timeout = timeout
+        self._sock = None  # type: Optional[socket.socket]
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+
+    def _connect(self) -> None:
+        try:
+            self._sock = socket.create_connection(self._address, timeout=self._timeout)
+        except OSError as e:
+            raise CommunicationError("can't connect to %s: %s" % (self._uri, e))
+        self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def _call(self, method: str, *args, **kwargs):
+        with self._lock:
+            if self._sock is None:
+                self._connect()
+            msg_id = next(self._ids)
+            try:
+                self._sock.sendall(encode({"id": msg_id, "method": method, "args": args, "kwargs": kwargs}))
+                size, = HEADER.unpack(_recv_exactly(self._sock, HEADER.size))
+                response = decode(_recv_exactly(self._sock, size))
+            except (OSError, ValueError) as e:
+                # (ValueError: a garbled response) we can't tell what state the connection is in,
+                # so start over with a new one next time
+                self._close()
+                if isinstance(e, CommunicationError):
+                    raise
+                raise CommunicationError("call of %s at %s failed: %s" % (method, self._uri, e))
+            if response.get("id") != msg_id:
+                self._close()
+                raise CommunicationError("unexpected response from %s" % self._uri)
+        if "error" in response:
+            raise RemoteError(*response["error"])
+        return response["result"]
+
+    def __getattr__(self, name: str):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return functools.partial(self._call, name)
+
+    def _close(self) -> None:
+        if self._sock is not None:
+            try:
+                self._sock.close()
+            finally:
+                self._sock = None
+
+    def _release(self) -> None:
+        """Close the connection (as Pyro4.Proxy._pyroRelease); it is reopened by the next call."""
+        with self._lock:
+            self._close()
+
+    def __del__(self):
+        self._close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_exc):
+        self._release()
+
+
+def connect(uri: str):
+    """A proxy for the pipeline server at `uri`, which may be either a Pyro URI or one of ours."""
+    uri = str(uri).strip()
+    if uri.startswith(URI_PREFIX):
+        return Proxy(uri)
+    import Pyro4  # type: ignore
+    return Pyro4.Proxy(uri)
+
+
+def _release(proxy) -> None:
+    if isinstance(proxy, Proxy):
+        proxy._release()
+    else:
+        proxy._pyroRelease()
+
+
+class PersistentProxy(object):
+    """Like `connect(uri)`, but keeping a connection open for each thread which uses it (as Pyro
+    proxies can't be shared between threads) rather than connecting for every call.  If a call fails
+    due to a communication problem, the connection is re-established and the call retried up to
+    `retries` times, waiting `backoff` seconds before the first retry and twice as long before each
+    subsequent one (up to `max_backoff`).  Note that a retried call may have reached the server
+    the first time, so only methods which are safe to repeat (such as `Pipeline.claim` given a
+    request id, but not `Pipeline.getCommands`) should be called through it."""
+    def __init__(self, uri: str, retries: int = 5, backoff: float = 1.0, max_backoff: float = 30.0) -> None:
+        import Pyro4  # type: ignore
+        self.uri = str(uri).strip()
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._errors = (CommunicationError, Pyro4.errors.CommunicationError)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._proxies = []  # type: list
+
+    def _proxy(self):
+        proxy = getattr(self._local, "proxy", None)
+        if proxy is None:
+            proxy = self._local.proxy = connect(self.uri)
+            with self._lock:
+                self._proxies.append(proxy)
+        return proxy
+
+    def _discard(self) -> None:
+        proxy = getattr(self._local, "proxy", None)
+        if proxy is not None:
+            self._local.proxy = None
+            with self._lock:
+                self._proxies.remove(proxy)
+            try:
+                _release(proxy)
+            except Exception:
+                pass
+
+    def _call(self, method: str, *args, **kwargs):
+        delay = self.backoff
+        for attempt in itertools.count():
+            try:
+                return getattr(self._proxy(), method)(*args, **kwargs)
+            except self._errors as e:
+                self._discard()
+                if attempt >= self.retries:
+                    raise
+                logger.warning("Call of %s at the server failed (%s); reconnecting in %.1fs", method, e, delay)
+                time.sleep(delay)
+                delay = min(2 * delay, self.max_backoff)
+
+    def __getattr__(self, name: str):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return functools.partial(self._call, name)
+
+    def close(self) -> None:
+        """Close the connections of all threads."""
+        with self._lock:
+            proxies, self._proxies = self._proxies, []
+        for proxy in proxies:
+            try:
+                _release(proxy)
+            except Exception:
+                pass
+        self._local = threading.local()
+
+
+_current_task = getattr(asyncio, "current_task", None) or asyncio.Task.current_task  # Python < 3.7
+
+
+class Server(object):
+    """Serve the public methods of `obj` from the current asyncio event loop.
+
+    >>> class Adder(object):
+    ...     def add(self, x, y):
+    ...         return x + y
+    ...     async def later(self, x):
+    ...         await asyncio.sleep(0)
+    ...         return x
+    >>> loop = asyncio.new_event_loop()
+    >>> server = Server(Adder(), host="127.0.0.1")
+    >>> loop.run_until_complete(server.start())
+    >>> p = Proxy(server.uri)
+    >>> call = lambda f: loop.run_until_complete(loop.run_in_executor(None, f))  # the loop must keep running
+    >>> call(lambda: (p.add(1, y=2), p.later((1, 2))))
+    (3, [1, 2])
+    >>> call(lambda: p.add(None, 2))
+    Traceback (most recent call last):
+    ...
+    pydpiper.execution.rpc.RemoteError: TypeError: unsupported operand type(s) for +: 'NoneType' and 'int'
+    >>> p._release(); loop.run_until_complete(server.close()); loop.close()
+    """
+    def __init__(self, obj, host: str, port: int = 0) -> None:
+        self.obj = obj
+        self.host = host
+        self.port = port
+        self.uri = None  # type: Optional[str]
+        self._server = None  # type: Any
+        self._connections = {}  # type: Dict[asyncio.Task, asyncio.StreamWriter]  # by the task serving each
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(self._handle_connection, host=self.host, port=self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        self.uri = format_uri(self.host, self.port)
+
+    async def close(self) -> None:
+        self._server.close()
+        # closing a connection ends the task serving it, unless it's waiting for a method to return:
+        for writer in self._connections.values():
+            writer.close()
+        if self._connections:
+            _, pending = await asyncio.wait(list(self._connections), timeout=1)
+            for task in pending:
+                task.cancel()
+        await self._server.wait_closed()
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        sock = writer.get_extra_info('socket')
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        task = _current_task()
+        self._connections[task] = writer
+        try:
+            while True:
+                try:
+                    size, = HEADER.unpack(await reader.readexactly(HEADER.size))
+                    if size > MAX_MESSAGE_SIZE:
+                        raise ValueError("message too large")
+                    request = decode(await reader.readexactly(size))
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    # the client has gone away
+                    break
+                writer.write(await self._dispatch(request))
+                await writer.drain()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Error while serving a client; closing its connection")
+        finally:
+            self._connections.pop(task, None)
+            writer.close()
+
+    async def _dispatch(self, request: Dict[str, Any]) -> bytes:
+        """Call the requested method, returning the encoded response."""
+        msg_id = request.get("id")
+        try:
+            method = request["method"]
+            if method.startswith('_'):
+                raise AttributeError("%s is private" % method)
+            result = getattr(self.obj, method)(*request.get("args", ()), **request.get("kwargs", {}))
+            if inspect.isawaitable(result):
+                result = await result
+            return encode({"id": msg_id, "result": result})
+        except Exception as e:
+            logger.debug("Exception in remote call %s", request.get("method"), exc_info=True)
+            return encode({"id": msg_id, "error": [type(e).__name__, str(e)]})
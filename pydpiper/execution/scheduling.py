@@ -0,0 +1,355 @@
+"""
+Data structures used by the server to decide which runnable stage to hand out next.
+"""
+
+from array import array
+import bisect
+import heapq
+import math
+
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+# Very rough relative running times of some of the programs we run, used to weight
+# paths through the stage graph when deciding which stages to run first.
+# Anything not listed here is assumed to be cheap.
+DEFAULT_STAGE_COSTS = {
+    "ANTS"                    : 60.0,
+    "antsRegistration"        : 60.0,
+    "DRAMMS"                  : 60.0,
+    "elastix"                 : 30.0,
+    "rotational_minctracc.py" : 30.0,
+    "minctracc"               : 10.0,
+    "mincbigaverage"          : 10.0,
+    "pmincaverage"            : 10.0,
+    "mincaverage"             : 5.0,
+    "AverageImages"           : 5.0,
+    "nu_correct"              : 5.0,
+    "mincblur"                : 2.0,
+    "mincresample"            : 2.0,
+}  # type: Dict[str, float]
+
+DEFAULT_STAGE_COST = 1.0
+
+# Roughly the running time (s) of a stage of unit cost, for estimating running times
+# of stages before any have been measured
+DEFAULT_COST_SECONDS = 60.0
+
+
+def runtime_class(seconds: Optional[float]) -> int:
+    """The runtime class of a stage expected to run for `seconds`: the smallest k such that it's
+    expected to finish within 2 ** k seconds (0 for an unknown running time, taken as negligible).
+
+    >>> runtime_class(None), runtime_class(0.5), runtime_class(60), runtime_class(3600), runtime_bound(6)
+    (0, 0, 6, 12, 64)
+    """
+    if not seconds or seconds <= 1:
+        return 0
+    return math.ceil(math.log2(seconds))
+
+
+def runtime_bound(cls: int) -> int:
+    """The longest running time (s) of stages in runtime class `cls`."""
+    return 2 ** cls
+
+
+def stage_cost(name: str) -> float:
+    """
+    >>> stage_cost("ANTS") > stage_cost("mincblur") > stage_cost("xfmconcat")
+    True
+    """
+    return DEFAULT_STAGE_COSTS.get(name, DEFAULT_STAGE_COST)
+
+
+def critical_path_priorities(topological_order: Iterable[int],
+                             successors: Callable[[int], Iterable[int]],
+                             cost: Callable[[int], float],
+                             n: int) -> Sequence[float]:
+    """For each of the `n` nodes of a DAG, compute the total cost of the most expensive path
+    from that node to a sink (including the node itself), i.e., the amount of work which must
+    still happen serially once the node becomes runnable.
+
+    >>> succ = {0: [1, 2], 1: [3], 2: [], 3: []}
+    >>> list(critical_path_priorities([0, 1, 2, 3], lambda i: succ[i], lambda i: [1, 1, 5, 1][i], 4))
+    [6.0, 2.0, 5.0, 1.0]
+    """
+    priorities = array('d', bytes(8 * n))
+    for i in reversed(list(topological_order)):
+        priorities[i] = cost(i) + max((priorities[j] for j in successors(i)), default=0)
+    return priorities
+
+
+class RunnableQueue(object):
+    """A set of runnable stage indices, indexed both by priority and by resource requirements.
+    `pop` returns the stage with the most remaining downstream work (ties are broken in favour of the
+    lowest index), while `pop_fitting` returns the highest priority stage fitting into the given
+    resources (among stages with equal priorities, the one with the largest requirements).
+    A stage's (memory, procs) requirements are looked up once, when it is added.
+    Adding a stage which is already present has no effect, as for a set.
+
+    Given `runtimes` (the expected running time of each stage, also looked up when it's added),
+    stages are additionally classed by running time (see `runtime_class`) so that `pop_fitting` can
+    hand out only stages expected to finish within an executor's remaining walltime (and, of equal
+    priorities and requirements, the longest, so that long stages go to the executors with the most
+    time left).
+Given also `max_walltime`, the (full) walltime of a newly started executor, stages expected to run
+for longer than any executor could are put into the longest class shorter than this, so that they're
+still handed out (to executors with most of their walltime left) rather than never.
+
+    >>> q = RunnableQueue(priorities=[1.0, 5.0, 3.0, 2.0], resources=lambda i: [(1, 1), (8, 1), (2, 4), (2, 1)][i])
+    >>> for i in [0, 1, 2, 3, 1]: q.add(i)
+    >>> len(q), 2 in q
+    (4, True)
+    >>> q.pop_fitting(mem=4, procs=2), q.pop_fitting(mem=0.5, procs=2)
+    (3, None)
+    >>> q.discard(2)
+    >>> [q.pop() for _ in range(len(q))]
+    [1, 0]
+
+    >>> q = RunnableQueue(priorities=[1.0, 2.0, 1.0], resources=lambda i: [(8, 1), (1, 1), (1, 1)][i])
+    >>> for i in range(3): q.add(i)
+    >>> [q.pop_fitting(mem=16, procs=2) for _ in range(3)]
+    [1, 0, 2]
+
+    >>> q = RunnableQueue(priorities=[3.0, 2.0, 2.0], resources=lambda i: (2, 1), runtimes=[30, 600, 3600].__getitem__)
+    >>> for i in range(3): q.add(i)
+    >>> q.has_fitting(mem=2, procs=1, max_runtime=10), q.pop_fitting(mem=2, procs=1, max_runtime=1200)
+    (False, 0)
+    >>> q.pop_fitting(mem=2, procs=1, max_runtime=1200), q.pop_fitting(mem=2, procs=1, max_runtime=8000)
+    (1, 2)
+
+    >>> q = RunnableQueue(priorities=[1.0], resources=lambda i: (2, 1), runtimes=lambda i: 7200, max_walltime=3000)
+    >>> q.add(0)
+    >>> q.runtime_bound(0), q.pop_fitting(mem=2, procs=1, max_runtime=1000), q.pop_fitting(mem=2, procs=1, max_runtime=2990)
+    (2048, None, 0)
+    """
+    def __init__(self,
+                 priorities: Sequence[float],
+                 resources: Callable[[int], Tuple[float, int]],
+                 runtimes: Optional[Callable[[int], Optional[float]]] = None,
+                 max_walltime: Optional[float] = None) -> None:
+        self.priorities = priorities
+        self.resources = resources
+        self.runtimes = runtimes
+        # the longest runtime class whose stages can be expected to finish within `max_walltime`
+        self._max_class = max(runtime_class(max_walltime) - 1, 0) if max_walltime is not None else math.inf
+        # removal from the heaps below is lazy, so this map (from each stage to its
+        # (memory, procs, runtime class) class) is the source of truth for membership
+        self._members = {}        # type: Dict[int, Tuple[float, int, int]]
+        # a priority heap per class, and the classes present in sorted order:
+        self._buckets = {}        # type: Dict[Tuple[float, int, int], List[Tuple[float, int]]]
+        self._bucket_sizes = {}   # type: Dict[Tuple[float, int, int], int]
+        self._classes = []        # type: List[Tuple[float, int, int]]
+        # so that all members of a class share a single key object:
+        self._class_keys = {}     # type: Dict[Tuple[float, int, int], Tuple[float, int, int]]
+
+    def add(self, i: int) -> None:
+        if i in self._members:
+            return
+        mem, procs = self.resources(i)
+        key = (mem, procs, min(runtime_class(self.runtimes(i)), self._max_class) if self.runtimes else 0)
+        key = self._class_keys.setdefault(key, key)
+        self._members[i] = key
+        entry = (-self.priorities[i], i)
+        if key not in self._buckets:
+            self._buckets[key] = []
+            self._bucket_sizes[key] = 0
+            bisect.insort(self._classes, key)
+        heapq.heappush(self._buckets[key], entry)
+        self._bucket_sizes[key] += 1
+
+    def _remove(self, i: int) -> None:
+        key = self._members.pop(i)
+        self._bucket_sizes[key] -= 1
+        if self._bucket_sizes[key] == 0:
+            del self._buckets[key]
+            del self._bucket_sizes[key]
+            del self._class_keys[key]
+            del self._classes[bisect.bisect_left(self._classes, key)]
+
+    def pop(self) -> int:
+        """Remove and return the highest priority stage, whatever its requirements."""
+        if not self._classes:
+            raise KeyError("pop from an empty RunnableQueue")
+        _, i = min(self._head(key) for key in self._classes)
+        self._remove(i)
+        return i
+
+    def _head(self, key: Tuple[float, int, int]) -> Tuple[float, int]:
+        """The (-priority, stage) entry of the highest priority member of a class."""
+        bucket = self._buckets[key]
+        while self._members.get(bucket[0][1]) != key:
+            # clear out stale entries
+            heapq.heappop(bucket)
+        return bucket[0]
+
+    def _fitting_class(self, mem: float, procs: int,
+                       max_runtime: Optional[float]) -> Optional[Tuple[float, int, int]]:
+        """The class from which `pop_fitting` takes its stage: the fitting class with the highest priority
+        head, or of those with equal priorities, the one with the largest (memory, procs, runtime class)."""
+        best, best_rank = None, None
+        for ix in range(bisect.bisect_right(self._classes, (mem, math.inf)) - 1, -1, -1):
+            key = self._classes[ix]
+            if key[1] > procs or (max_runtime is not None and runtime_bound(key[2]) > max_runtime):
+                continue
+            # (classes are visited from largest to smallest, so only a strictly higher priority wins)
+            rank = self._head(key)[0]
+            if best is None or rank < best_rank:
+                best, best_rank = key, rank
+        return best
+
+    def pop_fitting(self, mem: float, procs: int, max_runtime: Optional[float] = None) -> Optional[int]:
+        """Remove and return the highest priority stage with requirements not exceeding `mem` and `procs`
+        (of equal priorities, the one with the largest requirements), or None if there is no such stage.
+        Given `max_runtime`, only stages expected to finish within that many seconds are considered."""
+        key = self._fitting_class(mem, procs, max_runtime)
+        if key is None:
+            return None
+        _, i = self._head(key)
+        self._remove(i)
+        return i
+
+    def has_fitting(self, mem: float, procs: int, max_runtime: Optional[float] = None) -> bool:
+        """Whether `pop_fitting(mem, procs, max_runtime)` would return a stage.
+
+        >>> q = RunnableQueue(priorities=[0, 0], resources=lambda i: [(4, 2), (8, 1)][i])
+        >>> q.add(0); q.add(1)
+        >>> q.has_fitting(mem=6, procs=1), q.has_fitting(mem=6, procs=2), q.has_fitting(mem=2, procs=8)
+        (False, True, False)
+        """
+        for ix in range(bisect.bisect_right(self._classes, (mem, math.inf)) - 1, -1, -1):
+            key = self._classes[ix]
+            if key[1] <= procs and (max_runtime is None or runtime_bound(key[2]) <= max_runtime):
+                return True
+        return False
+
+    def runtime_bound(self, i: int) -> int:
+        """The longest running time (s) expected of (runnable) stage `i`."""
+        return runtime_bound(self._members[i][2])
+
+    def discard(self, i: int) -> None:
+        if i in self._members:
+            self._remove(i)
+
+    # Queries about the resource requirements of the runnable stages.  These only look at
+    # the (sorted) resource classes rather than at every stage.
+
+    def largest(self) -> Optional[int]:
+        """A stage with the largest memory requirement (without removing it), or None if empty."""
+        if not self._classes:
+            return None
+        return self._head(self._classes[-1])[1]
+
+    def max_memory(self) -> float:
+        return self._classes[-1][0] if self._classes else 0
+
+    def top_memory_sum(self, k: int) -> float:
+        """Total memory required by the `k` runnable stages with the largest requirements."""
+        total = 0
+        for key in reversed(self._classes):
+            if k <= 0:
+                break
+            count = self._bucket_sizes[key]
+            total += key[0] * min(k, count)
+            k -= count
+        return total
+
+    def resource_counts(self) -> List[Tuple[Tuple[float, int], int]]:
+        """((memory, procs), number of stages) pairs, in decreasing order of memory (then procs)."""
+        counts = []  # type: List[Tuple[Tuple[float, int], int]]
+        for key in reversed(self._classes):
+            if counts and counts[-1][0] == key[:2]:
+                counts[-1] = (counts[-1][0], counts[-1][1] + self._bucket_sizes[key])
+            else:
+                counts.append((key[:2], self._bucket_sizes[key]))
+        return counts
+
+    def memory_counts(self) -> List[Tuple[float, int]]:
+        """(memory, number of stages) pairs, in decreasing order of memory.
+
+        >>> q = RunnableQueue(priorities=[0] * 4, resources=lambda i: [(1, 1), (4, 1), (4, 2), (2, 1)][i])
+        >>> for i in range(4): q.add(i)
+        >>> q.memory_counts(), q.max_memory(), q.top_memory_sum(3), q.largest() in (1, 2)
+        ([(4, 2), (2, 1), (1, 1)], 4, 10, True)
+        """
+        counts = []  # type: List[Tuple[float, int]]
+        for key in reversed(self._classes):
+            if counts and counts[-1][0] == key[0]:
+                counts[-1] = (key[0], counts[-1][1] + self._bucket_sizes[key])
+            else:
+                counts.append((key[0], self._bucket_sizes[key]))
+        return counts
+
+    def __len__(self) -> int:
+        return len(self._members)
+
+    def __contains__(self, i) -> bool:
+        return i in self._members
+
+    def __iter__(self):
+        return iter(self._members)
+
+
+# executors are sized in powers of two (G) from this size up (or the maximum allowed)...
+MIN_EXECUTOR_MEM = 1.0
+# ... and at most this many different sizes are requested at once
+MAX_SIZE_CLASSES = 3
+
+
+def _how_many_fit(count: int, free_mem: float, free_procs: int, mem: float, procs: int) -> int:
+    """How many of `count` stages requiring `mem` and `procs` each fit into the given free resources."""
+    if mem > 0:
+        count = min(count, int(free_mem // mem))
+    if procs > 0:
+        count = min(count, int(free_procs // procs))
+    return count
+
+
+def executor_size_classes(demands: Iterable[Tuple[Tuple[float, int], int]],
+                          max_mem: float, procs: int, max_executors: int,
+                          greedy: bool = False) -> List[Tuple[float, int]]:
+    """Decide how many executors of which (memory) sizes to launch to run stages with the given demands,
+    as ((memory, procs), number of stages) pairs, on at most `max_executors` executors with `procs`
+    processors and at most `max_mem` G of memory each.  Returns (memory, number of executors) pairs,
+    largest first.
+
+    The stages are packed into executors largest first (first fit decreasing), so big stages get
+    executors first if there are too many stages to launch executors for all of them; stages which
+    don't fit into any executor are ignored.  The memory of each executor is then rounded up to a
+    power of two (but at most `max_mem`), and the smallest of these sizes merged into larger ones
+    to give at most MAX_SIZE_CLASSES classes; with `greedy`, all executors get `max_mem`.
+
+    >>> executor_size_classes([((60.0, 1), 1), ((2.0, 1), 20)], max_mem=64.0, procs=4, max_executors=10)
+    [(64.0, 1), (8.0, 4), (4.0, 1)]
+    >>> executor_size_classes([((60.0, 1), 1), ((2.0, 1), 20)], max_mem=64.0, procs=4, max_executors=3)
+    [(64.0, 1), (8.0, 2)]
+    >>> executor_size_classes([((100.0, 1), 1), ((3.0, 1), 3)], max_mem=64.0, procs=2, max_executors=10, greedy=True)
+    [(64.0, 2)]
+    """
+    bins = []  # type: List[List[float]]  # [free memory, free procs] of each executor
+    for (mem, stage_procs), count in sorted(demands, reverse=True):
+        if mem > max_mem or stage_procs > procs:
+            continue
+        for b in bins:
+            if count == 0:
+                break
+            n = _how_many_fit(count, b[0], b[1], mem, stage_procs)
+            if n > 0:
+                b[0] -= n * mem
+                b[1] -= n * stage_procs
+                count -= n
+        while count > 0 and len(bins) < max_executors:
+            n = _how_many_fit(count, max_mem, procs, mem, stage_procs)
+            bins.append([max_mem - n * mem, procs - n * stage_procs])
+            count -= n
+    if greedy:
+        return [(max_mem, len(bins))] if bins else []
+    sizes = {}  # type: Dict[float, int]
+    for free_mem, _ in bins:
+        used = max(max_mem - free_mem, MIN_EXECUTOR_MEM)
+        size = min(MIN_EXECUTOR_MEM * 2 ** math.ceil(math.log2(used / MIN_EXECUTOR_MEM) - 1e-9), max_mem)
+        sizes[size] = sizes.get(size, 0) + 1
+    classes = sorted(sizes.items(), reverse=True)
+    while len(classes) > MAX_SIZE_CLASSES:
+        (_, n), (size, m) = classes.pop(), classes.pop()
+        classes.append((size, n + m))
+    return classes
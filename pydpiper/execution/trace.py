@@ -0,0 +1,192 @@
+"""
+A structured record of the lifecycle of every stage the server hands out, for finding out after a
+run whether it was limited by scheduling, by waiting for executors, or by the stages themselves.
+
+The server records an event whenever a stage becomes runnable, is claimed by (handed out to) an
+executor, is started, finishes, fails, or is lost along with its executor, together with the
+executor, the memory requested for the stage and (for stages which have terminated) its measured
+peak memory use and CPU time.  Since a pipeline may have hundreds of thousands of stages, events
+are kept in flat arrays (one entry per event) rather than as objects.
+
+At shutdown the events are written out as a Chrome trace (a JSON file which chrome://tracing or
+https://ui.perfetto.dev display as a timeline, with a row per executor) and as a CSV file with a
+row per event, and the time spent per tool is summarized.
+"""
+
+import csv
+import json
+import os
+import re
+
+from array import array
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+# event types
+RUNNABLE, CLAIMED, STARTED, FINISHED, FAILED, LOST = range(6)
+EVENT_NAMES = ("runnable", "claimed", "started", "finished", "failed", "lost")
+# events after which a stage is no longer running
+ENDED = (FINISHED, FAILED, LOST)
+SUMMARY_FIELDS = ("runs", "waiting", "running", "cputime", "mem_requested", "maxrss")
+
+
+def executor_host(uri: str) -> str:
+    """The host an executor runs on, given its URI (or the URI itself if it doesn't contain a host).
+
+    >>> executor_host("PYRO:obj_1234@10.0.0.7:41234"), executor_host("PYDPIPER:node1:5000"), executor_host("local")
+    ('10.0.0.7', 'node1', 'local')
+    """
+    m = re.match(r"^[A-Z]+:(?:[^@]*@)?(.+):\d+$", uri)
+    return m.group(1) if m else uri
+
+
+class StageTrace(object):
+    """The lifecycle events of a pipeline's stages, in the order they occurred."""
+    def __init__(self) -> None:
+        self.times = array('d')
+        self.stages = array('i')
+        self.events = bytearray()
+        # executors are stored as indices into `executors` (-1 for none)
+        self.executor_ixs = array('i')
+        self.executors = []  # type: List[str]
+        self._executor_ix = {}  # type: Dict[str, int]
+        self.mem = array('f')     # memory requested (G)
+        self.maxrss = array('f')  # peak memory used (G), for ended stages
+        self.cputime = array('f')  # user + system CPU time (s), for ended stages
+
+    def __len__(self) -> int:
+        return len(self.events)
+
+    def record(self, t: float, stage: int, event: int, executor: Optional[str] = None,
+               mem: float = 0.0, maxrss: float = 0.0, cputime: float = 0.0) -> None:
+        if executor is None:
+            ix = -1
+        else:
+            ix = self._executor_ix.get(executor)
+            if ix is None:
+                ix = self._executor_ix[executor] = len(self.executors)
+                self.executors.append(executor)
+        self.times.append(t)
+        self.stages.append(stage)
+        self.events.append(event)
+        self.executor_ixs.append(ix)
+        self.mem.append(mem or 0.0)
+        self.maxrss.append(maxrss or 0.0)
+        self.cputime.append(cputime or 0.0)
+
+    def executor(self, k: int) -> str:
+        ix = self.executor_ixs[k]
+        return self.executors[ix] if ix >= 0 else ""
+
+    def runs(self) -> List[Tuple[int, int]]:
+        """Pairs of the (indices of the) events starting and ending each run of a stage."""
+        started = {}  # type: Dict[int, int]
+        runs = []
+        for k, event in enumerate(self.events):
+            if event == STARTED:
+                started[self.stages[k]] = k
+            elif event in ENDED and self.stages[k] in started:
+                runs.append((started.pop(self.stages[k]), k))
+        return runs
+
+    def write_csv(self, path: str, tool: Callable[[int], str]) -> None:
+        """Write a row per event; `tool` gives the name of the program each stage runs."""
+        with open(path, 'w', newline='') as fh:
+            w = csv.writer(fh)
+            w.writerow(["time", "stage", "event", "tool", "executor", "host",
+                        "mem_requested", "maxrss", "cputime"])
+            for k in range(len(self)):
+                executor = self.executor(k)
+                w.writerow([repr(self.times[k]), self.stages[k], EVENT_NAMES[self.events[k]],
+                            tool(self.stages[k]), executor, executor_host(executor) if executor else "",
+                            "%.3f" % self.mem[k], "%.3f" % self.maxrss[k], "%.2f" % self.cputime[k]])
+
+    def chrome_trace(self, tool: Callable[[int], str]) -> Dict:
+        """The events in the Chrome trace event format: each run of a stage is shown as a span
+        in a row per executor (grouped by host), along with counters of runnable and running stages."""
+        t0 = self.times[0] if len(self) else 0.0
+        us = lambda t: round((t - t0) * 1e6)
+        hosts = OrderedDict()  # type: Dict[str, int]
+        trace = []  # type: List[Dict]
+        for tid, executor in enumerate(self.executors):
+            host = executor_host(executor)
+            pid = hosts.setdefault(host, len(hosts))
+            trace.append(dict(ph="M", name="thread_name", pid=pid, tid=tid, args=dict(name=executor)))
+        for host, pid in hosts.items():
+            trace.append(dict(ph="M", name="process_name", pid=pid, args=dict(name=host)))
+        for start, end in self.runs():
+            ix = self.stages[start]
+            executor = self.executor_ixs[start]
+            trace.append(dict(ph="X", name=tool(ix), cat=EVENT_NAMES[self.events[end]],
+                              pid=hosts[executor_host(self.executors[executor])], tid=executor,
+                              ts=us(self.times[start]), dur=us(self.times[end]) - us(self.times[start]),
+                              args=dict(stage=ix, mem_requested=round(self.mem[start], 3),
+                                        maxrss=round(self.maxrss[end], 3), cputime=round(self.cputime[end], 2))))
+        runnable = running = 0
+        for k, event in enumerate(self.events):
+            if event == RUNNABLE:
+                runnable += 1
+            elif event == CLAIMED:
+                runnable -= 1
+            elif event == STARTED:
+                running += 1
+            elif event in ENDED:
+                running -= 1
+            else:
+                continue
+            trace.append(dict(ph="C", name="stages", pid=len(hosts), ts=us(self.times[k]),
+                              args=dict(runnable=runnable, running=running)))
+        trace.append(dict(ph="M", name="process_name", pid=len(hosts), args=dict(name="server")))
+        return dict(traceEvents=trace, displayTimeUnit="ms")
+
+    def write_chrome_trace(self, path: str, tool: Callable[[int], str]) -> None:
+        with open(path, 'w') as fh:
+            json.dump(self.chrome_trace(tool), fh, separators=(',', ':'))
+
+    def tool_summary(self, tool: Callable[[int], str]) -> "OrderedDict[str, Dict[str, float]]":
+        """Per tool: the number of runs, the total time stages waited between becoming runnable and being
+        claimed, their total running and CPU time, and their mean requested and used memory,
+        ordered by decreasing running time.
+
+        >>> t = StageTrace()
+        >>> for time, event in [(0, RUNNABLE), (1, CLAIMED), (1, STARTED), (11, FINISHED)]:
+        ...     t.record(time, 0, event, executor=None if event == RUNNABLE else "local", mem=2.0, maxrss=0.5)
+        >>> dict(t.tool_summary(lambda i: "ANTS")["ANTS"])
+        {'runs': 1, 'waiting': 1.0, 'running': 10.0, 'cputime': 0.0, 'mem_requested': 2.0, 'maxrss': 0.5}
+        """
+        summary = {}  # type: Dict[str, Dict[str, float]]
+        runnable_since = {}  # type: Dict[int, float]
+        for k, event in enumerate(self.events):
+            if event == RUNNABLE:
+                runnable_since[self.stages[k]] = self.times[k]
+            elif event == CLAIMED and self.stages[k] in runnable_since:
+                s = summary.setdefault(tool(self.stages[k]), dict.fromkeys(SUMMARY_FIELDS, 0.0))
+                s["waiting"] += self.times[k] - runnable_since.pop(self.stages[k])
+        for start, end in self.runs():
+            s = summary.setdefault(tool(self.stages[start]), dict.fromkeys(SUMMARY_FIELDS, 0.0))
+            s["runs"] += 1
+            s["running"] += self.times[end] - self.times[start]
+            s["cputime"] += self.cputime[end]
+            s["mem_requested"] += self.mem[start]
+            s["maxrss"] += self.maxrss[end]
+        for s in summary.values():
+            s["runs"] = int(s["runs"])
+            if s["runs"]:
+                s["mem_requested"] /= s["runs"]
+                s["maxrss"] /= s["runs"]
+        return OrderedDict(sorted(summary.items(), key=lambda kv: -kv[1]["running"]))
+
+    def format_summary(self, tool: Callable[[int], str]) -> str:
+        rows = ["%-24s %6s %12s %12s %12s %9s %9s" % ("tool", "runs", "waiting (s)", "running (s)",
+                                                       "CPU (s)", "mem (G)", "used (G)")]
+        for name, s in self.tool_summary(tool).items():
+            rows.append("%-24s %6d %12.1f %12.1f %12.1f %9.2f %9.2f"
+                        % (name[:24], s["runs"], s["waiting"], s["running"], s["cputime"],
+                           s["mem_requested"], s["maxrss"]))
+        return "\n".join(rows)
+
+
+def trace_paths(directory: str, pipeline_name: str) -> Sequence[str]:
+    """The Chrome trace and CSV files to which the trace of a pipeline is written."""
+    return (os.path.join(directory, pipeline_name + "_trace.json"),
+            os.path.join(directory, pipeline_name + "_trace.csv"))
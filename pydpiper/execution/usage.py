@@ -0,0 +1,241 @@
+"""
+A model of the resources used by the programs a pipeline runs, learned from the peak memory use and
+running time which executors measure for each stage.
+
+The memory requested by most stages comes from hand-tuned estimates (see, e.g., the memory
+configurations in pydpiper.minc.registration), which can be too small for some inputs or systems.
+The server records a sample for every stage which finishes, keyed by the program, its flags (but
+not their values or any file names; see `flags_signature`) and the stage's size (e.g., the number
+of voxels in its MINC inputs), and predicts the memory use of a stage which is about to become
+runnable from samples with the same key by a (least squares) linear fit in the size, plus the
+largest amount by which any sample exceeded the fit, plus a safety margin; the stage's request is
+raised to this if it's larger (but never lowered).  Stages which appear to have run out of
+memory are retried with more, and the larger amount is recorded as a sample so that later
+predictions for that key are raised as well.  Running times are used to weight paths through the
+stage graph (see `Pipeline.compute_stage_priorities`).
+
+Samples are appended to a file (as lines of JSON) shared by all pipelines using the same output
+directory, so they accumulate across runs.
+"""
+
+import hashlib
+import json
+import math
+import os
+import time
+
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+# the name of the store within a pipeline's output directory
+STORE_FILENAME = "resource_usage.jsonl"
+# don't predict anything for a key from fewer samples ...
+MIN_SAMPLES = 3
+# ... and only keep the most recent samples (the store is compacted on loading if it has many more)
+MAX_SAMPLES = 100
+# predictions are increased by this fraction ...
+MEMORY_MARGIN = 0.2
+# ... and rounded up to a multiple of this many G (so that stages fall into fewer resource classes)
+MEMORY_GRANULARITY = 0.125
+# don't predict for stages more than this much larger than the largest sample
+MAX_EXTRAPOLATION = 2.0
+# a failed stage whose peak memory use was at least this fraction of its request is assumed to
+# have run out of memory, and is retried with its request multiplied by OOM_GROWTH
+OOM_FRACTION = 0.95
+OOM_GROWTH = 1.5
+# write out new samples at most this often (seconds)
+FLUSH_INTERVAL = 10.0
+
+Key = Tuple[str, str]  # (tool, flags signature)
+# (size, peak memory use in G, running time in seconds or None for samples recorded after running out of memory)
+Sample = Tuple[float, float, Optional[float]]
+
+
+def _is_number(s: str) -> bool:
+    try:
+        float(s)
+        return True
+    except ValueError:
+        return False
+
+
+def flags_signature(cmd: Sequence[str]) -> str:
+    """A digest of the set of flags in the command `cmd` (not including their values).
+
+    >>> flags_signature(["mincblur", "-fwhm", "0.5", "a.mnc", "b"]) == flags_signature(["mincblur", "-fwhm", "-1", "c.mnc", "d"])
+    True
+    >>> flags_signature(["mincblur", "-gradient", "a.mnc", "b"]) == flags_signature(["mincblur", "a.mnc", "b"])
+    False
+    """
+    flags = sorted({a for a in cmd[1:] if a.startswith("-") and not _is_number(a)})
+    return hashlib.md5(" ".join(flags).encode()).hexdigest()[:12]
+
+
+def usage_key(cmd: Sequence[str]) -> Key:
+    return (os.path.basename(cmd[0]) if cmd else "", flags_signature(cmd))
+
+
+def input_bytes(stage) -> float:
+    """The total size in bytes of a stage's (existing) input files; the default measure of a stage's size."""
+    total = 0
+    for f in stage.inputFiles:
+        try:
+            total += os.path.getsize(f)
+        except OSError:
+            pass
+    return float(total)
+
+
+def _fit(points: Sequence[Tuple[float, float]]) -> Tuple[float, float]:
+    """The intercept and (non-negative) slope of the least squares line through `points`, or a constant
+    (the mean) if there's no variation in x or the slope is negative.
+
+    >>> _fit([(1, 3), (2, 5), (3, 7)])
+    (1.0, 2.0)
+    >>> _fit([(1, 3), (1, 5)])
+    (4.0, 0.0)
+    """
+    n = len(points)
+    mx = sum(x for x, _ in points) / n
+    my = sum(y for _, y in points) / n
+    sxx = sum((x - mx) ** 2 for x, _ in points)
+    sxy = sum((x - mx) * (y - my) for x, y in points)
+    if sxx <= 0 or sxy <= 0:
+        return (my, 0.0)
+    b = sxy / sxx
+    return (my - b * mx, b)
+
+
+def _predict(points: Sequence[Tuple[float, float]], size: float, upper: bool) -> Optional[float]:
+    """The value at `size` of the fit through `points` (shifted up to lie above all of them if `upper`),
+    or None if there are too few points or `size` is too far outside their range."""
+    if len(points) < MIN_SAMPLES:
+        return None
+    xs = [x for x, _ in points]
+    lo, hi = min(xs), max(xs)
+    if size > MAX_EXTRAPOLATION * hi or (lo == hi and abs(size - hi) > 0.1 * hi):
+        return None
+    a, b = _fit(points)
+    if upper:
+        a += max(y - (a + b * x) for x, y in points)
+    return max(a + b * size, 0.0)
+
+
+class ResourceUsageModel(object):
+    """Samples of resource usage by key, optionally saved to (and loaded from) the file `store`."""
+    def __init__(self, store: Optional[str] = None) -> None:
+        self.store = store
+        self.samples = {}  # type: Dict[Key, List[Sample]]
+        self._pending = []  # type: List[str]
+        self._last_flush = time.time()
+        if store is not None:
+            self._load()
+
+    def _load(self) -> None:
+        try:
+            with open(self.store) as fh:
+                lines = fh.readlines()
+        except OSError:
+            return
+        for line in lines:
+            try:
+                d = json.loads(line)
+                self._add((d["tool"], d["flags"]), (float(d["size"]), float(d["maxrss"]),
+                                                     None if d["runtime"] is None else float(d["runtime"])))
+            except (ValueError, KeyError, TypeError):
+                continue  # e.g., a partially written line
+        if len(lines) > 2 * sum(len(s) for s in self.samples.values()) + 100:
+            self._rewrite_store()
+
+    def _rewrite_store(self) -> None:
+        lines = [self._sample_line(k, s) for k, samples in self.samples.items() for s in samples]
+        tmp = "%s.%d" % (self.store, os.getpid())
+        try:
+            with open(tmp, 'w') as fh:
+                fh.writelines(lines)
+            os.replace(tmp, self.store)
+        except OSError:
+            pass  # the store is just an optimization
+
+    @staticmethod
+    def _sample_line(key: Key, sample: Sample) -> str:
+        size, maxrss, runtime = sample
+        return json.dumps(dict(tool=key[0], flags=key[1], size=size, maxrss=maxrss, runtime=runtime)) + "\n"
+
+    def _add(self, key: Key, sample: Sample) -> None:
+        samples = self.samples.setdefault(key, [])
+        samples.append(sample)
+        if len(samples) > MAX_SAMPLES:
+            del samples[0]
+
+    def record(self, key: Key, size: float, maxrss: float, runtime: Optional[float]) -> None:
+        sample = (float(size), float(maxrss), None if runtime is None else float(runtime))
+        self._add(key, sample)
+        if self.store is not None:
+            self._pending.append(self._sample_line(key, sample))
+
+    def record_oom(self, key: Key, size: float, mem: float) -> float:
+        """Record that a stage of the given size ran out of the `mem` G it was given,
+        returning the amount of memory to retry it with."""
+        mem *= OOM_GROWTH
+        self.record(key, size, mem, runtime=None)
+        return mem
+
+    def has_samples(self, key: Key) -> bool:
+        """Whether there are enough samples for `key` to predict anything from."""
+        return len(self.samples.get(key, ())) >= MIN_SAMPLES
+
+    def predict_mem(self, key: Key, size: float) -> Optional[float]:
+        """The memory (G) to request for a stage of the given size, or None if there's no good estimate.
+
+        >>> m = ResourceUsageModel()
+        >>> for size, maxrss in [(1e6, 1.0), (2e6, 1.5), (4e6, 2.5)]: m.record(("mincblur", ""), size, maxrss, 10)
+        >>> m.predict_mem(("mincblur", ""), 3e6), m.predict_mem(("mincblur", ""), 1e8), m.predict_mem(("ANTS", ""), 3e6)
+        (2.5, None, None)
+        """
+        pred = _predict([s[:2] for s in self.samples.get(key, ())], size, upper=True)
+        if pred is None:
+            return None
+        return math.ceil(pred * (1 + MEMORY_MARGIN) / MEMORY_GRANULARITY) * MEMORY_GRANULARITY
+
+    def predict_runtime(self, key: Key, size: float) -> Optional[float]:
+        """The expected running time (s) of a stage of the given size, or None if there's no good estimate."""
+        return _predict([(s[0], s[2]) for s in self.samples.get(key, ()) if s[2] is not None], size, upper=False)
+
+    def mean_runtime(self, tool: str) -> Optional[float]:
+        """The mean running time of all samples for `tool` (for when a stage's flags and size aren't known)."""
+        runtimes = [s[2] for (t, _), samples in self.samples.items() if t == tool
+                    for s in samples if s[2] is not None]
+        return sum(runtimes) / len(runtimes) if len(runtimes) >= MIN_SAMPLES else None
+
+    def cost_scale(self, cost: Callable[[str], float], default: float = 1.0) -> float:
+        """The factor (seconds per unit) by which to multiply the relative costs given by `cost`
+        to make them comparable to running times of tools with samples (`default` if there are none).
+
+        >>> m = ResourceUsageModel()
+        >>> for _ in range(3): m.record(("ANTS", ""), 1.0, 1.0, 600.0)
+        >>> m.cost_scale(lambda tool: {"ANTS": 60.0}.get(tool, 1.0)), ResourceUsageModel().cost_scale(len)
+        (10.0, 1.0)
+        """
+        tools = {t for t, _ in self.samples}
+        runtimes = [(self.mean_runtime(t), cost(t)) for t in tools]
+        known = [(r, c) for r, c in runtimes if r is not None]
+        return sum(r for r, _ in known) / sum(c for _, c in known) if known else default
+
+    def flush_if_due(self, now: Optional[float] = None) -> None:
+        if self._pending and (now or time.time()) - self._last_flush >= FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self) -> None:
+        self._last_flush = time.time()
+        if self._pending:
+            try:
+                # (a single write, so that lines from different pipelines sharing the store aren't interleaved)
+                with open(self.store, 'a') as fh:
+                    fh.write("".join(self._pending))
+            except OSError:
+                pass
+            self._pending = []
+
+
+def load_model(directory: str) -> ResourceUsageModel:
+    return ResourceUsageModel(os.path.join(directory, STORE_FILENAME))
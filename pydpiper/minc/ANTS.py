@@ -8,12 +8,11 @@ from functools import reduce
 from operator import mul
 from typing import cast, List, Optional
 
-from pyminc.volumes.factory import volumeFromFile
-
 from pydpiper.core.stages import Result, CmdStage, Stages, identity_result
 from pydpiper.core.util import NamedTuple
 from pydpiper.minc.containers import XfmHandler
 from pydpiper.minc.files import XfmAtom, MincAtom, IdMinc
+from pydpiper.minc.headers import minc_header
 from pydpiper.minc.nlin import NLIN
 # TODO in order to remove circularity from the module import (which gives an exception at import time)
 # TODO we need to move some stuff around ...
@@ -63,7 +62,7 @@ class MultilevelANTSConf(object):
 
 def set_memory(st, source: MincAtom, conf: ANTSConf, mem_cfg):
     # see comments re: mincblur memory configuration
-    voxels = reduce(mul, volumeFromFile(source.path).getSizes())
+    voxels = reduce(mul, minc_header(source.path).sizes)
     mem_per_voxel = (mem_cfg.mem_per_voxel_coarse
                      if int(conf.iterations.split('x')[-1]) == 0
                      # yikes ... this parsing should be done earlier
@@ -5,8 +5,6 @@ from functools import reduce
 from operator import mul
 from typing import Optional, Tuple, Sequence
 
-from pyminc.volumes.factory import volumeFromFile
-
 from pydpiper.minc.ANTS import ANTSMemCfg
 from pydpiper.core.util import AutoEnum, NamedTuple, flatten
 from pydpiper.minc.nlin import NLIN
@@ -14,6 +12,7 @@ from pydpiper.minc.containers import XfmHandler
 from pydpiper.minc.registration import mincresample, Interpolation, mincblur, MincAlgorithms
 from pydpiper.core.stages import Stages, CmdStage, Result, identity_result
 from pydpiper.minc.files import MincAtom, XfmAtom, IdMinc
+from pydpiper.minc.headers import minc_header
 
 ConvergenceCriteria = NamedTuple("ConvergenceCriteria",
                                  [("convergence_threshold", float),
@@ -327,7 +326,7 @@ def antsRegistration(source: MincAtom,
     # see comments re: mincblur memory configuration
     def set_memory(st, mem_cfg):
         # see comments re: mincblur memory configuration
-        voxels = reduce(mul, volumeFromFile(source.path).getSizes())
+        voxels = reduce(mul, minc_header(source.path).sizes)
         mem_per_voxel = (mem_cfg.mem_per_voxel_coarse
                          if 0 in conf.convergence.iterations[-1:]  #-2?
                          # yikes ... this parsing should be done earlier
@@ -0,0 +1,157 @@
+"""
+A process-wide cache of MINC header information (dimension sizes, step sizes, starts and data type).
+
+Reading a header via pyminc opens the whole file (through HDF5), which is slow, and the same files
+are examined again and again: e.g., the memory-estimation hooks of all the stages registering an image
+to many others look at that image's size, and these hooks run in the (single-threaded) server.
+Headers are therefore cached by path and only read again if the file's size or modification time
+has changed.  The cache can also be kept in a small file (see `use_store`), normally in the pipeline's
+output directory, so that restarted pipelines and other pipelines using the same files can reuse it.
+"""
+
+import functools
+import json
+import operator
+import os
+import tempfile
+import threading
+
+from typing import Dict, NamedTuple, Optional, Tuple
+
+from pyminc.volumes.factory import volumeFromFile  # type: ignore
+
+# the name of the store within a pipeline's output directory
+STORE_FILENAME = "minc_headers.cache"
+
+MincHeader = NamedTuple('MincHeader', [('sizes', Tuple[int, ...]),
+                                       ('separations', Tuple[float, ...]),
+                                       ('starts', Tuple[float, ...]),
+                                       ('dtype', Optional[str])])
+
+
+def read_header(path: str) -> MincHeader:
+    """Read the header of the MINC file at `path` (uncached)."""
+    vol = volumeFromFile(path)
+    try:
+        dtype = getattr(vol, "dtype", None)
+        return MincHeader(sizes=tuple(int(s) for s in vol.getSizes()),
+                          separations=tuple(float(s) for s in vol.separations),
+                          starts=tuple(float(s) for s in vol.starts),
+                          dtype=None if dtype is None else str(dtype))
+    finally:
+        vol.closeVolume()
+
+
+class MincHeaderCache(object):
+    """Headers of MINC files by path, valid while a file's size and modification time are unchanged.
+    Newly read headers are appended to the store file (if any) as lines of JSON, so that several
+    processes (e.g., pipelines writing to the same directory) can safely add to it."""
+    def __init__(self, read=read_header) -> None:
+        self.read = read
+        self.store = None  # type: Optional[str]
+        self._entries = {}  # type: Dict[str, Tuple[int, float, MincHeader]]  # (size, mtime, header) by absolute path
+        self._lock = threading.Lock()
+
+    def use_store(self, store: str) -> None:
+        """Load the headers previously saved in the file `store` and save newly read ones there."""
+        store = os.path.abspath(store)
+        if store == self.store:
+            return
+        self.store = store
+        try:
+            with open(store) as fh:
+                lines = fh.readlines()
+        except OSError:
+            return
+        for line in lines:
+            try:
+                d = json.loads(line)
+                self._entries[d["path"]] = (d["size"], d["mtime"], MincHeader(sizes=tuple(d["sizes"]),
+                                                                             separations=tuple(d["separations"]),
+                                                                             starts=tuple(d["starts"]),
+                                                                             dtype=d["dtype"]))
+            except (ValueError, KeyError, TypeError):
+                continue  # e.g., a partially written line
+        if len(lines) > 2 * len(self._entries) + 100:
+            # mostly out-of-date entries (of files which have since changed), so compact the store
+            self._rewrite_store()
+
+    def _entry_line(self, path: str) -> str:
+        size, mtime, header = self._entries[path]
+        return json.dumps(dict(header._asdict(), path=path, size=size, mtime=mtime)) + "\n"
+
+    def _rewrite_store(self) -> None:
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.store), prefix=os.path.basename(self.store) + ".")
+        try:
+            with os.fdopen(fd, 'w') as fh:
+                fh.writelines(self._entry_line(p) for p in self._entries)
+            os.replace(tmp, self.store)
+        except OSError:
+            os.unlink(tmp)
+
+    def is_cached(self, path: str) -> bool:
+        """Whether the (current) header of the file at `path` is known."""
+        path = os.path.abspath(path)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return False
+        entry = self._entries.get(path)
+        return entry is not None and entry[:2] == (st.st_size, st.st_mtime)
+
+    def get(self, path: str) -> MincHeader:
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        entry = self._entries.get(path)
+        if entry is not None and entry[:2] == (st.st_size, st.st_mtime):
+            return entry[2]
+        header = self.read(path)
+        with self._lock:
+            self._entries[path] = (st.st_size, st.st_mtime, header)
+            if self.store is not None:
+                try:
+                    # a single (short) write, so lines from different processes aren't interleaved
+                    with open(self.store, 'a') as fh:
+                        fh.write(self._entry_line(path))
+                except OSError:
+                    pass  # the store is just an optimization
+        return header
+
+
+_cache = MincHeaderCache()
+
+
+def minc_header(path: str) -> MincHeader:
+    """The header of the MINC file at `path`, from the process-wide cache if possible.
+
+    >>> import tempfile
+    >>> f = os.path.join(tempfile.mkdtemp(), "img.mnc")
+    >>> open(f, 'w').close()
+    >>> _cache.read = lambda path: MincHeader(sizes=(10, 20, 30), separations=(0.1,) * 3, starts=(0,) * 3, dtype=None)
+    >>> minc_header(f).sizes, is_cached(f)
+    ((10, 20, 30), True)
+    >>> _cache.read = read_header
+    """
+    return _cache.get(path)
+
+
+def is_cached(path: str) -> bool:
+    return _cache.is_cached(path)
+
+
+def input_voxels(stage) -> float:
+    """The total number of voxels in a stage's MINC input files, as a measure of the stage's size
+    (see pydpiper.execution.usage)."""
+    total = 0
+    for f in stage.inputFiles:
+        if f.endswith(".mnc"):
+            try:
+                total += functools.reduce(operator.mul, minc_header(f).sizes, 1)
+            except Exception:  # e.g., not (yet) a readable MINC file; pyminc doesn't raise anything more specific
+                pass
+    return float(total)
+
+
+def use_store(directory: str) -> None:
+    """Keep the process-wide cache in the store in `directory` (e.g., a pipeline's output directory)."""
+    _cache.use_store(os.path.join(directory or os.curdir, STORE_FILENAME))
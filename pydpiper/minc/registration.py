@@ -12,13 +12,13 @@ from operator import mul
 from typing import Any, cast, Dict, Generic, List, Optional, Tuple, TypeVar, Union, Callable
 
 from configargparse import Namespace
-from pyminc.volumes.factory import volumeFromFile  # type: ignore
 
 from pydpiper.core.files import FileAtom
 from pydpiper.core.stages import CmdStage, Result, Stages, identity_result
 from pydpiper.core.util import pairs, AutoEnum, NamedTuple, raise_, flatten
 from pydpiper.minc.containers import XfmHandler
 from pydpiper.minc.files import MincAtom, XfmAtom, xfmToMinc, IdMinc, mincToXfm
+from pydpiper.minc.headers import is_cached, minc_header
 from pydpiper.minc.nlin import NLIN, NLIN_BUILD_MODEL, Algorithms
 
 
@@ -267,7 +267,7 @@ def minctracc(source: MincAtom,
 
     if nlin_conf is not None:  # TODO at the moment basically ignore resource requirements for linear stages ...
         def set_memory(st, cfg):
-            voxels = reduce(mul, volumeFromFile(source.path).getSizes())
+            voxels = reduce(mul, minc_header(source.path).sizes)
             st.setMem(voxels * cfg.mem_per_voxel + cfg.base_mem)
             # TODO make a wrapper to generate these set_memory functions?
 
@@ -380,7 +380,7 @@ def mincblur(img: MincAtom,
         # we pass the stage itself as an argument since the stage will be converted to an old-style CmdStage,
         # so `stage` will have no effect.  In order to receive this argument, hooks must now take a self-argument
         # (instead of no arguments as previously).
-        voxels = reduce(mul, volumeFromFile(img.path).getSizes())
+        voxels = reduce(mul, minc_header(img.path).sizes)
         #default_mem = self.mem #hack; see pipeline.addStage method
         stage.setMem((mem_cfg.base_mem + voxels * mem_cfg.mem_per_voxel)
                      * (mem_cfg.tmpdir_factor if mem_cfg.include_tmpdir else 1))
@@ -582,7 +582,7 @@ def pmincaverage(imgs: List[MincAtom],
         avg.mask = combined_mask
 
     def set_memory(st, cfg):
-        voxels_per_file = reduce(mul, volumeFromFile(imgs[0].path).getSizes())
+        voxels_per_file = reduce(mul, minc_header(imgs[0].path).sizes)
         st.setMem(cfg.base_mem + voxels_per_file * cfg.mem_per_voxel * len(imgs))
 
     avg_cmd.when_runnable_hooks.append(lambda st: set_memory(st, default_pmincaverage_mem_cfg))
@@ -2124,15 +2124,12 @@ def check_MINC_files_have_equal_dimensions_and_resolution(args: List[str],
     if len(args) < 2:
         return True
 
-    first_file = volumeFromFile(args[0])
-    img_dimensions_first = ([int(element) for element in first_file.getSizes()])
-    img_separations_first = first_file.separations
-    img_starts_first = first_file.starts
+    first_file = minc_header(args[0])
     for other_img in args[1:]:
-        other_volume = volumeFromFile(other_img)
-        if not img_dimensions_first   == ([int(element) for element in other_volume.getSizes()]) or \
-            not img_separations_first == other_volume.separations or \
-            not img_starts_first      == other_volume.starts :
+        other_volume = minc_header(other_img)
+        if not first_file.sizes           == other_volume.sizes or \
+            not first_file.separations    == other_volume.separations or \
+            not first_file.starts         == other_volume.starts :
             print("\nThe input files do not all have the same "
                   "dimensions/starts/step sizes. The first input "
                   "file:\n", str(args[0]), " differs from:\n",
@@ -2805,10 +2802,11 @@ def get_resolution_from_file(input_file: str) -> float:
     input_file -- string pointing to an existing MINC file
     """
     # quite important is that this file actually exists...
-    if not can_read_MINC_file(input_file):
+    # (if we've read its header before, it certainly does)
+    if not is_cached(input_file) and not can_read_MINC_file(input_file):
         raise IOError("\nError: can not read input file: %s\n" % input_file)
 
-    image_resolution = volumeFromFile(input_file).separations
+    image_resolution = minc_header(input_file).separations
 
     return min([abs(x) for x in image_resolution])
 
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+"""
+Compare construction time and memory usage of the server's stage graph (pydpiper.execution.graph.StageGraph)
+with the networkx-based graph it replaced, on synthetic pipelines of 10^5-10^6 stages.
+
+Usage: benchmark_stage_graph.py [n_stages ...]
+
+Each measurement runs in a fresh process so that the peak RSS numbers are independent.
+"""
+
+import random
+import resource
+import sys
+import time
+
+from multiprocessing import get_context
+
+import networkx as nx
+
+from pydpiper.execution.graph import StageGraph
+
+
+class ThinGraph(nx.DiGraph):
+    """the graph previously used by the server (see pydpiper.execution.pipeline)"""
+    all_edge_dict = {'weight': 1}
+    def single_edge_dict(self):
+        return self.all_edge_dict
+    edge_attr_dict_factory = single_edge_dict
+
+
+def synthetic_predecessors(n, chain_length=10, seed=0):
+    """chains of stages (as in multi-level registrations) with occasional dependencies
+    on earlier stages (as in averaging or resampling with an earlier transform)"""
+    rng = random.Random(seed)
+    preds = []
+    for i in range(n):
+        ps = [i - 1] if i % chain_length != 0 else []
+        if i > chain_length and rng.random() < 0.3:
+            j = rng.randrange(i - chain_length)
+            if j not in ps:
+                ps.append(j)
+        preds.append(ps)
+    return preds
+
+
+def max_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # kB on Linux
+
+
+def build_stage_graph(n, preds):
+    G = StageGraph.from_predecessors(n, preds)
+    counts = G.in_degrees()
+    return G, counts
+
+
+def build_networkx_graph(n, preds):
+    G = ThinGraph()
+    for i in range(n):
+        G.add_node(i, label="cmd", color="black")
+    for i, ps in enumerate(preds):
+        for p in ps:
+            G.add_edge(p, i)
+    counts = [len(list(G.predecessors(i))) for i in range(n)]
+    return G, counts
+
+
+def measure(builder, n, results):
+    preds = synthetic_predecessors(n)
+    rss_before = max_rss_mb()
+    t = time.time()
+    graph = builder(n, preds)
+    elapsed = time.time() - t
+    results.put((elapsed, max_rss_mb() - rss_before))
+    del graph
+
+
+def main(sizes):
+    ctx = get_context("fork")
+    print("%10s %14s %12s %14s" % ("stages", "graph", "build (s)", "peak RSS (MB)"))
+    for n in sizes:
+        for name, builder in [("StageGraph", build_stage_graph), ("networkx", build_networkx_graph)]:
+            results = ctx.Queue()
+            p = ctx.Process(target=measure, args=(builder, n, results))
+            p.start()
+            elapsed, rss = results.get()
+            p.join()
+            print("%10d %14s %12.2f %14.1f" % (n, name, elapsed, rss))
+
+
+if __name__ == "__main__":
+    main([int(a) for a in sys.argv[1:]] or [10**5, 3 * 10**5, 10**6])
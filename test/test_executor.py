@@ -0,0 +1,85 @@
+import os
+import time
+
+from argparse import Namespace
+
+import pytest
+
+from configargparse import ArgParser
+
+from pydpiper.core.arguments import _mk_execution_parser
+from pydpiper.execution.pipeline_executor import pipelineExecutor, StageInfo
+
+from test_pipeline import in_tmpdir  # noqa: F401 (fixtures)
+
+
+@pytest.fixture()
+def executor():
+    parser = ArgParser()
+    _mk_execution_parser(parser)
+    options = parser.parse_args(["--proc=4", "--mem=8", "--fs-delay=0"])
+    e = pipelineExecutor(options=options, uri_file="uri", pipeline_name="test")
+    e.clientURI = "exec"
+    return e
+
+
+def stage_info(ix, cmd, procs=1, output_files=()):
+    return StageInfo(mem=1.0, procs=procs, ix=ix, cmd=cmd, log_file="stage%d.log" % ix,
+                     output_files=list(output_files), env_vars={})
+
+
+class TestSupervisor():
+    def test_runs_and_accounts(self, executor):
+        executor.launchStage(stage_info(0, ["true"], procs=3))
+        executor.launchStage(stage_info(1, ["exit", "2"]))
+        assert executor.runningProcs == 4
+        executor.joinChildren()
+        assert executor.runningProcs == 0 and executor.runningMem == 0 and executor.runningChildren == {}
+        results = {r[0]: r for r in executor.finished_results}
+        assert results[0][1] == 0 and results[1][1] == 2
+        assert all(r[3] > 0 for r in results.values())  # peak memory use was measured
+
+    def test_kill(self, executor):
+        # (the shell doesn't `exec` the sleep, which must be killed too)
+        executor.launchStage(stage_info(0, ["sleep", "60", "&", "echo", "$!", ">", "sleep.pid;", "wait"]))
+        while executor.runningChildren[0].pid is None or not os.path.exists("sleep.pid") or not os.path.getsize("sleep.pid"):
+            time.sleep(0.01)
+        start = time.time()
+        executor.generalShutdownCall()
+        assert time.time() - start < 30
+        # (not reported as failed, so that the server treats the stage as lost)
+        assert executor.finished_results == []
+        with open("sleep.pid") as f:
+            sleep_pid = int(f.read())
+        time.sleep(0.1)
+        try:
+            with open("/proc/%d/stat" % sleep_pid) as f:
+                assert f.read().split()[2] == "Z"  # (killed, but not reaped by its new parent yet)
+        except FileNotFoundError:
+            pass
+
+    def test_check_outputs(self, executor):
+        executor.check_outputs, executor.fs_delay = True, 0.2
+        executor.launchStage(stage_info(0, ["touch", "a.txt"], output_files=["a.txt"]))
+        executor.launchStage(stage_info(1, ["true"], output_files=["b.txt"]))
+        executor.joinChildren()
+        assert sorted(r[:2] for r in executor.finished_results) == [(0, 0), (1, None)]
+
+
+class TestSubmission():
+    def test_whole_node_array(self, monkeypatch):
+        parser = ArgParser()
+        _mk_execution_parser(parser)
+        options = parser.parse_args(["--proc=1", "--ppn=16", "--mem=60", "--whole-node-executors",
+                                     "--queue-type=pbs"])
+        e = pipelineExecutor(options=options, uri_file="uri", pipeline_name="test")
+        submitted = []
+        monkeypatch.setattr("subprocess.run",
+                            lambda cmd, input, env: submitted.append((cmd, input.decode())) or Namespace(returncode=0))
+        monkeypatch.setattr("sys.argv", ["pipeline_executor.py", "--proc=1", "--whole-node-executors"])
+        e.submitToQueue(3)
+        # a single submission of one multi-core executor per task:
+        [(cmd, script)] = submitted
+        assert "--ppj=16" in cmd
+        lines = script.split('\n')
+        assert len(lines) == 3 and all("--proc 16" in l and "--proc=1" not in l for l in lines)
@@ -0,0 +1,55 @@
+import os
+import signal
+import threading
+import time
+
+from pydpiper.execution.journal import FinishedStagesJournal, load_finished_digests
+from pydpiper.execution.local import run_in_process
+
+from test_pipeline import in_tmpdir, mk_pipeline, stage  # noqa: F401 (fixtures)
+
+
+def run(stages, tmpdir, **kwargs):
+    for i, s in enumerate(stages):
+        s.setLogFile(str(tmpdir.join("stage%d.log" % i)))
+    p = mk_pipeline(stages, tmpdir, mem=4.0, proc=2, cmd_wrapper="", fs_delay=0, check_outputs=False,
+                    defer_directory_creation=False, **kwargs)
+    p.options.application.verbose = False
+    p.finished_stages_journal = FinishedStagesJournal(p.backupFileLocation)  # as in pipelineDaemon
+    p.finished_stages_journal.open()
+    try:
+        run_in_process(p)
+    finally:
+        p.finished_stages_journal.close()
+    return p
+
+
+class TestInProcess():
+    def test_runs_stages_in_order(self, tmpdir):
+        p = run([stage("touch", [], ["a.txt"]),
+                 stage("cp", ["a.txt"], ["b.txt"]),
+                 stage("cp", ["b.txt"], ["c.txt"])], tmpdir)
+        assert p.allStagesCompleted() and os.path.exists("c.txt")
+        assert len(load_finished_digests(p.backupFileLocation)) == 3
+        assert p.clients == {}
+
+    def test_failed_stage(self, tmpdir):
+        p = run([stage("touch", [], ["a.txt"]),
+                 stage("false", ["a.txt"], ["b.txt"]),
+                 stage("cp", ["b.txt"], ["c.txt"])], tmpdir)
+        assert not p.allStagesCompleted()
+        assert p.stage_retries[1] == 2 and set(p.failedStages) == {1, 2}
+        assert p.isStageFinished(0) and not os.path.exists("c.txt")
+
+    def test_stage_too_large(self, tmpdir, capsys):
+        p = run([stage("touch", [], ["a.txt"], mem=64.0)], tmpdir)
+        assert not p.allStagesCompleted() and "requires 64.00G" in capsys.readouterr().out
+
+    def test_keyboard_interrupt(self, tmpdir):
+        threading.Timer(0.5, os.kill, (os.getpid(), signal.SIGINT)).start()
+        p = run([stage("touch", [], ["a.txt"]),
+                 stage("sleep 1 && touch", [], ["b.txt"])], tmpdir)
+        time.sleep(1.5)
+        # the running stage was killed, but the one which finished was recorded
+        assert os.path.exists("a.txt") and not os.path.exists("b.txt")
+        assert len(load_finished_digests(p.backupFileLocation)) == 1
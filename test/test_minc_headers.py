@@ -0,0 +1,71 @@
+import os
+
+import pytest
+
+from pydpiper.minc import headers
+from pydpiper.minc.headers import MincHeader, MincHeaderCache
+from pydpiper.minc.registration import check_MINC_files_have_equal_dimensions_and_resolution
+
+
+def fake_header(sizes):
+    return MincHeader(sizes=sizes, separations=(0.05, 0.05, 0.05), starts=(-5.0, -5.0, -5.0), dtype="float")
+
+
+class CountingReader(object):
+    def __init__(self, sizes=(100, 200, 150)):
+        self.sizes = sizes
+        self.reads = []
+
+    def __call__(self, path):
+        self.reads.append(path)
+        return fake_header(self.sizes)
+
+
+@pytest.fixture()
+def img(tmpdir):
+    path = str(tmpdir.join("img.mnc"))
+    with open(path, 'w') as fh:
+        fh.write("not really MINC")
+    return path
+
+
+class TestMincHeaderCache():
+    def test_read_once(self, img):
+        reader = CountingReader()
+        cache = MincHeaderCache(read=reader)
+        assert cache.get(img).sizes == (100, 200, 150)
+        assert cache.get(img) == cache.get(os.path.relpath(img))
+        assert len(reader.reads) == 1
+
+    def test_changed_file_reread(self, img):
+        reader = CountingReader()
+        cache = MincHeaderCache(read=reader)
+        cache.get(img)
+        with open(img, 'a') as fh:
+            fh.write("more")
+        reader.sizes = (10, 10, 10)
+        assert cache.get(img).sizes == (10, 10, 10) and len(reader.reads) == 2
+
+    def test_store(self, img, tmpdir):
+        store = str(tmpdir.join(headers.STORE_FILENAME))
+        cache = MincHeaderCache(read=CountingReader())
+        cache.use_store(store)
+        header = cache.get(img)
+        with open(store, 'a') as fh:
+            fh.write('{"path": "/trunc')  # e.g., a concurrent writer was killed
+        reader = CountingReader()
+        other = MincHeaderCache(read=reader)
+        other.use_store(store)
+        assert other.is_cached(img) and other.get(img) == header and reader.reads == []
+
+
+def test_check_dimensions(tmpdir, monkeypatch):
+    paths = [str(tmpdir.join("img%d.mnc" % i)) for i in range(3)]
+    for i, path in enumerate(paths):
+        with open(path, 'w') as fh:
+            fh.write(str(i))
+    monkeypatch.setattr(headers, "_cache",
+                        MincHeaderCache(read=lambda p: fake_header((10, 10, 11) if p.endswith("2.mnc") else (10, 10, 10))))
+    check_MINC_files_have_equal_dimensions_and_resolution(paths[:2])
+    with pytest.raises(ValueError):
+        check_MINC_files_have_equal_dimensions_and_resolution(paths)
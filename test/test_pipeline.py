@@ -0,0 +1,484 @@
+import csv
+import json
+import math
+import os
+import signal
+import threading
+
+import pytest
+
+from configargparse import Namespace
+
+from pydpiper.execution.journal import FinishedStagesJournal, load_finished_digests, rewrite, stage_digest
+from pydpiper.execution.pipeline import EXECUTOR_LAUNCH_TIMEOUT, Pipeline, CmdStage, InputFile, OutputFile
+from pydpiper.execution.profiling import ServerProfile, profile_paths
+from pydpiper.execution.trace import trace_paths
+from pydpiper.execution.usage import ResourceUsageModel, STORE_FILENAME, usage_key
+
+
+@pytest.fixture(autouse=True)
+def in_tmpdir(tmpdir, monkeypatch):
+    # the pipeline keeps its record of finished stages in the current directory
+    monkeypatch.chdir(tmpdir)
+
+
+def mk_options(tmpdir, smart_restart=False, **kwargs):
+    execution = dict(submit_server=False, local=True, default_job_mem=1.0, memory_factor=1.0,
+                     learn_resources=False, stage_trace=False, whole_node_executors=False,
+                     stage_cache_dir=None, stage_cache_max_size=None, stage_cache_max_age=None,
+                     fuse_stages=False, urifile=None, queue_type=None, time=None)
+    execution.update(kwargs)
+    return Namespace(application=Namespace(pipeline_name="test", output_directory=str(tmpdir),
+                                           smart_restart=smart_restart),
+                     execution=Namespace(**execution))
+
+
+def mk_pipeline(stages, tmpdir, restart=False, **kwargs):
+    p = Pipeline(stages=stages, options=mk_options(tmpdir, **kwargs))
+    p.shutdown_ev = threading.Event()  # normally created by launchServer
+    # as in pipelineDaemon:
+    if restart:
+        p.skip_completed_stages()
+    else:
+        p.enqueue_graph_heads()
+    return p
+
+
+def stage(cmd, inputs, outputs, mem=None):
+    s = CmdStage([cmd] + [InputFile(i) for i in inputs] + [OutputFile(o) for o in outputs])
+    s.mem = mem
+    s.env_vars = {}  # normally set by convertCmdStage
+    return s
+
+
+def registration_stages(xfm="nlin.xfm"):
+    # a long registration chain plus a cheap stage that nothing depends on
+    return [stage("mincpik", ["in.mnc"], ["qc.png"]),
+            stage("mincblur", ["in.mnc"], ["blur.mnc"]),
+            stage("ANTS", ["blur.mnc"], [xfm]),
+            stage("mincresample", [xfm], ["resampled.mnc"])]
+
+
+@pytest.fixture()
+def pipeline(tmpdir):
+    return mk_pipeline(registration_stages(), tmpdir)
+
+
+class TestScheduling():
+    def test_critical_path_first(self, pipeline):
+        assert sorted(pipeline.runnable) == [0, 1]
+        assert pipeline.getRunnableStageIndex() == ("run_stage", 1)
+        assert pipeline.getRunnableStageIndex() == ("run_stage", 0)
+        assert pipeline.getRunnableStageIndex() == ("wait", None)
+
+    def test_priorities_include_downstream_work(self, pipeline):
+        assert pipeline.compute_stage_priorities()[1] > pipeline.compute_stage_priorities()[2] > \
+               pipeline.compute_stage_priorities()[3]
+
+
+@pytest.fixture()
+def wide_pipeline(tmpdir):
+    stages = [stage("ANTS", ["in%d.mnc" % i], ["out%d.xfm" % i], mem=mem)
+              for i, mem in enumerate([8.0, 1.0, 3.0, 2.0])]
+    return mk_pipeline(stages, tmpdir)
+
+
+class TestResourceMatching():
+    def test_largest_fitting_stage(self, wide_pipeline):
+        assert wide_pipeline.getCommand("exec", clientMemFree=4.0, clientProcsFree=1) == ("run_stage", 2)
+        assert wide_pipeline.getCommand("exec", clientMemFree=2.5, clientProcsFree=1) == ("run_stage", 3)
+
+    def test_priority_before_size(self, tmpdir):
+        # the small mincblur starts a long chain, while nothing depends on the big mincpik
+        p = mk_pipeline([stage("mincpik", ["in.mnc"], ["qc.png"], mem=4.0),
+                         stage("mincblur", ["in.mnc"], ["blur.mnc"], mem=1.0),
+                         stage("ANTS", ["blur.mnc"], ["nlin.xfm"], mem=1.0)], tmpdir)
+        assert p.getCommand("exec", clientMemFree=8.0, clientProcsFree=1) == ("run_stage", 1)
+        assert p.getCommand("exec", clientMemFree=8.0, clientProcsFree=1) == ("run_stage", 0)
+
+    def test_nothing_fits(self, wide_pipeline):
+        assert wide_pipeline.getCommand("exec", clientMemFree=0.5, clientProcsFree=1) == ("wait", None)
+        assert len(wide_pipeline.runnable) == 4
+
+    def test_batch_fits_together(self, wide_pipeline):
+        flag, stages = wide_pipeline.getCommands("exec", clientMemFree=6.0, clientProcsFree=4, max_n=4)
+        assert flag == "run_stage"
+        assert [s.ix for s in stages] == [2, 3, 1]
+        assert wide_pipeline.getCommands("exec", clientMemFree=6.0, clientProcsFree=4, max_n=4) == ("wait", [])
+
+    def test_runnable_memory_requirements(self, wide_pipeline):
+        assert wide_pipeline.max_memory_required() == 8.0
+        assert wide_pipeline.getMemoryRequirementsRunnable() == [(8.0, 1), (3.0, 1), (2.0, 1), (1.0, 1)]
+        wide_pipeline.getCommand("exec", clientMemFree=16.0, clientProcsFree=1)
+        assert wide_pipeline.max_memory_required() == 3.0
+        assert wide_pipeline.runnable.top_memory_sum(2) == 5.0
+
+
+class TestExecutorSizing():
+    @pytest.fixture()
+    def mixed_pipeline(self, tmpdir, monkeypatch):
+        stages = [stage("ANTS", ["big.mnc"], ["big.xfm"], mem=60.0)] + \
+                 [stage("mincblur", ["in%d.mnc" % i], ["blur%d.mnc" % i], mem=2.0) for i in range(8)]
+        p = mk_pipeline(stages, tmpdir, num_exec=10, greedy=False, proc=4, max_failed_executors=2,
+                        monitor_heartbeats=False)
+        p.memAvail = 64.0
+        p.launched = []
+        monkeypatch.setattr(p, "launchExecutorsFromServer", lambda n, mem: p.launched.append((mem, n)))
+        return p
+
+    def test_size_classes(self, mixed_pipeline):
+        mixed_pipeline.manageExecutors()
+        # one big executor (also taking two small stages), then executors for 4 and 2 small stages:
+        assert mixed_pipeline.launched == [(64.0, 1), (8.0, 1), (4.0, 1)]
+
+    def test_oversized_stage(self, mixed_pipeline):
+        mixed_pipeline.memAvail = 32.0
+        assert mixed_pipeline.numberOfExecutorsToLaunch() == 8
+        mixed_pipeline.manageExecutors()
+        assert mixed_pipeline.launched == [(8.0, 2)]
+
+    def test_whole_node_executors(self, mixed_pipeline):
+        mixed_pipeline.exec_options.whole_node_executors = True
+        mixed_pipeline.exec_options.ppn = 8
+        mixed_pipeline.manageExecutors()
+        # each executor fills a node's memory (and processors):
+        assert mixed_pipeline.launched == [(64.0, 2)]
+
+
+class TestWalltimeAdmission():
+    @pytest.fixture()
+    def mixed(self, tmpdir):
+        # (by default, ANTS stages are expected to run for over an hour and mincblur for a few minutes)
+        p = mk_pipeline([stage("mincblur", ["b.mnc"], ["blur.mnc"]),
+                         stage("ANTS", ["blur.mnc"], ["b.xfm"]),
+                         stage("ANTS", ["a.mnc"], ["a.xfm"])], tmpdir)
+        for c in ["exec1", "exec2"]:
+            p.registerClient(c, 16.0)
+        return p
+
+    def test_only_stages_finishing_in_time(self, mixed):
+        flag, stages = mixed.claim("exec1", clientMemFree=16.0, clientProcsFree=4, max_n=4, walltime_left=600)
+        assert [s.ix for s in stages] == [0]
+        assert not mixed.waitForWork("exec1", 16.0, 3, timeout=1, walltime_left=600)
+        assert mixed.waitForWork("exec2", 16.0, 4, timeout=1, walltime_left=20000)
+
+    def test_critical_path_before_long_stages(self, mixed):
+        # even an executor with plenty of time gets the mincblur on the critical path first
+        assert mixed.getCommand("exec2", 16.0, 1, walltime_left=20000) == ("run_stage", 0)
+        assert mixed.getCommand("exec1", 16.0, 1, walltime_left=600) == ("wait", None)
+        assert mixed.getCommand("exec2", 16.0, 1, walltime_left=20000) == ("run_stage", 2)
+
+    def test_stages_longer_than_any_walltime(self, tmpdir):
+        # (an ANTS stage is expected to take well over the executors' 30 minutes, but must still run)
+        p = mk_pipeline([stage("ANTS", ["a.mnc"], ["a.xfm"])], tmpdir, queue_type="pbs", time="00:30:00")
+        p.registerClient("exec", 16.0)
+        assert p.getCommand("exec", 16.0, 1, walltime_left=600) == ("wait", None)
+        assert p.has_work_for(16.0, 1, walltime_left=1790)
+        assert p.getCommand("exec", 16.0, 1, walltime_left=1790) == ("run_stage", 0)
+
+
+class TestStageCache():
+    def mk_cached_pipeline(self, tmpdir, name, stages=None):
+        d = tmpdir.mkdir(name)
+        p = mk_pipeline(stages(d) if stages else
+                        [stage("mincblur", [str(tmpdir / "in.mnc")], [str(d / "blur.mnc")]),
+                         stage("mincresample", [str(d / "blur.mnc")], [str(d / "resampled.mnc")])],
+                        d, stage_cache_dir=str(tmpdir / "cache"))
+        p.registerClient("exec", 16.0)
+        p.finished_stages_journal = FinishedStagesJournal(p.backupFileLocation)
+        p.finished_stages_journal.open()
+        # (as the server does periodically)
+        p.collect_cache_lookups(wait=True)
+        return p, d
+
+    def test_reuse_across_pipelines(self, tmpdir):
+        (tmpdir / "in.mnc").write("image")
+        p, d = self.mk_cached_pipeline(tmpdir, "first")
+        for ix, output in [(0, "blur.mnc"), (1, "resampled.mnc")]:
+            p.collect_cache_lookups(wait=True)
+            assert p.getCommand("exec", 16.0, 1) == ("run_stage", ix)
+            p.setStageStarted(ix, "exec")
+            (d / output).write(output)
+            p.report("exec", [(ix, 0, 1.0, 0.1, 1.0)])
+        p.flush_stage_cache()
+        # another pipeline (with other output files) doesn't need to run anything:
+        q, e = self.mk_cached_pipeline(tmpdir, "second")
+        assert q.allStagesCompleted() and q.stage_cache.hits == 2
+        assert (e / "resampled.mnc").read() == "resampled.mnc"
+        assert os.access(str(e / "resampled.mnc"), os.W_OK)
+        assert q.getStatusSnapshot()["stage_cache_hits"] == 2
+        # (the restored stages are recorded as finished, e.g., for a restart without the cache)
+        q.flush_journal()
+        assert {q.getStageDigest(i) for i in [0, 1]} <= load_finished_digests(q.backupFileLocation)
+
+    def test_changed_input(self, tmpdir):
+        (tmpdir / "in.mnc").write("image")
+        p, d = self.mk_cached_pipeline(tmpdir, "first")
+        p.claim("exec", 16.0, 1, max_n=1)
+        (d / "blur.mnc").write("blurred")
+        p.report("exec", [(0, 0, 1.0, 0.1, 1.0)])
+        p.flush_stage_cache()
+        (tmpdir / "in.mnc").write("another image")
+        q, _ = self.mk_cached_pipeline(tmpdir, "second")
+        assert q.stage_cache.hits == 0 and 0 in q.runnable
+
+    def test_changed_input_within_argument(self, tmpdir):
+        # (as antsRegistration's metrics, which name their inputs within a single argument)
+        fixed = str(tmpdir / "fixed.mnc")
+        def registration(d):
+            s = CmdStage(["antsRegistration", "CC[%s,1,4]" % fixed, OutputFile(str(d / "nlin.xfm"))])
+            s.inputFiles = (fixed,)
+            return [s]
+        (tmpdir / "fixed.mnc").write("image")
+        p, d = self.mk_cached_pipeline(tmpdir, "first", stages=registration)
+        p.claim("exec", 16.0, 1, max_n=1)
+        (d / "nlin.xfm").write("transform")
+        p.report("exec", [(0, 0, 1.0, 0.1, 1.0)])
+        p.flush_stage_cache()
+        (tmpdir / "fixed.mnc").write("another image")
+        q, _ = self.mk_cached_pipeline(tmpdir, "second", stages=registration)
+        assert q.stage_cache.hits == 0 and 0 in q.runnable
+
+
+class TestStageFusion():
+    @pytest.fixture()
+    def fused(self, tmpdir):
+        p = mk_pipeline([stage("mincblur", ["in.mnc"], ["blur.mnc"], mem=1.0),
+                         stage("mincresample", ["blur.mnc"], ["resampled.mnc"], mem=4.0),
+                         stage("ANTS", ["resampled.mnc"], ["nlin.xfm"], mem=2.0)],
+                        tmpdir, fuse_stages=True)
+        p.registerClient("exec", 16.0)
+        p.finished_stages_journal = FinishedStagesJournal(p.backupFileLocation)
+        p.finished_stages_journal.open()
+        return p
+
+    def test_chains(self, fused):
+        # (the ANTS stage is too expensive to be fused with the others)
+        assert list(fused.chain_next) == [1, -1, -1]
+
+    def test_single_job(self, fused):
+        flag, stages = fused.claim("exec", 16.0, 1, max_n=4)
+        assert flag == "run_stage" and [(s.ix, s.mem) for s in stages] == [(0, 4.0)]
+        assert stages[0].cmd[:2] == ["sh", "-c"] and stages[0].output_files == ["blur.mnc", "resampled.mnc"]
+        assert list(fused.stage_status[:2]) == [1, 1]
+        # (the job reserves the memory of the larger stage only)
+        [client] = fused.getStatusSnapshot()["executors"]["clients"]
+        assert client["mem_free"] == 12.0
+        fused.report("exec", [(0, 0, 1.0, 0.1, 1.0)])
+        assert fused.isStageFinished(0) and fused.isStageFinished(1) and list(fused.runnable) == [2]
+        # (each stage is still recorded as finished separately, e.g., for restarts)
+        assert load_finished_digests(fused.backupFileLocation) == {fused.getStageDigest(i) for i in [0, 1]}
+
+    @pytest.mark.parametrize("fail", [lambda p: p.report("exec", [(0, 1, 1.0, 0.1, 1.0)]),
+                                      lambda p: p.unregisterClient("exec")])
+    def test_rerun_together(self, fused, fail):
+        fused.claim("exec", 16.0, 1, max_n=4)
+        fail(fused)
+        assert list(fused.stage_status) == [0, 0, 0] and list(fused.runnable) == [0]
+        assert fused.stage_resources(0) == (4.0, 1)
+
+
+class TestExecutorLaunches():
+    def test_progressive_registration(self, pipeline, monkeypatch):
+        monkeypatch.setattr("pydpiper.execution.pipeline.launchPipelineExecutors", lambda **kwargs: None)
+        pipeline.launchExecutorsFromServer(3, 8.0)
+        pipeline.launchExecutorsFromServer(1, 4.0)
+        assert pipeline.getNumberOfQueuedClients() == 4
+        # (executors are credited to the launch of their size, whichever starts first)
+        pipeline.registerClient("exec1", 4.0)
+        pipeline.registerClient("exec2", 8.0)
+        launches = pipeline.getStatusSnapshot()["executors"]["launches"]
+        assert [(l["number"], l["mem"], l["registered"]) for l in launches] == [(3, 8.0, 1)]
+        pipeline.registerClient("exec3", 8.0)
+        pipeline.registerClient("exec4", 8.0)
+        assert pipeline.launches == [] and pipeline.getNumberOfQueuedClients() == 0
+
+    def test_expiry(self, pipeline, monkeypatch):
+        monkeypatch.setattr("pydpiper.execution.pipeline.launchPipelineExecutors", lambda **kwargs: None)
+        pipeline.launchExecutorsFromServer(2, 8.0)
+        pipeline.launchExecutorsFromServer(1, 4.0)
+        pipeline.launches[0].timestamp -= EXECUTOR_LAUNCH_TIMEOUT + 1
+        pipeline.registerClient("exec1", 8.0)
+        pipeline.expire_launches()
+        # (the executor of the launch which never started no longer counts as queued)
+        assert [l.mem for l in pipeline.launches] == [4.0] and pipeline.getNumberOfQueuedClients() == 1
+
+
+class TestStageStatus():
+    def test_status_columns(self, pipeline):
+        assert not any(pipeline.isStageFinished(i) for i in range(len(pipeline.stages)))
+        pipeline.registerClient("exec", 16.0)
+        pipeline.finished_stages_journal = FinishedStagesJournal(pipeline.backupFileLocation)
+        pipeline.finished_stages_journal.open()
+        pipeline.setStageStarted(1, "exec")
+        pipeline.setStageFinished(1, "exec", save_state=False)
+        assert pipeline.isStageFinished(1)
+        assert 2 in pipeline.runnable
+
+    def test_prepare_to_run_only_once(self, wide_pipeline):
+        # enqueue (which prepares stages) may run several times for a stage
+        wide_pipeline.enqueue(0)
+        wide_pipeline.prepare_to_run(0)
+        assert wide_pipeline.stages[0].mem == 8.0
+
+
+class TestClaimAndReport():
+    @pytest.fixture()
+    def claimed(self, pipeline):
+        pipeline.registerClient("exec", 16.0)
+        pipeline.finished_stages_journal = FinishedStagesJournal(pipeline.backupFileLocation)
+        pipeline.finished_stages_journal.open()
+        pipeline.clients["exec"].timestamp = 0
+        flag, stages = pipeline.claim("exec", clientMemFree=16.0, clientProcsFree=2, max_n=2)
+        assert flag == "run_stage" and [s.ix for s in stages] == [1, 0]
+        return pipeline
+
+    def test_claim_starts_stages(self, claimed):
+        assert claimed.clients["exec"].running_stages == {0, 1}
+        assert claimed.currently_running_stages == {0, 1}
+        assert claimed.clients["exec"].timestamp > 0  # the claim counts as a heartbeat
+        assert claimed.claim("exec", clientMemFree=16.0, clientProcsFree=2, max_n=2) == ("wait", [])
+
+    def test_report(self, claimed):
+        claimed.report("exec", [(1, 0, 5.0, 0.5, 4.5), (0, 1, 1.0, 0.1, 0.5)])
+        assert claimed.isStageFinished(1) and (claimed.stage_maxrss[1], claimed.stage_cputime[1]) == (0.5, 4.5)
+        assert 2 in claimed.runnable
+        assert 0 in claimed.runnable and claimed.stage_retries[0] == 1  # to be retried
+        assert claimed.clients["exec"].running_stages == set()
+
+    def test_duplicate_report_ignored(self, claimed):
+        claimed.report("exec", [(1, 0, 5.0, 0.5, 4.5)])
+        claimed.report("exec", [(1, 0, 5.0, 0.5, 4.5)])  # e.g., a retried call
+        assert claimed.num_finished_stages == 1
+
+    def test_status_snapshot(self, claimed):
+        claimed.report("exec", [(1, 0, 5.0, 0.5, 4.5)])
+        status = claimed.getStatusSnapshot(minutes=5)
+        assert status["stages"] == dict(total=4, finished=1, running=1, runnable=1, waiting=1,
+                                        failed=0, failed_or_blocked=0)
+        assert [(s["ix"], s["cmd"]) for s in status["running_stages"]] == [(0, "mincpik in.mnc qc.png")]
+        [client] = status["executors"]["clients"]
+        assert (client["uri"], client["mem_free"], client["running_stages"]) == ("exec", 15.0, [0])
+        assert status["throughput"] == dict(minutes=5, finished=1, per_minute=0.2)
+
+
+class TestLearnedResources():
+    def test_learned_estimates(self, tmpdir):
+        model = ResourceUsageModel(str(tmpdir.join(STORE_FILENAME)))
+        for _ in range(3):
+            model.record(usage_key(["mincblur"]), size=0, maxrss=2.5, runtime=30.0)
+        model.flush()
+        p = mk_pipeline(registration_stages(), tmpdir, learn_resources=True)
+        assert p.stages[1].mem == 3.0 and p.stages[0].mem == 1.0  # (2.5G plus margin; no samples for mincpik)
+        assert p.estimated_runtime(1) == 30.0 and p.estimated_runtime(0) is None
+        # (the size is only measured for stages there are samples for)
+        assert p.stage_sizes[1] == 0.0 and math.isnan(p.stage_sizes[0])
+
+    def test_learned_estimates_only_raise(self, tmpdir):
+        model = ResourceUsageModel(str(tmpdir.join(STORE_FILENAME)))
+        for _ in range(3):
+            model.record(usage_key(["mincblur"]), size=0, maxrss=0.5, runtime=30.0)
+        model.flush()
+        p = mk_pipeline(registration_stages(), tmpdir, learn_resources=True, memory_factor=2.0)
+        assert p.stages[1].mem == 2.0  # (the static estimate times the memory factor, not 0.625G)
+
+    def test_out_of_memory(self, tmpdir):
+        p = mk_pipeline(registration_stages(), tmpdir, learn_resources=True)
+        p.registerClient("exec", 16.0)
+        p.finished_stages_journal = FinishedStagesJournal(p.backupFileLocation)
+        p.finished_stages_journal.open()
+        p.claim("exec", clientMemFree=16.0, clientProcsFree=2, max_n=2)
+        p.report("exec", [(1, -signal.SIGKILL, 5.0, 0.9, 1.0), (0, 0, 1.0, 0.2, 0.5)])
+        assert p.stages[1].mem == 1.5 and p.runnable.memory_counts() == [(1.5, 1)]
+        p.flush_journal()
+        samples = ResourceUsageModel(str(tmpdir.join(STORE_FILENAME))).samples
+        assert samples[usage_key(["mincblur"])] == [(0.0, 1.5, None)]
+        assert samples[usage_key(["mincpik"])] == [(0.0, 0.2, 1.0)]
+
+
+class TestStageTrace():
+    def test_trace(self, tmpdir):
+        p = mk_pipeline(registration_stages(), tmpdir, stage_trace=True)
+        p.registerClient("PYRO:obj@node1:4000", 16.0)
+        p.finished_stages_journal = FinishedStagesJournal(p.backupFileLocation)
+        p.finished_stages_journal.open()
+        p.claim("PYRO:obj@node1:4000", clientMemFree=16.0, clientProcsFree=2, max_n=2)
+        p.report("PYRO:obj@node1:4000", [(1, 0, 5.0, 0.5, 4.5), (0, 1, 1.0, 0.1, 0.5)])
+        p.unregisterClient("PYRO:obj@node1:4000")
+        p.write_trace()
+        json_file, csv_file = trace_paths(str(tmpdir), "test")
+        with open(csv_file) as fh:
+            rows = list(csv.DictReader(fh))
+        assert [(r["stage"], r["event"]) for r in rows] == \
+               [("0", "runnable"), ("1", "runnable"), ("1", "claimed"), ("0", "claimed"), ("1", "started"),
+                ("0", "started"), ("1", "finished"), ("2", "runnable"), ("0", "failed"), ("0", "runnable")]
+        assert rows[6]["tool"] == "mincblur" and rows[6]["host"] == "node1" and float(rows[6]["maxrss"]) == 0.5
+        with open(json_file) as fh:
+            spans = [e for e in json.load(fh)["traceEvents"] if e["ph"] == "X"]
+        assert sorted((e["name"], e["cat"]) for e in spans) == [("mincblur", "finished"), ("mincpik", "failed")]
+
+
+class TestServerProfile():
+    def test_outermost_calls_timed(self, pipeline, tmpdir):
+        pipeline.profile = ServerProfile()
+        pipeline.profile.instrument(pipeline)
+        pipeline.registerClient("exec", 16.0)
+        pipeline.finished_stages_journal = FinishedStagesJournal(pipeline.backupFileLocation)
+        pipeline.finished_stages_journal.open()
+        pipeline.claim("exec", clientMemFree=16.0, clientProcsFree=2, max_n=2)
+        pipeline.report("exec", [(1, 0, 5.0, 0.5, 4.5), (0, 0, 1.0, 0.1, 0.5)])
+        # (the time spent in, e.g., setStageFinished is part of the time of the report call)
+        profile = pipeline.getStatusSnapshot()["profile"]
+        assert {m: p["calls"] for m, p in profile.items()} == dict(registerClient=1, claim=1, report=1)
+        pipeline.write_profile()
+        latency_file, _ = profile_paths(str(tmpdir), "test")
+        with open(latency_file) as fh:
+            assert sum(json.load(fh)["methods"]["report"]["counts"]) == 1
+
+
+class TestRestart():
+    def test_journal_records_finished_stages(self, pipeline, tmpdir):
+        pipeline.registerClient("exec", 16.0)
+        pipeline.finished_stages_journal = FinishedStagesJournal(pipeline.backupFileLocation, flush_records=2)
+        pipeline.finished_stages_journal.open()
+        for i in [1, 0]:
+            pipeline.setStageStarted(i, "exec")
+            pipeline.setStageFinished(i, "exec")
+        assert load_finished_digests(pipeline.backupFileLocation) == \
+               {stage_digest(pipeline.stages[i].getHash()) for i in [0, 1]}
+
+    def test_changed_stages_rerun(self, tmpdir):
+        p = mk_pipeline(registration_stages(), tmpdir)
+        rewrite(p.backupFileLocation, [(p.getStageDigest(i), 0.0, 0.0) for i in range(4)])
+        # the ANTS stage has changed, so it and its descendants must re-run:
+        restarted = mk_pipeline(registration_stages(xfm="nlin2.xfm"), tmpdir, restart=True)
+        assert [restarted.isStageFinished(i) for i in range(4)] == [True, True, False, False]
+        assert list(restarted.runnable) == [2]
+        assert len(load_finished_digests(p.backupFileLocation)) == 2
+        # no hooks were run for the skipped stages:
+        assert list(restarted.stage_prepared) == [0, 0, 1, 0]
+
+    def test_smart_restart(self, tmpdir):
+        for f in ["in.mnc", "qc.png", "blur.mnc", "nlin.xfm", "resampled.mnc"]:
+            tmpdir.join(f).write("")
+        stages = [stage(s.cmd[0], [str(tmpdir.join(f)) for f in s.inputFiles],
+                        [str(tmpdir.join(f)) for f in s.outputFiles])
+                  for s in registration_stages()]
+        p = mk_pipeline(stages, tmpdir)
+        rewrite(p.backupFileLocation, [(p.getStageDigest(i), 0.0, 0.0) for i in range(4)])
+        # blur.mnc was modified after nlin.xfm was created from it:
+        for f in ["in.mnc", "qc.png", "nlin.xfm", "resampled.mnc"]:
+            os.utime(str(tmpdir.join(f)), (0, 0))
+        restarted = mk_pipeline(stages, tmpdir, restart=True, smart_restart=True)
+        assert sorted(restarted.runnable) == [2]
+
+    def test_legacy_journal(self, tmpdir):
+        p = mk_pipeline(registration_stages(), tmpdir)
+        with open(p.backupFileLocation, 'w') as fh:
+            fh.write("1,%s\n" % p.stages[1].getHash())
+        restarted = mk_pipeline(registration_stages(), tmpdir, restart=True)
+        assert restarted.isStageFinished(1) and not restarted.isStageFinished(0)
+        assert sorted(restarted.runnable) == [0, 2]
+        # rewritten in the new format:
+        with open(p.backupFileLocation, 'rb') as fh:
+            assert fh.read(8) == b"PYDPJNL1"
@@ -0,0 +1,162 @@
+import asyncio
+import json
+import threading
+import urllib.request
+
+import pytest
+
+from pydpiper.execution import rpc
+from pydpiper.execution.pipeline_executor import StageInfo
+
+from pydpiper.execution.journal import FinishedStagesJournal
+from pydpiper.execution.metrics import start_metrics_server
+
+from test_pipeline import in_tmpdir, wide_pipeline, mk_pipeline, stage  # noqa: F401 (fixtures)
+
+
+@pytest.fixture()
+def serve():
+    """Serve an object from an event loop running in another thread, returning the server's URI."""
+    loop = asyncio.new_event_loop()
+    servers = []
+    t = threading.Thread(target=loop.run_forever, daemon=True)
+    t.start()
+
+    def _serve(obj):
+        server = rpc.Server(obj, host="127.0.0.1")
+        asyncio.run_coroutine_threadsafe(server.start(), loop).result()
+        servers.append(server)
+        return server.uri
+
+    yield _serve
+    for server in servers:
+        asyncio.run_coroutine_threadsafe(server.close(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+    t.join()
+    loop.close()
+
+
+class Echo(object):
+    def echo(self, x):
+        return x
+
+    def _private(self):
+        return "secret"
+
+
+class TestRPC():
+    def test_registered_classes(self, serve):
+        p = rpc.connect(serve(Echo()))
+        s = StageInfo(mem=1.0, procs=1, ix=3, cmd=["ANTS", "a.mnc"], log_file="ANTS.log",
+                      output_files=["a.xfm"], env_vars={})
+        t = p.echo(s)
+        assert isinstance(t, StageInfo) and vars(t) == vars(s)
+
+    def test_private_methods(self, serve):
+        p = rpc.connect(serve(Echo()))
+        with pytest.raises(AttributeError):
+            p._private()
+        with pytest.raises(rpc.RemoteError):
+            p._call("_private")
+
+    def test_reconnect_after_release(self, serve):
+        p = rpc.connect(serve(Echo()))
+        assert p.echo(1) == 1
+        p._release()
+        assert p.echo([1, 2]) == [1, 2]
+
+    def test_connection_refused(self):
+        with pytest.raises(rpc.CommunicationError):
+            rpc.connect(rpc.format_uri("127.0.0.1", 1)).echo(1)
+
+    def test_serve_pipeline(self, serve, wide_pipeline):
+        p = rpc.connect(serve(wide_pipeline))
+        p.registerClient("exec", 16.0)
+        flag, stages = p.getCommands(clientURIstr="exec", clientMemFree=4.0, clientProcsFree=1, max_n=1)
+        assert flag == "run_stage" and [s.ix for s in stages] == [2]
+        assert p.getMemoryRequirementsRunnable() == [[8.0, 1], [2.0, 1], [1.0, 1]]
+
+    def test_status_endpoint(self, serve, wide_pipeline):
+        uri = serve(wide_pipeline)
+        rpc.connect(uri).registerClient("exec", 16.0)
+        httpd = start_metrics_server(0, rpc.PersistentProxy(uri).getStatusSnapshot)
+        try:
+            url = "http://127.0.0.1:%d" % httpd.server_address[1]
+            with urllib.request.urlopen(url + "/metrics") as response:
+                metrics = response.read().decode()
+            with urllib.request.urlopen(url + "/status") as response:
+                status = json.loads(response.read().decode())
+        finally:
+            httpd.shutdown()
+        assert 'pydpiper_stages{state="runnable"} 4' in metrics.splitlines()
+        assert 'pydpiper_executor_memory_free_gigabytes{executor="exec"} 16.0' in metrics.splitlines()
+        assert status["runnable_memory"] == [[8.0, 1], [3.0, 1], [2.0, 1], [1.0, 1]]
+
+    def test_wait_for_work(self, serve, tmpdir):
+        pipeline = mk_pipeline([stage("ANTS", ["in.mnc"], ["nlin.xfm"], mem=8.0),
+                                stage("xfminvert", ["nlin.xfm"], ["inv.xfm"], mem=1.0)], tmpdir)
+        pipeline.finished_stages_journal = FinishedStagesJournal(pipeline.backupFileLocation)
+        pipeline.finished_stages_journal.open()
+        pipeline.work_waiters = {}  # as in launchAsyncioServer
+        uri = serve(pipeline)
+        big, small = rpc.connect(uri), rpc.connect(uri)
+        big.registerClient("big", 16.0)
+        small.registerClient("small", 2.0)
+        assert small.waitForWork("small", 2.0, 1, timeout=0.05) is False
+        waited = []
+        t = threading.Thread(target=lambda: waited.append(small.waitForWork("small", 2.0, 1, timeout=30)))
+        t.start()
+        assert big.getCommand("big", 16.0, 1) == ["run_stage", 0]
+        big.setStageStarted(0, "big")
+        big.setStageFinished(0, "big")  # makes the small stage runnable
+        t.join()
+        assert waited == [True] and pipeline.work_waiters == {}
+
+    def test_wait_for_work_without_loop(self, wide_pipeline):
+        # e.g., from the Pyro server: answer immediately
+        assert wide_pipeline.waitForWork("exec", 0.5, 1, timeout=30) is False
+        assert wide_pipeline.waitForWork("exec", 4.0, 1, timeout=30) is True
+
+
+class TestPersistentProxy():
+    def test_connection_per_thread(self, serve):
+        p = rpc.PersistentProxy(serve(Echo()))
+        results = []
+        threads = [threading.Thread(target=lambda i=i: results.append(p.echo(i))) for i in range(3)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert sorted(results) == [0, 1, 2] and len(p._proxies) == 3
+        p.close()
+        assert p._proxies == [] and p.echo(4) == 4
+
+    def test_reconnect(self, serve):
+        p = rpc.PersistentProxy(serve(Echo()), backoff=0.01)
+        assert p.echo(1) == 1
+        p._proxy()._sock.close()  # e.g., the connection was dropped
+        assert p.echo(2) == 2
+
+    def test_lost_claim_reply(self, serve, wide_pipeline, monkeypatch):
+        p = rpc.PersistentProxy(serve(wide_pipeline), backoff=0.01)
+        p.registerClient("exec", 16.0)
+        call, lost = rpc.Proxy._call, []
+
+        def lose_first_claim_reply(proxy, method, *args, **kwargs):
+            result = call(proxy, method, *args, **kwargs)
+            if method == "claim" and not lost:
+                lost.append(result)
+                raise rpc.CommunicationError("connection reset")  # (after the server has handed out the stages)
+            return result
+        monkeypatch.setattr(rpc.Proxy, "_call", lose_first_claim_reply)
+        flag, stages = p.claim("exec", clientMemFree=4.0, clientProcsFree=1, max_n=1, request_id=0)
+        # the retry gets the stage handed out by the lost call, rather than another one
+        assert flag == "run_stage" and [s.ix for s in stages] == [s.ix for s in lost[0][1]] == [2]
+        assert wide_pipeline.clients["exec"].running_stages == {2}
+        flag, stages = p.claim("exec", clientMemFree=4.0, clientProcsFree=1, max_n=1, request_id=1)
+        assert [s.ix for s in stages] == [3] and wide_pipeline.clients["exec"].running_stages == {2, 3}
+
+    def test_give_up(self):
+        p = rpc.PersistentProxy(rpc.format_uri("127.0.0.1", 1), retries=2, backoff=0.01)
+        with pytest.raises(rpc.CommunicationError):
+            p.echo(1)